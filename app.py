@@ -1,19 +1,52 @@
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import gspread
+import requests
+from gspread.http_client import HTTPClient
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import re
-from datetime import datetime, timedelta, time
+from datetime import datetime, timedelta, time, date
 import urllib.parse
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple, NamedTuple, Iterator, Iterable, BinaryIO, Callable, MutableMapping
 import math
+import io
+import json
+import random
+import os
+import sqlite3
+import tempfile
+import threading
+import time as time_module
+import functools
+import heapq
+import bisect
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from gspread.utils import numericise_all
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка общего снимка недоступна
+    fcntl = None
+try:
+    import openpyxl
+except ImportError:  # без openpyxl выгрузка в XLSX недоступна
+    openpyxl = None
 
 
 # ================================================================
 # КОНСТАНТЫ И НАСТРОЙКИ
 # ================================================================
 SPREADSHEET_NAME = "Start"
+# Ключ таблицы из её адреса: открытие по ключу обходится без поиска таблицы по имени в Drive
+SPREADSHEET_KEY = os.environ.get("CRM_SPREADSHEET_KEY", "")
 WORKSHEET_NAME_ORDERS = "ЗАЯВКИ"
 WORKSHEET_NAME_PRICE = "ПРАЙС"
+WORKSHEET_NAME_COUNTER = "НОМЕРА"
+WORKSHEET_NAME_ORDER_ITEMS = "ПОЗИЦИИ"
 EXPECTED_HEADERS = [
     "ДАТА_ВВОДА",
     "НОМЕР_ЗАЯВКИ",
@@ -24,6 +57,12 @@ EXPECTED_HEADERS = [
     "ЗАКАЗ",
     "СУММА"
 ]
+# Служебный столбец I: метка последнего изменения строки, по ней работает дозагрузка изменений
+REVISION_HEADER = "РЕВИЗИЯ"
+SHEET_HEADERS = EXPECTED_HEADERS + [REVISION_HEADER]
+# Позиции заказа построчно (лист ПОЗИЦИИ / таблица order_items), рядом с текстом в ЗАКАЗ
+ORDER_ITEM_COLUMNS = ["НОМЕР_ЗАЯВКИ", "НАИМЕНОВАНИЕ", "КОЛИЧЕСТВО", "ЦЕНА_ЗА_ЕД", "КОММЕНТАРИЙ_ПОЗИЦИИ"]
+ORDER_ITEMS_SHEET_HEADERS = ORDER_ITEM_COLUMNS + [REVISION_HEADER]
 # Индекс столбца для сортировки/вставки: ДАТА_ДОСТАВКИ (E)
 DELIVERY_DATE_COLUMN_INDEX = 5
 MANAGER_WHATSAPP_PHONE = "79000000000"
@@ -37,6 +76,126 @@ PARSE_DATETIME_FORMAT = '%d.%m.%Y %H:%M:%S'
 DISPLAY_DATE_FORMAT = '%d.%m.%Y %H:%M'  # Формат для отображения без секунд
 
 
+# — КВОТЫ GOOGLE SHEETS API —
+# Общий бюджет процесса (квота Sheets API по умолчанию - 60 запросов в минуту на пользователя)
+SHEETS_REQUESTS_PER_MINUTE = 55
+SHEETS_REQUEST_BURST = 10
+SHEETS_MAX_RETRIES = 5
+SHEETS_BACKOFF_BASE_SECONDS = 1.0
+SHEETS_BACKOFF_MAX_SECONDS = 32.0
+
+
+# — ХРАНИЛИЩЕ ЗАЯВОК —
+# "gsheets" — Google Sheets (как раньше), "sqlite" — локальная база как основное хранилище
+STORAGE_BACKEND = os.environ.get("CRM_STORAGE_BACKEND", "gsheets")
+SQLITE_DB_PATH = os.environ.get("CRM_SQLITE_PATH", "crm_orders.db")
+# Дублировать записи локальной базы в Google Sheets (зеркало)
+SHEETS_MIRROR_ENABLED = os.environ.get("CRM_SHEETS_MIRROR", "0") == "1"
+# Как часто (сек) проверять лист ЗАЯВКИ на изменения, сделанные другими операторами
+SHEETS_SYNC_INTERVAL_SECONDS = 20
+# Файл Arrow с копией листа ЗАЯВКИ, общей для процессов Streamlit на этой машине (пусто - у каждого своя).
+# Переживает перезапуск: после старта страница строится из него, сверка с листом идёт в фоне
+SHARED_SNAPSHOT_PATH = os.environ.get("CRM_SHARED_SNAPSHOT", "crm_orders.arrow")
+# Если изменилась большая доля строк, дешевле перечитать лист целиком
+SHEETS_DELTA_MAX_FRACTION = 0.3
+SHEETS_DELTA_MAX_RANGES = 200
+# Сколько ячеек столбца E читать за один запрос при поиске границ окна дат в листе
+SHEETS_WINDOW_PROBES = 32
+
+
+# Запись в Google Sheets через фоновую очередь (сохранение не ждёт ответа API)
+WRITE_QUEUE_ENABLED = os.environ.get("CRM_WRITE_QUEUE", "1") == "1"
+WRITE_QUEUE_PATH = os.environ.get("CRM_WRITE_QUEUE_PATH", "crm_outbox.db")
+WRITE_QUEUE_FLUSH_SECONDS = 2
+WRITE_QUEUE_MAX_BATCH = 200
+WRITE_QUEUE_MAX_ATTEMPTS = 5
+
+
+# — АРХИВ ЗАЯВОК —
+# Заявки с доставкой старше горизонта (дней) переносятся в помесячные листы АРХИВ_ГГГГ-ММ
+ARCHIVE_HORIZON_DAYS = int(os.environ.get("CRM_ARCHIVE_DAYS", "90"))
+ARCHIVE_SHEET_PREFIX = "АРХИВ_"
+WORKSHEET_NAME_ARCHIVE_INDEX = "АРХИВ_ИНДЕКС"
+ARCHIVE_INDEX_HEADERS = ["НОМЕР_ЗАЯВКИ", "ЛИСТ", "СТРОКА"]
+# update_order возвращает это значение, если заявка перезаписана в архиве
+ARCHIVED_ORDER_POSITION = -2
+
+
+# — ЗАГРУЗКА СЛОТОВ ДОСТАВКИ —
+# Заявок на один слот (дата + интервал TIME_STEP_SECONDS); 0 - без ограничения
+SLOT_CAPACITY = int(os.environ.get("CRM_SLOT_CAPACITY", "6"))
+# "warn" - предупреждать о заполненном слоте, "refuse" - не сохранять заявку в него
+SLOT_OVERBOOKING = os.environ.get("CRM_SLOT_OVERBOOKING", "warn")
+
+
+# — ПОСТОЯННЫЕ КЛИЕНТЫ —
+CUSTOMER_RECENT_ORDERS = 5
+CUSTOMER_TOP_ITEMS = 5
+
+
+# — СПИСОК ЗАЯВОК —
+# Строк на странице таблицы во вкладке «Список Заявок»
+LIST_PAGE_SIZE = 50
+# Окна по дате доставки: число дней начиная с сегодняшнего (None - все заявки)
+LIST_PERIOD_OPTIONS = {"Сегодня и завтра": 2, "7 дней": 7, "30 дней": 30, "Все заявки": None}
+
+
+# — ПРАЙС —
+# Как часто (сек) проверять ревизию прайса; сам прайс перечитывается только при её смене
+PRICE_REVISION_CHECK_SECONDS = 10
+# Если хранилище не умеет отдавать ревизию - перечитывать прайс не реже этого интервала
+PRICE_RELOAD_FALLBACK_SECONDS = 3600
+# Ячейка листа ПРАЙС с контрольной суммой содержимого (формула вписывается автоматически)
+PRICE_REVISION_CELL = "Z1"
+PRICE_REVISION_FORMULA = '=COUNTA(A1:Y)&"-"&SUM(A1:Y)&"-"&SUMPRODUCT(LEN(A1:Y))'
+# Необязательный столбец прайса с артикулом
+PRICE_SKU_HEADER = "АРТИКУЛ"
+# Снимок прайса с его ревизией для быстрого старта (пусто - не сохранять)
+PRICE_SNAPSHOT_PATH = os.environ.get("CRM_PRICE_SNAPSHOT", "crm_prices.arrow")
+
+
+# — ИМПОРТ ЗАЯВОК —
+# Строка файла CSV/XLSX - позиция заказа. Строки с одинаковым ЗАКАЗ_ID (без него - с одинаковыми
+# телефоном, адресом и датой доставки) образуют одну заявку; позиция - по НАИМЕНОВАНИЕ или АРТИКУЛ
+IMPORT_REQUIRED_COLUMNS = ["ТЕЛЕФОН", "АДРЕС", "ДАТА_ДОСТАВКИ", "КОЛИЧЕСТВО"]
+IMPORT_OPTIONAL_COLUMNS = ["ЗАКАЗ_ID", "НАИМЕНОВАНИЕ", PRICE_SKU_HEADER, "КОММЕНТАРИЙ", "КОММЕНТАРИЙ_ПОЗИЦИИ"]
+IMPORT_MAX_ROWS = 5000
+
+
+# — АНАЛИТИКА —
+ANALYTICS_TOP_ITEMS = 20
+
+
+# — ВЫГРУЗКА ЗАЯВОК —
+# Заявки читаются из хранилища и пишутся в файл кусками по EXPORT_CHUNK_ROWS строк
+EXPORT_CHUNK_ROWS = 2000
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "XLSX": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+# Столбцы позиции при выгрузке "позиция - строка" (вместо ЗАКАЗ)
+EXPORT_ITEM_COLUMNS = ["НАИМЕНОВАНИЕ", "КОЛИЧЕСТВО", "ЦЕНА_ЗА_ЕД", "СУММА_ПОЗИЦИИ", "КОММЕНТАРИЙ_ПОЗИЦИИ"]
+EXPORT_FLOAT_COLUMNS = ["СУММА", "ЦЕНА_ЗА_ЕД", "СУММА_ПОЗИЦИИ"]
+XLSX_MAX_ROWS = 1048576
+
+
+# — НОМЕРА ЗАЯВОК —
+ORDER_NUMBER_START = 1001
+# Сколько номеров процесс резервирует в хранилище за одно обращение
+ORDER_NUMBER_BLOCK_SIZE = 5
+
+
+# — ТРАССИРОВКА —
+# Замер времени вызовов хранилища, запросов к API и блоков страницы
+TRACE_ENABLED = os.environ.get("CRM_TRACE", "1") == "1"
+# Файл JSON-lines, куда раз в TRACE_EXPORT_SECONDS дописываются накопленные показатели (пусто - не писать)
+TRACE_LOG_PATH = os.environ.get("CRM_TRACE_LOG", "")
+TRACE_EXPORT_SECONDS = 60
+# Порт HTTP-сервера с показателями в текстовом формате Prometheus (0 - не запускать)
+METRICS_PORT = int(os.environ.get("CRM_METRICS_PORT", "0"))
+
+
 st.set_page_config(
     page_title="CRM: Ввод Новой Заявки",
     layout="wide",
@@ -44,71 +203,3475 @@ st.set_page_config(
 )
 
 
+# ================================================================
+# ТРАССИРОВКА (время вызовов, попадания в кэш, экспорт показателей)
+# ================================================================
+class SpanRecord(NamedTuple):
+    """Замер одного участка текущего перезапуска страницы"""
+    name: str
+    depth: int
+    seconds: float
+
+
+class Tracer:
+    """Лёгкая трассировка: участки (span) с замером времени и счётчики кэшей.
+
+    Каждый участок попадает в общие для процесса суммы (число вызовов, общее и
+    наибольшее время), а если поток выполняет перезапуск страницы - ещё и в его
+    разбивку для панели отладки. Streamlit выполняет сценарий каждой сессии в
+    своём потоке, поэтому разбивка хранится в threading.local. Экземпляр на
+    процесс выдаёт get_tracer(): глобальные переменные сценария создаются заново
+    при каждом перезапуске.
+    """
+
+    def __init__(self, enabled: bool = TRACE_ENABLED):
+        self.enabled = enabled
+        self.started_at = time_module.time()
+        self.spans: Dict[str, Dict[str, float]] = {}
+        self.caches: Dict[str, Dict[str, int]] = {}
+        self.reruns = 0
+        # Первый же перезапуск страницы выгружает показатели
+        self._last_export = 0.0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _record(self, name: str, seconds: float):
+        with self._lock:
+            stats = self.spans.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        open_spans = self._local.__dict__.setdefault('open', set())
+        if name in open_spans:
+            # Вложенный вызов того же участка (например, через super()) уже замеряется
+            yield
+            return
+        rerun = getattr(self._local, 'rerun', None)
+        depth = getattr(self._local, 'depth', 0)
+        index = None
+        if rerun is not None:
+            index = len(rerun)
+            rerun.append(SpanRecord(name, depth, 0.0))
+        self._local.depth = depth + 1
+        open_spans.add(name)
+        started = time_module.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time_module.perf_counter() - started
+            open_spans.discard(name)
+            self._local.depth = depth
+            if index is not None:
+                rerun[index] = SpanRecord(name, depth, seconds)
+            self._record(name, seconds)
+
+    def wrap(self, name: str, fn):
+        """Функция fn, каждый вызов которой замеряется как участок name"""
+        @functools.wraps(fn)
+        def traced(*args, **kwargs):
+            with self.span(name):
+                return fn(*args, **kwargs)
+        return traced
+
+    @contextlib.contextmanager
+    def rerun(self, name: str = "rerun"):
+        """Перезапуск страницы (или отдельно фрагмента): разбивка участков собирается заново"""
+        self._local.rerun = []
+        self._local.depth = 0
+        try:
+            with self.span(name):
+                yield
+        finally:
+            self._local.rerun = None
+            with self._lock:
+                self.reruns += 1
+            self.maybe_export()
+
+    def in_rerun(self) -> bool:
+        """Поток сейчас выполняет перезапуск под rerun()"""
+        return getattr(self._local, 'rerun', None) is not None
+
+    def current_rerun(self) -> List[SpanRecord]:
+        return list(getattr(self._local, 'rerun', None) or [])
+
+    @contextlib.contextmanager
+    def cache_call(self, name: str):
+        """Вызов кэшированной функции: промах отмечает mark_cache_miss() изнутри вычисления"""
+        stack = self._local.__dict__.setdefault('cache_stack', [])
+        stack.append(False)
+        try:
+            with self.span(f"cache.{name}"):
+                yield
+        finally:
+            missed = stack.pop()
+            with self._lock:
+                counts = self.caches.setdefault(name, {'hits': 0, 'misses': 0})
+                counts['misses' if missed else 'hits'] += 1
+
+    def mark_cache_miss(self):
+        stack = getattr(self._local, 'cache_stack', None)
+        if stack:
+            stack[-1] = True
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'time': datetime.now().isoformat(timespec='seconds'),
+                'uptime_seconds': round(time_module.time() - self.started_at, 1),
+                'reruns': self.reruns,
+                'spans': {name: dict(stats) for name, stats in self.spans.items()},
+                'caches': {name: dict(counts) for name, counts in self.caches.items()},
+            }
+
+    def maybe_export(self):
+        """Дописывает накопленные показатели в TRACE_LOG_PATH не чаще TRACE_EXPORT_SECONDS"""
+        if not TRACE_LOG_PATH or time_module.monotonic() - self._last_export < TRACE_EXPORT_SECONDS:
+            return
+        self._last_export = time_module.monotonic()
+        try:
+            with open(TRACE_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(self.snapshot(), ensure_ascii=False) + "\n")
+        except OSError:
+            pass
+
+    def prometheus_text(self) -> str:
+        snapshot = self.snapshot()
+
+        def label(value: str) -> str:
+            return value.replace('\\', '\\\\').replace('"', '\\"')
+        lines = [
+            "# TYPE crm_reruns_total counter",
+            f"crm_reruns_total {snapshot['reruns']}",
+            "# TYPE crm_span_calls_total counter",
+        ]
+        lines += [f'crm_span_calls_total{{span="{label(n)}"}} {s["calls"]}' for n, s in snapshot['spans'].items()]
+        lines.append("# TYPE crm_span_seconds_total counter")
+        lines += [f'crm_span_seconds_total{{span="{label(n)}"}} {s["seconds"]:.6f}' for n, s in snapshot['spans'].items()]
+        lines.append("# TYPE crm_span_seconds_max gauge")
+        lines += [f'crm_span_seconds_max{{span="{label(n)}"}} {s["max_seconds"]:.6f}' for n, s in snapshot['spans'].items()]
+        lines.append("# TYPE crm_cache_requests_total counter")
+        for name, counts in snapshot['caches'].items():
+            lines.append(f'crm_cache_requests_total{{cache="{label(name)}",result="hit"}} {counts["hits"]}')
+            lines.append(f'crm_cache_requests_total{{cache="{label(name)}",result="miss"}} {counts["misses"]}')
+        return "\n".join(lines) + "\n"
+
+
+@st.cache_resource
+def get_tracer() -> Tracer:
+    """Трассировка, общая для всех сессий и перезапусков сценария в процессе"""
+    return Tracer()
+
+
+tracer = get_tracer()
+
+
+def traced_cache(cache_decorator, name: str, **cache_kwargs):
+    """st.cache_data / st.cache_resource со счётчиками попаданий и промахов в трассировке"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def compute(*args, **kwargs):
+            tracer.mark_cache_miss()
+            return fn(*args, **kwargs)
+        cached = cache_decorator(**cache_kwargs)(compute) if cache_kwargs else cache_decorator(compute)
+
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            with tracer.cache_call(name):
+                return cached(*args, **kwargs)
+        call.clear = cached.clear
+        return call
+    return decorate
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """GET /metrics - показатели трассировки в текстовом формате Prometheus"""
+
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        body = get_tracer().prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@st.cache_resource
+def start_metrics_server() -> Optional[ThreadingHTTPServer]:
+    """HTTP-сервер показателей на METRICS_PORT (один на процесс)"""
+    if not METRICS_PORT:
+        return None
+    try:
+        server = ThreadingHTTPServer(('0.0.0.0', METRICS_PORT), MetricsRequestHandler)
+    except OSError as e:
+        st.warning(f"Не удалось открыть порт показателей {METRICS_PORT}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+def sheets_endpoint_name(method: str, endpoint: str) -> str:
+    """Короткое имя запроса к Sheets API для трассировки (values.get, batchUpdate и т.п.)"""
+    path = urllib.parse.urlparse(str(endpoint)).path
+    for suffix, name in ((':batchUpdate', 'batchUpdate'), (':batchGet', 'batchGet'), (':append', 'append'),
+                         (':clear', 'clear')):
+        if path.endswith(suffix):
+            return f"values.{name}" if '/values' in path else name
+    if '/values/' in path:
+        return 'values.get' if method.lower() == 'get' else 'values.update'
+    return f"spreadsheet.{method.lower()}"
+
+
 # ================================================================
 # БАЗОВЫЕ ФУНКЦИИ (Работа с данными и Google Sheets)
 # ================================================================
-@st.cache_resource(ttl=3600)
+class SheetsRequestGovernor:
+    """Общий для процесса бюджет запросов к Google Sheets API с повторами.
+
+    - token bucket: не больше SHEETS_REQUESTS_PER_MINUTE запросов в минуту на процесс
+      (с допустимым всплеском SHEETS_REQUEST_BURST), лишние запросы ждут токен;
+    - временные ошибки (429, 408, 5xx, обрыв соединения) повторяются с
+      экспоненциальной задержкой и случайным разбросом (full jitter); неидемпотентные
+      запросы (idempotent=False) - только при 429: квота отклоняет запрос до его
+      выполнения, а после 5xx или обрыва запись могла уже примениться;
+    - одинаковые одновременные чтения выполняются один раз, результат получают все;
+    - счётчики запросов, повторов и ожиданий доступны через stats().
+
+    Не зависит от gspread: call() принимает любую функцию, а время и сон можно
+    подменить (clock, sleep) для проверки на заглушке со сценарием ответов 429/5xx.
+    """
+
+    RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+    def __init__(self, requests_per_minute: float = SHEETS_REQUESTS_PER_MINUTE,
+                 burst: int = SHEETS_REQUEST_BURST, max_retries: int = SHEETS_MAX_RETRIES,
+                 clock=time_module.monotonic, sleep=time_module.sleep):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(burst)
+        self.max_retries = max_retries
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Any, Dict[str, Any]] = {}
+        self._stats = {'requests': 0, 'retries': 0, 'failures': 0, 'deduplicated': 0,
+                       'rate_limit_wait_seconds': 0.0, 'backoff_seconds': 0.0}
+
+    def _acquire(self):
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self._stats['rate_limit_wait_seconds'] += wait
+        if wait:
+            self._sleep(wait)
+
+    @classmethod
+    def _retryable(cls, error: Exception, idempotent: bool = True) -> bool:
+        code = getattr(error, 'code', None)
+        if code is None:
+            code = getattr(getattr(error, 'response', None), 'status_code', None)
+        if not idempotent:
+            return code == 429
+        if code in cls.RETRY_STATUS_CODES:
+            return True
+        return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+    @staticmethod
+    def _retry_after(error: Exception) -> Optional[float]:
+        headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+        try:
+            return float(headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+
+    def _call_with_retries(self, fn, idempotent: bool = True):
+        attempt = 0
+        while True:
+            self._acquire()
+            with self._lock:
+                self._stats['requests'] += 1
+            try:
+                return fn()
+            except Exception as e:
+                if attempt >= self.max_retries or not self._retryable(e, idempotent):
+                    with self._lock:
+                        self._stats['failures'] += 1
+                    raise
+                ceiling = min(SHEETS_BACKOFF_MAX_SECONDS, SHEETS_BACKOFF_BASE_SECONDS * 2 ** attempt)
+                delay = max(self._retry_after(e) or 0.0, random.uniform(0, ceiling))
+                with self._lock:
+                    self._stats['retries'] += 1
+                    self._stats['backoff_seconds'] += delay
+                self._sleep(delay)
+                attempt += 1
+
+    def call(self, fn, dedupe_key: Any = None, idempotent: bool = True):
+        """Выполняет fn() в рамках бюджета; запросы с одинаковым dedupe_key объединяются"""
+        if dedupe_key is None:
+            return self._call_with_retries(fn, idempotent)
+        with self._lock:
+            flight = self._in_flight.get(dedupe_key)
+            leader = flight is None
+            if leader:
+                flight = {'done': threading.Event(), 'result': None, 'error': None}
+                self._in_flight[dedupe_key] = flight
+            else:
+                self._stats['deduplicated'] += 1
+        if not leader:
+            flight['done'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['result']
+        try:
+            flight['result'] = self._call_with_retries(fn)
+            return flight['result']
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(dedupe_key, None)
+            flight['done'].set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats)
+
+
+@traced_cache(st.cache_resource, "get_request_governor")
+def get_request_governor() -> SheetsRequestGovernor:
+    return SheetsRequestGovernor()
+
+
+class QuotaAwareHTTPClient(HTTPClient):
+    """HTTP-клиент gspread, пропускающий все запросы через SheetsRequestGovernor"""
+
+    # Повтор этих запросов не меняет результат; остальные (POST: append, batchUpdate) повторяются только при 429
+    IDEMPOTENT_METHODS = {'get', 'head', 'put'}
+
+    def __init__(self, auth, session=None):
+        super().__init__(auth, session)
+        self.governor = get_request_governor()
+
+    def request(self, method, endpoint, params=None, data=None, json=None, files=None, headers=None):
+        def send():
+            return super(QuotaAwareHTTPClient, self).request(
+                method, endpoint, params=params, data=data, json=json, files=files, headers=headers
+            )
+        # Объединяем только чтения: повтор записи изменил бы данные дважды
+        dedupe_key = None
+        if method.lower() == 'get' and data is None and json is None and files is None:
+            dedupe_key = (endpoint, repr(sorted(params.items())) if isinstance(params, dict) else repr(params))
+        with tracer.span(f"sheets.{sheets_endpoint_name(method, endpoint)}"):
+            return self.governor.call(send, dedupe_key=dedupe_key,
+                                      idempotent=method.lower() in self.IDEMPOTENT_METHODS)
+
+
+@traced_cache(st.cache_resource, "get_gsheet_client", ttl=3600)
 def get_gsheet_client():
     if "gcp_service_account" not in st.secrets:
         st.error("Секрет 'gcp_service_account' не найден. Проверьте конфигурацию secrets.toml.")
         return None
     try:
-        return gspread.service_account_from_dict(st.secrets["gcp_service_account"])
+        return gspread.service_account_from_dict(
+            st.secrets["gcp_service_account"],
+            http_client=QuotaAwareHTTPClient
+        )
     except Exception as e:
         st.error(f"Ошибка аутентификации: {e}")
         return None
 
 
-@st.cache_resource
+@traced_cache(st.cache_resource, "get_orders_worksheet")
 def get_orders_worksheet():
     gc = get_gsheet_client()
     if not gc:
         return None
     try:
-        sh = gc.open(SPREADSHEET_NAME)
+        sh = gc.open_by_key(SPREADSHEET_KEY) if SPREADSHEET_KEY else gc.open(SPREADSHEET_NAME)
         worksheet = sh.worksheet(WORKSHEET_NAME_ORDERS)
         current_headers = worksheet.row_values(1)
-        if current_headers != EXPECTED_HEADERS:
-            worksheet.update('A1', [EXPECTED_HEADERS])
+        if current_headers != SHEET_HEADERS:
+            worksheet.update('A1', [SHEET_HEADERS])
         return worksheet
     except Exception as e:
         st.error(f"Ошибка доступа к листу '{WORKSHEET_NAME_ORDERS}': {e}")
         return None
 
 
-@st.cache_data(ttl="1h")
-def load_all_orders():
-    orders_ws = get_orders_worksheet()
-    if not orders_ws:
-        return pd.DataFrame()
+class LazySheetHandle:
+    """Объект gspread (лист или таблица), открываемый при первом обращении к нему.
+
+    Хранилище и очередь записи создаются без авторизации и запросов к API: при
+    старте из снимка на диске лист открывается уже в фоновой сверке.
+    """
+
+    def __init__(self, opener):
+        self._opener = opener
+        self._target = None
+        self._lock = threading.Lock()
+
+    def resolve(self):
+        with self._lock:
+            if self._target is None:
+                self._target = self._opener()
+                if self._target is None:
+                    raise RuntimeError(f"Лист '{WORKSHEET_NAME_ORDERS}' недоступен.")
+            return self._target
+
+    def __getattr__(self, name: str):
+        return getattr(self.resolve(), name)
+
+
+def open_order_items_worksheet(spreadsheet):
+    """Лист ПОЗИЦИИ (создаётся с заголовком при первом обращении)"""
+    try:
+        return spreadsheet.worksheet(WORKSHEET_NAME_ORDER_ITEMS)
+    except gspread.WorksheetNotFound:
+        worksheet = spreadsheet.add_worksheet(
+            title=WORKSHEET_NAME_ORDER_ITEMS, rows=1000, cols=len(ORDER_ITEMS_SHEET_HEADERS)
+        )
+        worksheet.update(values=[ORDER_ITEMS_SHEET_HEADERS], range_name='A1')
+        return worksheet
+
+
+# ================================================================
+# ХРАНИЛИЩЕ ЗАЯВОК (Google Sheets / локальная база SQLite)
+# ================================================================
+def parse_sheet_datetime(dt_str: Any) -> Optional[datetime]:
+    """Разбирает дату-время в формате таблицы, None если формат не распознан"""
     try:
-        data = orders_ws.get_all_records()
-        df = pd.DataFrame(data)
+        return datetime.strptime(str(dt_str), PARSE_DATETIME_FORMAT)
+    except ValueError:
+        return None
+
+
+def delivery_slot(dt: datetime) -> int:
+    """Начало слота доставки в секундах от начала дня (шаг TIME_STEP_SECONDS)"""
+    seconds = dt.hour * 3600 + dt.minute * 60 + dt.second
+    return seconds // TIME_STEP_SECONDS * TIME_STEP_SECONDS
+
+
+def slot_label(slot: int) -> str:
+    return f"{slot // 3600:02d}:{slot % 3600 // 60:02d}"
+
+
+class OrderChange(NamedTuple):
+    """Запись журнала изменений таблицы заявок"""
+    version: int
+    kind: str  # 'insert', 'update' или 'delete'
+    row_id: int
+    position: int
+    old: Optional[Dict[str, Any]]
+    new: Optional[Dict[str, Any]]
+
+
+def longest_increasing_subsequence(values: List[int]) -> List[int]:
+    """Индексы самой длинной строго возрастающей подпоследовательности values"""
+    tails, tail_index, parent = [], [], [-1] * len(values)
+    for i, value in enumerate(values):
+        k = bisect.bisect_left(tails, value)
+        if k == len(tails):
+            tails.append(value)
+            tail_index.append(i)
+        else:
+            tails[k] = value
+            tail_index[k] = i
+        parent[i] = tail_index[k - 1] if k else -1
+    result, i = [], tail_index[-1] if tail_index else -1
+    while i >= 0:
+        result.append(i)
+        i = parent[i]
+    return result[::-1]
+
+
+class OrdersTable:
+    """Общая для процесса таблица заявок в памяти с номером версии.
+
+    Индекс DataFrame - стабильные идентификаторы строк, не меняющиеся при вставках
+    выше. Каждая вставка/перезапись/удаление увеличивает version и попадает в журнал:
+    производные кэши (отображение, индексы) догоняют версию по changes_since()
+    или перестраиваются целиком, если журнал вернул None (была полная замена).
+    Синхронизация с источником идёт через merge(), который пишет в журнал только
+    отличающиеся строки.
+    DataFrame не изменяется на месте - каждое изменение создаёт новый объект,
+    поэтому уже выданные сессиям ссылки остаются согласованными.
+    """
+
+    CHANGE_LOG_LIMIT = 1000
+
+    def __init__(self, columns: List[str]):
+        self.columns = columns
+        self.df = pd.DataFrame(columns=columns)
+        self.version = 0
+        self.loaded = False
+        self._reset_version = 0
+        self._changes: List[OrderChange] = []
+        self._next_id = 0
+        self._lock = threading.RLock()
+
+    def replace(self, frame: pd.DataFrame):
+        """Полная замена содержимого (загрузка или перезагрузка из источника)"""
+        with self._lock:
+            frame = frame.reindex(columns=self.columns, fill_value="")
+            frame.index = pd.RangeIndex(self._next_id, self._next_id + len(frame))
+            self._next_id += len(frame)
+            self.df = frame
+            self.version += 1
+            self._reset_version = self.version
+            self._changes = []
+            self.loaded = True
+
+    def merge(self, frame: pd.DataFrame, key_columns: Optional[List[str]] = None) -> int:
+        """Приводит таблицу к frame, записывая в журнал только отличающиеся строки.
+
+        Строки сопоставляются по ключу key_columns (по умолчанию - все столбцы),
+        строки с одинаковым ключом считаются одинаковыми. Совпавшие строки,
+        сохранившие взаимный порядок, оставляют свои идентификаторы и в журнал не
+        попадают; остальные записываются перезаписями, удалениями и вставками по
+        позициям. Если таблица не загружена или изменений больше, чем вмещает
+        журнал, - полная замена. Возвращает число записей журнала (-1 - замена).
+        """
+        with self._lock:
+            frame = frame.reindex(columns=self.columns, fill_value="")
+            if not self.loaded:
+                self.replace(frame)
+                return -1
+            key_columns = key_columns or self.columns
+            old_keys = self._row_keys(self.df, key_columns)
+            new_keys = self._row_keys(frame, key_columns)
+            free: Dict[Tuple, List[int]] = {}
+            for position in range(len(old_keys) - 1, -1, -1):
+                free.setdefault(old_keys[position], []).append(position)
+            sources = []
+            for key in new_keys:
+                positions = free.get(key)
+                sources.append(positions.pop() if positions else -1)
+            matched = [new_pos for new_pos, source in enumerate(sources) if source >= 0]
+            matched_sources = [sources[new_pos] for new_pos in matched]
+            if any(b <= a for a, b in zip(matched_sources, matched_sources[1:])):
+                matched = [matched[i] for i in longest_increasing_subsequence(matched_sources)]
+            kept = [(sources[new_pos], new_pos) for new_pos in matched]
+
+            # Промежутки между сохранёнными строками: попарно перезаписи, остаток -
+            # удаления или вставки; позиции - в таблице после предыдущих записей
+            planned, prev_old, prev_new, current = [], 0, 0, 0
+            for old_pos, new_pos in kept + [(len(old_keys), len(new_keys))]:
+                old_gap, new_gap = range(prev_old, old_pos), range(prev_new, new_pos)
+                common = min(len(old_gap), len(new_gap))
+                planned += [('update', current + j, old_gap[j], new_gap[j]) for j in range(common)]
+                planned += [('delete', current + common, old_gap[j], -1) for j in range(common, len(old_gap))]
+                planned += [('insert', current + j, -1, new_gap[j]) for j in range(common, len(new_gap))]
+                current += len(new_gap) + 1
+                prev_old, prev_new = old_pos + 1, new_pos + 1
+            if len(planned) > self.CHANGE_LOG_LIMIT:
+                self.replace(frame)
+                return -1
+            if not planned:
+                return 0
+
+            old_ids = self.df.index.to_numpy()
+            ids = np.empty(len(frame), dtype=np.int64)
+            for old_pos, new_pos in kept:
+                ids[new_pos] = old_ids[old_pos]
+            logged = []
+            for kind, position, old_pos, new_pos in planned:
+                if kind == 'insert':
+                    row_id = self._next_id
+                    self._next_id += 1
+                else:
+                    row_id = int(old_ids[old_pos])
+                if new_pos >= 0:
+                    ids[new_pos] = row_id
+                old = self.df.iloc[old_pos].to_dict() if old_pos >= 0 else None
+                new = frame.iloc[new_pos].to_dict() if new_pos >= 0 else None
+                logged.append((kind, row_id, position, old, new))
+            frame = frame.copy()
+            frame.index = pd.Index(ids)
+            self.df = frame
+            for kind, row_id, position, old, new in logged:
+                self._log(kind, row_id, position, old, new)
+            return len(logged)
+
+    @staticmethod
+    def _row_keys(df: pd.DataFrame, key_columns: List[str]) -> List[Tuple]:
+        if df.empty:
+            return []
+        return list(zip(*(df[c].astype(str).tolist() for c in key_columns)))
+
+    def _row_frame(self, row_id: int, record: Dict[str, Any]) -> pd.DataFrame:
+        return pd.DataFrame([[record.get(c, "") for c in self.columns]], columns=self.columns, index=[row_id])
+
+    def _log(self, kind: str, row_id: int, position: int, old, new) -> int:
+        self.version += 1
+        self._changes.append(OrderChange(self.version, kind, row_id, position, old, new))
+        if len(self._changes) > self.CHANGE_LOG_LIMIT:
+            del self._changes[:len(self._changes) - self.CHANGE_LOG_LIMIT]
+        return row_id
+
+    def insert(self, position: int, record: Dict[str, Any]) -> int:
+        """Вставляет строку перед позицией position, возвращает её идентификатор"""
+        with self._lock:
+            position = max(0, min(position, len(self.df)))
+            row_id = self._next_id
+            self._next_id += 1
+            row = self._row_frame(row_id, record)
+            if self.df.empty:
+                self.df = row
+            else:
+                self.df = pd.concat([self.df.iloc[:position], row, self.df.iloc[position:]])
+            return self._log('insert', row_id, position, None, dict(record))
+
+    def insert_many(self, rows: List[Tuple[int, Dict[str, Any]]]) -> List[int]:
+        """Вставляет строки сразу на их итоговые позиции, возвращает идентификаторы.
+
+        DataFrame собирается один раз; в журнал попадают отдельные вставки по
+        возрастанию позиции, поэтому производные индексы догоняют их как обычно.
+        """
+        with self._lock:
+            rows = sorted(rows, key=lambda row: row[0])
+            old = self.df
+            pieces, logged, previous = [], [], 0
+            for k, (position, record) in enumerate(rows):
+                old_position = max(previous, min(position - k, len(old)))
+                row_id = self._next_id
+                self._next_id += 1
+                pieces += [old.iloc[previous:old_position], self._row_frame(row_id, record)]
+                logged.append((row_id, old_position + k, record))
+                previous = old_position
+            pieces.append(old.iloc[previous:])
+            self.df = pd.concat([piece for piece in pieces if len(piece)]) if rows else old
+            return [self._log('insert', row_id, position, None, dict(record)) for row_id, position, record in logged]
+
+    def update(self, position: int, record: Dict[str, Any]) -> int:
+        """Перезаписывает строку на позиции position, возвращает её идентификатор"""
+        with self._lock:
+            row_id = int(self.df.index[position])
+            old = self.df.iloc[position].to_dict()
+            row = self._row_frame(row_id, record)
+            self.df = pd.concat([self.df.iloc[:position], row, self.df.iloc[position + 1:]])
+            return self._log('update', row_id, position, old, dict(record))
+
+    def move(self, position: int, new_position: int, record: Dict[str, Any]) -> int:
+        """Перезаписывает строку на позиции position и переносит её на new_position
+        (позицию после переноса); в журнал - удаление и вставка с тем же идентификатором"""
+        with self._lock:
+            row_id = int(self.df.index[position])
+            old = self.df.iloc[position].to_dict()
+            rest = self.df.iloc[np.r_[0:position, position + 1:len(self.df)]]
+            pieces = [rest.iloc[:new_position], self._row_frame(row_id, record), rest.iloc[new_position:]]
+            self.df = pd.concat([piece for piece in pieces if len(piece)])
+            self._log('delete', row_id, position, old, None)
+            return self._log('insert', row_id, new_position, None, dict(record))
+
+    def changes_since(self, version: int) -> Optional[List[OrderChange]]:
+        """Изменения после version; None - нужно перестроиться с нуля"""
+        with self._lock:
+            if version < self._reset_version:
+                return None
+            if self._changes and version < self._changes[0].version - 1:
+                return None
+            return [c for c in self._changes if c.version > version]
+
+
+def parse_sheet_datetimes(values: pd.Series) -> np.ndarray:
+    """Векторный разбор столбца дат формата таблицы в datetime64 (NaT - не распознана)"""
+    parsed = pd.to_datetime(values.astype(str), format=PARSE_DATETIME_FORMAT, errors='coerce')
+    return parsed.to_numpy(dtype='datetime64[ns]')
+
+
+class DeliveryDateIndex:
+    """Индекс дат доставки в порядке строк для поиска позиции вставки без чтения листа.
+
+    Хранит разобранные ДАТА_ДОСТАВКИ по позициям (NaT - дата не распознана) и
+    отдельно отсортированные по позиции распознанные даты. Пока они идут по
+    неубыванию (лист поддерживается отсортированным), позиция ищется бинарным
+    поиском; если порядок нарушен ручной правкой или перезаписью даты - векторным
+    поиском первой даты не раньше новой. Догоняет таблицу по журналу изменений.
+    """
+
+    def __init__(self):
+        self.version = -1
+        self._ts = np.array([], dtype='datetime64[ns]')
+        self._valid_pos = np.array([], dtype=np.int64)
+        self._valid_ts = np.array([], dtype='datetime64[ns]')
+        self.is_sorted = True
+        self._lock = threading.Lock()
+
+    def sync(self, table: OrdersTable) -> 'DeliveryDateIndex':
+        with self._lock:
+            if self.version == table.version:
+                return self
+            changes = table.changes_since(self.version)
+            if changes is None:
+                self._rebuild(table.df)
+            else:
+                for change in changes:
+                    self._apply(change)
+            self.version = table.version
+            return self
+
+    @classmethod
+    def from_dates(cls, values: List[Any]) -> 'DeliveryDateIndex':
+        """Индекс по готовому списку дат (без привязки к таблице заявок)"""
+        index = cls()
+        index._rebuild(pd.DataFrame({'ДАТА_ДОСТАВКИ': values}))
+        return index
+
+    def _rebuild(self, df: pd.DataFrame):
+        self._ts = parse_sheet_datetimes(df['ДАТА_ДОСТАВКИ']) if len(df) else np.array([], dtype='datetime64[ns]')
+        valid = ~np.isnat(self._ts)
+        self._valid_pos = np.flatnonzero(valid).astype(np.int64)
+        self._valid_ts = self._ts[valid]
+        self._check_sorted()
+
+    def _check_sorted(self):
+        self.is_sorted = bool(np.all(self._valid_ts[1:] >= self._valid_ts[:-1]))
+
+    def _apply(self, change: OrderChange):
+        p = change.position
+        k = int(np.searchsorted(self._valid_pos, p))
+        if change.kind != 'insert' and k < len(self._valid_pos) and self._valid_pos[k] == p:
+            self._valid_pos = np.delete(self._valid_pos, k)
+            self._valid_ts = np.delete(self._valid_ts, k)
+        if change.kind == 'delete':
+            self._ts = np.delete(self._ts, p)
+            self._valid_pos[k:] -= 1
+            self._check_sorted()
+            return
+        new_dt = parse_sheet_datetime(change.new.get('ДАТА_ДОСТАВКИ', ""))
+        new_ts = np.datetime64(new_dt, 'ns') if new_dt else np.datetime64('NaT', 'ns')
+        if change.kind == 'insert':
+            self._ts = np.insert(self._ts, p, new_ts)
+            self._valid_pos[k:] += 1
+        else:
+            self._ts[p] = new_ts
+        if new_dt:
+            self._valid_pos = np.insert(self._valid_pos, k, p)
+            self._valid_ts = np.insert(self._valid_ts, k, new_ts)
+        self._check_sorted()
+
+    @property
+    def unparsed_positions(self) -> np.ndarray:
+        """Позиции строк с нераспознанной датой доставки (не участвуют в сортировке)"""
+        return np.flatnonzero(np.isnat(self._ts))
+
+    def positions_before(self, end: datetime) -> np.ndarray:
+        """Позиции строк с распознанной датой доставки раньше end"""
+        return self._valid_pos[self._valid_ts < np.datetime64(end, 'ns')]
+
+    def window_positions(self, start: datetime, end: datetime) -> np.ndarray:
+        """Позиции строк с распознанной датой доставки в интервале [start, end)"""
+        start_ts, end_ts = np.datetime64(start, 'ns'), np.datetime64(end, 'ns')
+        if self.is_sorted:
+            first = int(np.searchsorted(self._valid_ts, start_ts, side='left'))
+            last = int(np.searchsorted(self._valid_ts, end_ts, side='left'))
+            return self._valid_pos[first:last]
+        return np.flatnonzero((self._ts >= start_ts) & (self._ts < end_ts))
+
+    def insertion_position(self, new_dt: datetime) -> int:
+        """Позиция перед первой строкой с датой не раньше new_dt (как в прежнем линейном поиске)"""
+        target = np.datetime64(new_dt, 'ns')
+        if self.is_sorted:
+            k = int(np.searchsorted(self._valid_ts, target, side='left'))
+        else:
+            later = self._valid_ts >= target
+            k = int(np.argmax(later)) if later.any() else len(self._valid_ts)
+        return int(self._valid_pos[k]) if k < len(self._valid_pos) else len(self._ts)
+
+
+def plan_sorted_inserts(date_index: DeliveryDateIndex, delivery_dates: List[Any]) -> List[Tuple[int, List[int]]]:
+    """Места вставки новых строк в отсортированный по дате лист: [(позиция, [номера новых строк])].
+
+    Позиция - число существующих строк выше, по возрастанию. Новые строки с одним
+    местом идут пачкой по дате, при равной дате более поздняя - выше, как при
+    поочерёдной вставке.
+    """
+    groups: Dict[int, List[Tuple[datetime, int, int]]] = {}
+    for seq, value in enumerate(delivery_dates):
+        new_dt = parse_sheet_datetime(value)
+        boundary = date_index.insertion_position(new_dt) if new_dt else 0
+        groups.setdefault(boundary, []).append((new_dt or datetime.min, -seq, seq))
+    return [(boundary, [seq for _, _, seq in sorted(groups[boundary])]) for boundary in sorted(groups)]
+
+
+def planned_positions(plan: List[Tuple[int, List[int]]]) -> Dict[int, int]:
+    """Итоговые позиции новых строк (номер строки -> позиция) после вставки по плану"""
+    positions, inserted_above = {}, 0
+    for boundary, group in plan:
+        for offset, seq in enumerate(group):
+            positions[seq] = boundary + inserted_above + offset
+        inserted_above += len(group)
+    return positions
+
+
+class OrderNumberIndex:
+    """Хэш-индекс НОМЕР_ЗАЯВКИ -> идентификаторы строк таблицы.
+
+    Хранит стабильные идентификаторы строк (индекс OrdersTable), поэтому вставки
+    выше не требуют пересчёта: позиция строки и номер строки листа вычисляются
+    по идентификатору в момент запроса. При дублях номера берётся последняя строка.
+    """
+
+    def __init__(self):
+        self.version = -1
+        self._rows: Dict[str, List[int]] = {}
+        self._lock = threading.Lock()
+
+    def sync(self, table: OrdersTable) -> 'OrderNumberIndex':
+        with self._lock:
+            if self.version == table.version:
+                return self
+            changes = table.changes_since(self.version)
+            if changes is None:
+                self._rows = {}
+                for number, row_id in zip(table.df['НОМЕР_ЗАЯВКИ'].astype(str), table.df.index):
+                    self._rows.setdefault(number, []).append(int(row_id))
+            else:
+                for change in changes:
+                    if change.old is not None:
+                        ids = self._rows.get(str(change.old['НОМЕР_ЗАЯВКИ']), [])
+                        if change.row_id in ids:
+                            ids.remove(change.row_id)
+                    if change.new is not None:
+                        self._rows.setdefault(str(change.new['НОМЕР_ЗАЯВКИ']), []).append(change.row_id)
+            self.version = table.version
+            return self
+
+    def position_of(self, order_number: str, table: OrdersTable) -> int:
+        """Позиция последней строки с номером order_number или -1"""
+        ids = self._rows.get(str(order_number).strip())
+        if not ids:
+            return -1
+        return max(table.df.index.get_loc(row_id) for row_id in ids)
+
+    def contains(self, order_number: str) -> bool:
+        return bool(self._rows.get(str(order_number).strip()))
+
+    def max_number(self) -> Optional[int]:
+        """Наибольший числовой номер заявки"""
+        numbers = [int(n) for n, ids in self._rows.items() if ids and n.isdigit()]
+        return max(numbers) if numbers else None
+
+
+class OrderSearchIndex:
+    """Триграммный индекс для поиска подстроки в НОМЕР_ЗАЯВКИ, ТЕЛЕФОН и АДРЕС.
+
+    Для каждой строки хранит нормализованные поля (номер и адрес - casefold,
+    телефон - цифры с заменой ведущей 8 на 7, как в is_valid_phone) и списки
+    идентификаторов строк по триграммам. Кандидаты - пересечение списков триграмм
+    запроса, затем точная проверка подстроки; запросы короче трёх символов
+    проверяются перебором. Догоняет таблицу по журналу изменений.
+    """
+
+    GRAM = 3
+
+    def __init__(self):
+        self.version = -1
+        self._fields: Dict[int, Tuple[str, str, str]] = {}
+        self._postings: Dict[str, set] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize_text(value: Any) -> str:
+        return str(value).strip().casefold()
+
+    @staticmethod
+    def normalize_phone(value: Any) -> str:
+        digits = re.sub(r'\D', '', str(value))
+        if digits.startswith('8') and len(digits) == 11:
+            digits = '7' + digits[1:]
+        return digits
+
+    @classmethod
+    def _grams(cls, text: str) -> set:
+        return {text[i:i + cls.GRAM] for i in range(len(text) - cls.GRAM + 1)}
+
+    def _row_fields(self, record: Dict[str, Any]) -> Tuple[str, str, str]:
+        return (self.normalize_text(record.get('НОМЕР_ЗАЯВКИ', "")),
+                self.normalize_phone(record.get('ТЕЛЕФОН', "")),
+                self.normalize_text(record.get('АДРЕС', "")))
+
+    def _add(self, row_id: int, record: Dict[str, Any]):
+        fields = self._row_fields(record)
+        self._fields[row_id] = fields
+        for gram in set().union(*(self._grams(f) for f in fields)):
+            self._postings.setdefault(gram, set()).add(row_id)
+
+    def _remove(self, row_id: int):
+        fields = self._fields.pop(row_id, None)
+        if fields is None:
+            return
+        for gram in set().union(*(self._grams(f) for f in fields)):
+            ids = self._postings.get(gram)
+            if ids is not None:
+                ids.discard(row_id)
+                if not ids:
+                    del self._postings[gram]
+
+    def sync(self, table: OrdersTable) -> 'OrderSearchIndex':
+        with self._lock:
+            if self.version == table.version:
+                return self
+            changes = table.changes_since(self.version)
+            if changes is None:
+                self._rebuild(table.df)
+            else:
+                for change in changes:
+                    self._remove(change.row_id)
+                    if change.new is not None:
+                        self._add(change.row_id, change.new)
+            self.version = table.version
+            return self
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> 'OrderSearchIndex':
+        """Индекс по готовой выборке заявок (без привязки к таблице заявок)"""
+        index = cls()
+        index._rebuild(df)
+        return index
+
+    def _rebuild(self, df: pd.DataFrame):
+        self._fields, self._postings = {}, {}
+        for row_id, number, phone, address in zip(df.index, df['НОМЕР_ЗАЯВКИ'], df['ТЕЛЕФОН'], df['АДРЕС']):
+            self._add(int(row_id), {'НОМЕР_ЗАЯВКИ': number, 'ТЕЛЕФОН': phone, 'АДРЕС': address})
+
+    def _candidates(self, needles: List[str]) -> Optional[set]:
+        """Объединение кандидатов по всем вариантам запроса; None - нужен полный перебор"""
+        result = set()
+        for needle in needles:
+            if len(needle) < self.GRAM:
+                return None
+            ids = None
+            for gram in sorted(self._grams(needle), key=lambda g: len(self._postings.get(g, ()))):
+                ids = set(self._postings.get(gram, ())) if ids is None else ids & self._postings.get(gram, set())
+                if not ids:
+                    break
+            result |= ids or set()
+        return result
+
+    @staticmethod
+    def _phone_needles(text: str) -> List[str]:
+        # Цифровой запрос (с пробелами, скобками, +, -) ищется и среди нормализованных телефонов
+        digits = re.sub(r'\D', '', text) if re.fullmatch(r'[\d\s()+\-]+', text) else ""
+        if not digits:
+            return []
+        return [digits, '7' + digits[1:]] if digits.startswith('8') else [digits]
+
+    @classmethod
+    def match_frame(cls, df: pd.DataFrame, query: str) -> pd.Series:
+        """Маска строк df, подходящих под запрос, - та же проверка, что в search(), без индекса"""
+        text = cls.normalize_text(query)
+        if not text:
+            return pd.Series(True, index=df.index)
+        mask = (df['НОМЕР_ЗАЯВКИ'].astype(str).str.strip().str.casefold().str.contains(text, regex=False)
+                | df['АДРЕС'].astype(str).str.strip().str.casefold().str.contains(text, regex=False))
+        needles = cls._phone_needles(text)
+        if needles:
+            phones = df['ТЕЛЕФОН'].astype(str).str.replace(r'\D', '', regex=True)
+            phones = phones.mask(phones.str.startswith('8') & (phones.str.len() == 11), '7' + phones.str[1:])
+            for needle in needles:
+                mask |= phones.str.contains(needle, regex=False)
+        return mask
+
+    def search(self, query: str) -> List[int]:
+        """Идентификаторы строк, где запрос входит в номер, телефон или адрес"""
+        text = self.normalize_text(query)
+        phone_needles = self._phone_needles(text)
+        with self._lock:
+            if not text:
+                return list(self._fields)
+            candidates = self._candidates([text] + phone_needles)
+            rows = self._fields.keys() if candidates is None else candidates
+            return [row_id for row_id in rows
+                    if text in self._fields[row_id][0] or text in self._fields[row_id][2]
+                    or any(needle in self._fields[row_id][1] for needle in phone_needles)]
+
+
+class OrderRollups:
+    """Сводки для вкладки аналитики: выручка и заявки по дню доставки, заявки по
+    слоту доставки (шаг TIME_STEP_SECONDS) и количество/выручка по позициям.
+
+    Догоняет таблицу по журналу изменений: вставка добавляет вклад строки,
+    перезапись вычитает вклад старой версии и добавляет вклад новой. Размер сводок
+    зависит от числа дней, слотов и наименований, а не от числа заявок.
+    """
+
+    def __init__(self):
+        self.version = -1
+        self.by_day: Dict[date, List[float]] = {}  # день -> [выручка, заявок]
+        self.by_slot: Dict[int, int] = {}  # секунды от начала дня -> заявок
+        self.by_item: Dict[str, List[float]] = {}  # наименование -> [количество, выручка, строк]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _total(value: Any) -> float:
+        if isinstance(value, (int, float)):
+            return 0.0 if pd.isna(value) else float(value)
+        return parse_item_price(str(value))
+
+    @staticmethod
+    def _bump(totals: Dict[Any, List[float]], key: Any, deltas: List[float]):
+        entry = totals.setdefault(key, [0] * len(deltas))
+        for i, delta in enumerate(deltas):
+            entry[i] += delta
+        # Последний счётчик - число вкладов: на нуле ключ больше ничего не содержит
+        if entry[-1] == 0:
+            del totals[key]
+
+    def _apply(self, record: Dict[str, Any], sign: int):
+        dt = parse_sheet_datetime(record.get('ДАТА_ДОСТАВКИ', ""))
+        if dt:
+            self._bump(self.by_day, dt.date(), [sign * self._total(record.get('СУММА', 0)), sign])
+            slot = delivery_slot(dt)
+            self.by_slot[slot] = self.by_slot.get(slot, 0) + sign
+            if not self.by_slot[slot]:
+                del self.by_slot[slot]
+        for item in parse_order_text_to_items(str(record.get('ЗАКАЗ', ""))):
+            self._bump(self.by_item, item['НАИМЕНОВАНИЕ'], [sign * item['КОЛИЧЕСТВО'], sign * item['СУММА'], sign])
+
+    def sync(self, table: OrdersTable) -> 'OrderRollups':
+        with self._lock:
+            if self.version == table.version:
+                return self
+            changes = table.changes_since(self.version)
+            if changes is None:
+                self._rebuild(table.df)
+            else:
+                for change in changes:
+                    if change.old is not None:
+                        self._apply(change.old, -1)
+                    if change.new is not None:
+                        self._apply(change.new, 1)
+            self.version = table.version
+            return self
+
+    def _rebuild(self, df: pd.DataFrame):
+        self.by_day, self.by_slot, self.by_item = {}, {}, {}
+        if df.empty:
+            return
+        ts = pd.Series(parse_sheet_datetimes(df['ДАТА_ДОСТАВКИ']))
+        totals = pd.Series([self._total(v) for v in df['СУММА']])
+        valid = ts.notna()
+        days = pd.DataFrame({'day': ts[valid].dt.date, 'total': totals[valid]}).groupby('day')['total']
+        self.by_day = {day: [float(total), int(count)]
+                       for day, total, count in zip(days.sum().index, days.sum(), days.count())}
+        seconds = ts[valid].dt.hour * 3600 + ts[valid].dt.minute * 60 + ts[valid].dt.second
+        self.by_slot = {int(slot): int(count)
+                        for slot, count in (seconds // TIME_STEP_SECONDS * TIME_STEP_SECONDS).value_counts().items()}
+        items = parse_order_items_frame(df)
+        if len(items):
+            grouped = items.assign(СУММА=items['КОЛИЧЕСТВО'] * items['ЦЕНА_ЗА_ЕД']).groupby('НАИМЕНОВАНИЕ')
+            stats = grouped.agg(qty=('КОЛИЧЕСТВО', 'sum'), revenue=('СУММА', 'sum'), lines=('СУММА', 'size'))
+            self.by_item = {name: [int(qty), float(revenue), int(lines)]
+                            for name, qty, revenue, lines in stats.itertuples()}
+
+    def daily_frame(self) -> pd.DataFrame:
+        """Выручка и число заявок по дням доставки"""
+        with self._lock:
+            rows = [(day, revenue, count) for day, (revenue, count) in sorted(self.by_day.items())]
+        return pd.DataFrame(rows, columns=['ДЕНЬ', 'ВЫРУЧКА', 'ЗАЯВОК']).set_index('ДЕНЬ')
+
+    def weekly_frame(self) -> pd.DataFrame:
+        """Выручка и число заявок по неделям доставки (НЕДЕЛЯ - понедельник), из сводки по дням"""
+        with self._lock:
+            weeks: Dict[date, List[float]] = {}
+            for day, (revenue, count) in self.by_day.items():
+                week = weeks.setdefault(day - timedelta(days=day.weekday()), [0.0, 0])
+                week[0] += revenue
+                week[1] += count
+        rows = [(week, revenue, count) for week, (revenue, count) in sorted(weeks.items())]
+        return pd.DataFrame(rows, columns=['НЕДЕЛЯ', 'ВЫРУЧКА', 'ЗАЯВОК']).set_index('НЕДЕЛЯ')
+
+    def slot_frame(self) -> pd.DataFrame:
+        """Число заявок по слотам доставки (ЧЧ:ММ)"""
+        with self._lock:
+            rows = [(slot_label(slot), count) for slot, count in sorted(self.by_slot.items())]
+        return pd.DataFrame(rows, columns=['СЛОТ', 'ЗАЯВОК']).set_index('СЛОТ')
+
+    def top_items(self, limit: int) -> pd.DataFrame:
+        """Позиции с наибольшим количеством"""
+        with self._lock:
+            rows = [(name, qty, revenue) for name, (qty, revenue, _) in self.by_item.items()]
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return pd.DataFrame(rows[:limit], columns=['НАИМЕНОВАНИЕ', 'КОЛИЧЕСТВО', 'ВЫРУЧКА'])
+
+
+class SlotOccupancyIndex:
+    """Число заявок в каждом слоте доставки: день -> {начало слота -> заявок}.
+
+    Строится по ДАТА_ДОСТАВКИ и догоняет таблицу по журналу изменений (перезапись
+    переносит заявку из старого слота в новый), count() - два обращения к словарю.
+    """
+
+    def __init__(self):
+        self.version = -1
+        self._days: Dict[date, Dict[int, int]] = {}
+        self._lock = threading.Lock()
+
+    def _apply(self, record: Dict[str, Any], sign: int):
+        dt = parse_sheet_datetime(record.get('ДАТА_ДОСТАВКИ', ""))
+        if not dt:
+            return
+        slots = self._days.setdefault(dt.date(), {})
+        slot = delivery_slot(dt)
+        slots[slot] = slots.get(slot, 0) + sign
+        if not slots[slot]:
+            del slots[slot]
+            if not slots:
+                del self._days[dt.date()]
+
+    def sync(self, table: OrdersTable) -> 'SlotOccupancyIndex':
+        with self._lock:
+            if self.version == table.version:
+                return self
+            changes = table.changes_since(self.version)
+            if changes is None:
+                self._rebuild(table.df)
+            else:
+                for change in changes:
+                    if change.old is not None:
+                        self._apply(change.old, -1)
+                    if change.new is not None:
+                        self._apply(change.new, 1)
+            self.version = table.version
+            return self
+
+    def _rebuild(self, df: pd.DataFrame):
+        self._days = {}
+        if df.empty:
+            return
+        ts = pd.Series(parse_sheet_datetimes(df['ДАТА_ДОСТАВКИ'])).dropna()
+        seconds = ts.dt.hour * 3600 + ts.dt.minute * 60 + ts.dt.second
+        counts = pd.DataFrame({'day': ts.dt.date, 'slot': seconds // TIME_STEP_SECONDS * TIME_STEP_SECONDS})
+        for (day, slot), count in counts.value_counts().items():
+            self._days.setdefault(day, {})[int(slot)] = int(count)
+
+    def count(self, dt: datetime) -> int:
+        """Заявок в слоте, в который попадает dt"""
+        with self._lock:
+            return self._days.get(dt.date(), {}).get(delivery_slot(dt), 0)
+
+    def full_slots(self, day: date, capacity: int) -> List[int]:
+        """Слоты дня, где заявок не меньше capacity"""
+        with self._lock:
+            return sorted(slot for slot, count in self._days.get(day, {}).items() if count >= capacity)
+
+
+class CustomerProfile(NamedTuple):
+    """История клиента по нормализованному телефону"""
+    phone: str
+    order_count: int
+    orders: List[Dict[str, Any]]  # последние заявки, по дате доставки от новых
+    addresses: List[str]  # известные адреса, частые первыми
+    items: List[Tuple[str, int]]  # частые позиции и число строк заказов с ними
+
+
+class CustomerIndex:
+    """Клиенты по телефону в форме is_valid_phone: их заявки, адреса и позиции.
+
+    Догоняет таблицу по журналу изменений: перезапись снимает старую версию строки
+    с прежнего телефона (со счётчиками адресов и позиций) и добавляет новую.
+    lookup() работает только с историей одного клиента.
+    """
+
+    FIELDS = ['НОМЕР_ЗАЯВКИ', 'АДРЕС', 'ДАТА_ДОСТАВКИ', 'КОММЕНТАРИЙ', 'ЗАКАЗ', 'СУММА', REVISION_HEADER]
+    NO_DATE = np.iinfo(np.int64).min  # заявки без распознанной даты - самые старые
+
+    def __init__(self):
+        self.version = -1
+        self._row_phone: Dict[int, str] = {}
+        self._customers: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _sort_key(cls, value: Any) -> int:
+        dt = parse_sheet_datetime(value)
+        return int(np.datetime64(dt, 'ns').astype(np.int64)) if dt else cls.NO_DATE
+
+    @staticmethod
+    def _count(counter: Dict[str, int], key: str, delta: int):
+        if not key:
+            return
+        counter[key] = counter.get(key, 0) + delta
+        if counter[key] <= 0:
+            del counter[key]
+
+    @staticmethod
+    def _item_names(order_text: Any) -> List[str]:
+        # Тот же разбор, что при перестроении (parse_order_items_frame), иначе счётчики
+        # позиций, собранные по журналу, разойдутся с перестроенными
+        texts = pd.DataFrame({'НОМЕР_ЗАЯВКИ': [""], 'ЗАКАЗ': [str(order_text)]})
+        return parse_order_items_frame(texts)['НАИМЕНОВАНИЕ'].tolist()
+
+    def _add(self, row_id: int, phone: str, record: Dict[str, Any], sort_key: int, item_names: List[str]):
+        customer = self._customers.setdefault(phone, {'orders': {}, 'addresses': {}, 'items': {}})
+        summary = {field: record.get(field, "") for field in self.FIELDS}
+        summary['_sort'] = (sort_key, row_id)
+        # Снимаются при удалении ровно те наименования, что были учтены
+        summary['_items'] = item_names
+        customer['orders'][row_id] = summary
+        self._count(customer['addresses'], str(summary['АДРЕС']).strip(), 1)
+        for name in item_names:
+            self._count(customer['items'], name, 1)
+        self._row_phone[row_id] = phone
+
+    def _remove(self, row_id: int):
+        phone = self._row_phone.pop(row_id, None)
+        if phone is None:
+            return
+        customer = self._customers[phone]
+        summary = customer['orders'].pop(row_id)
+        self._count(customer['addresses'], str(summary['АДРЕС']).strip(), -1)
+        for name in summary['_items']:
+            self._count(customer['items'], name, -1)
+        if not customer['orders']:
+            del self._customers[phone]
+
+    def sync(self, table: OrdersTable) -> 'CustomerIndex':
+        with self._lock:
+            if self.version == table.version:
+                return self
+            changes = table.changes_since(self.version)
+            if changes is None:
+                self._rebuild(table.df)
+            else:
+                for change in changes:
+                    self._remove(change.row_id)
+                    if change.new is None:
+                        continue
+                    phone = is_valid_phone(str(change.new.get('ТЕЛЕФОН', "")))
+                    if phone:
+                        self._add(change.row_id, phone, change.new, self._sort_key(change.new.get('ДАТА_ДОСТАВКИ')),
+                                  self._item_names(change.new.get('ЗАКАЗ', "")))
+            self.version = table.version
+            return self
+
+    def _rebuild(self, df: pd.DataFrame):
+        self._row_phone, self._customers = {}, {}
+        if df.empty:
+            return
+        phones = df['ТЕЛЕФОН'].astype(str).map(is_valid_phone).to_numpy()
+        sort_keys = parse_sheet_datetimes(df['ДАТА_ДОСТАВКИ']).astype(np.int64)
+        records = df.reindex(columns=self.FIELDS, fill_value="").to_dict('records')
+        # Наименования позиций - одним векторным разбором ЗАКАЗ, по позиции строки
+        items = parse_order_items_frame(df)
+        item_names: Dict[int, List[str]] = {}
+        for position, name in zip(items.index, items['НАИМЕНОВАНИЕ']):
+            item_names.setdefault(int(position), []).append(name)
+        for position, (row_id, phone, sort_key, record) in enumerate(zip(df.index, phones, sort_keys, records)):
+            if phone:
+                self._add(int(row_id), phone, record, int(sort_key), item_names.get(position, []))
+
+    def lookup(self, phone: str, limit: int = CUSTOMER_RECENT_ORDERS) -> Optional[CustomerProfile]:
+        with self._lock:
+            customer = self._customers.get(phone)
+            if not customer:
+                return None
+            orders = heapq.nlargest(limit, customer['orders'].values(), key=lambda summary: summary['_sort'])
+            addresses = sorted(customer['addresses'], key=customer['addresses'].get, reverse=True)
+            items = heapq.nlargest(CUSTOMER_TOP_ITEMS, customer['items'].items(), key=lambda pair: pair[1])
+            return CustomerProfile(
+                phone, len(customer['orders']),
+                [{k: v for k, v in summary.items() if not k.startswith('_')} for summary in orders],
+                addresses, items
+            )
+
+
+class OrderTextIndex:
+    """Инвертированный индекс слов из ЗАКАЗ (наименования и комментарии позиций) и КОММЕНТАРИЙ.
+
+    Слова приводятся к нижнему регистру через casefold, ё заменяется на е. Слово
+    запроса - префикс (так "домофон" находит и "домофона"); заявка должна содержать
+    все слова запроса. Префиксы ищутся бинарным поиском по отсортированному словарю.
+    Догоняет таблицу по журналу изменений, снимая слова старой версии строки.
+    """
+
+    TOKEN_PATTERN = re.compile(r'\w+')
+
+    def __init__(self):
+        self.version = -1
+        self._row_tokens: Dict[int, frozenset] = {}
+        self._postings: Dict[str, set] = {}
+        self._vocabulary: List[str] = []  # отсортированные ключи _postings
+        self._lock = threading.Lock()
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        return cls.TOKEN_PATTERN.findall(text.casefold().replace('ё', 'е'))
+
+    @classmethod
+    def _document_tokens(cls, order_text: Any, comment: Any) -> frozenset:
+        # Из строк позиций - наименование и комментарий, без количества и цены
+        parts = [str(comment)]
+        for line in str(order_text).split('\n'):
+            match = ORDER_ITEM_PATTERN.search(line.strip())
+            parts += [match.group(1), match.group(4) or ""] if match else [line]
+        return frozenset(cls.tokenize(" ".join(parts)))
+
+    def _add(self, row_id: int, tokens: frozenset):
+        self._row_tokens[row_id] = tokens
+        for token in tokens:
+            ids = self._postings.get(token)
+            if ids is None:
+                ids = self._postings[token] = set()
+                bisect.insort(self._vocabulary, token)
+            ids.add(row_id)
+
+    def _remove(self, row_id: int):
+        for token in self._row_tokens.pop(row_id, ()):
+            ids = self._postings[token]
+            ids.discard(row_id)
+            if not ids:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+
+    def sync(self, table: OrdersTable) -> 'OrderTextIndex':
+        with self._lock:
+            if self.version == table.version:
+                return self
+            changes = table.changes_since(self.version)
+            if changes is None:
+                self._rebuild(table.df)
+            else:
+                for change in changes:
+                    self._remove(change.row_id)
+                    if change.new is not None:
+                        self._add(change.row_id, self._document_tokens(change.new.get('ЗАКАЗ', ""),
+                                                                       change.new.get('КОММЕНТАРИЙ', "")))
+            self.version = table.version
+            return self
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> 'OrderTextIndex':
+        """Индекс по готовой выборке заявок (без привязки к таблице заявок)"""
+        index = cls()
+        index._rebuild(df)
+        return index
+
+    def _rebuild(self, df: pd.DataFrame):
+        self._row_tokens, self._postings = {}, {}
+        if len(df):
+            for row_id, order_text, comment in zip(df.index, df['ЗАКАЗ'], df['КОММЕНТАРИЙ']):
+                tokens = self._document_tokens(order_text, comment)
+                self._row_tokens[row_id] = tokens
+                for token in tokens:
+                    self._postings.setdefault(token, set()).add(row_id)
+        self._vocabulary = sorted(self._postings)
+
+    def _prefix_ids(self, prefix: str) -> set:
+        ids = set()
+        for i in range(bisect.bisect_left(self._vocabulary, prefix), len(self._vocabulary)):
+            if not self._vocabulary[i].startswith(prefix):
+                break
+            ids |= self._postings[self._vocabulary[i]]
+        return ids
+
+    def search(self, query: str) -> List[int]:
+        """Идентификаторы строк, где есть слова, начинающиеся с каждого слова запроса"""
+        tokens = self.tokenize(query)
+        with self._lock:
+            if not tokens:
+                return list(self._row_tokens)
+            matched = None
+            # Длинные слова запроса обычно редче - с них пересечение быстрее сужается
+            for token in sorted(set(tokens), key=len, reverse=True):
+                ids = self._prefix_ids(token)
+                matched = ids if matched is None else matched & ids
+                if not matched:
+                    return []
+            return list(matched)
+
+
+# Методы хранилища, замеряемые трассировкой как участки storage.<хранилище>.<метод>
+TRACED_STORAGE_METHODS = (
+    'load_orders', 'load_orders_window', 'append_order', 'append_orders', 'update_order', 'find_order',
+    'order_position', 'used_order_numbers',
+    'delivery_index', 'search_orders', 'search_order_text', 'order_rollups', 'slot_occupancy', 'customer_profile',
+    'load_order_items', 'order_items_frame', 'backfill_order_items',
+    'load_prices', 'price_revision', 'resync', 'archive_orders', 'reserve_number_block', 'initial_order_number',
+)
+
+
+def trace_storage_methods(cls):
+    """Оборачивает методы TRACED_STORAGE_METHODS класса cls (и унаследованные) в участки трассировки.
+
+    Уже обёрнутый в базовом классе метод повторно не оборачивается.
+    """
+    def traced(method_name, fn):
+        @functools.wraps(fn)
+        def call(self, *args, **kwargs):
+            with tracer.span(f"storage.{self.name}.{method_name}"):
+                return fn(self, *args, **kwargs)
+        call.traced = True
+        return call
+    for method_name in TRACED_STORAGE_METHODS:
+        fn = getattr(cls, method_name, None)
+        if fn is not None and not getattr(fn, 'traced', False):
+            setattr(cls, method_name, traced(method_name, fn))
+    return cls
+
+
+class OrderStorage:
+    """Общий интерфейс хранилища заявок и прайса.
+
+    Позиция строки - индекс среди строк данных (0 - первая строка после заголовка),
+    строки упорядочены по ДАТА_ДОСТАВКИ так же, как в листе ЗАЯВКИ. Загруженные
+    заявки живут в self.table, записи сразу дописываются в неё (write-through).
+    """
+
+    name = "base"
+    columns = EXPECTED_HEADERS
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        trace_storage_methods(cls)
+
+    def __init__(self):
+        self.table = OrdersTable(self.columns)
+        self.date_index = DeliveryDateIndex()
+        self.number_index = OrderNumberIndex()
+        self.search_index = OrderSearchIndex()
+        self.rollups = OrderRollups()
+        self.slot_index = SlotOccupancyIndex()
+        self.customer_index = CustomerIndex()
+        self.text_index = OrderTextIndex()
+
+    def delivery_index(self) -> DeliveryDateIndex:
+        """Индекс дат доставки, актуальный для текущей версии таблицы"""
+        self.load_orders()
+        return self.date_index.sync(self.table)
+
+    def order_position(self, order_number: str) -> int:
+        """Позиция последней заявки с номером order_number в таблице или -1"""
+        self.load_orders()
+        return self.number_index.sync(self.table).position_of(order_number, self.table)
+
+    def used_order_numbers(self, order_numbers: Iterable[str]) -> set:
+        """Номера из order_numbers, занятые заявками локальной копии (без внеочередной проверки источника)"""
+        self.load_orders()
+        index = self.number_index.sync(self.table)
+        return {number for number in order_numbers if index.contains(number)}
+
+    def search_orders(self, query: str) -> List[int]:
+        """Идентификаторы строк таблицы (индекс table.df), подходящих под поисковый запрос"""
+        self.load_orders()
+        return self.search_index.sync(self.table).search(query)
+
+    def search_order_text(self, query: str) -> List[int]:
+        """Идентификаторы строк таблицы, где состав заказа или комментарии содержат слова запроса"""
+        self.load_orders()
+        return self.text_index.sync(self.table).search(query)
+
+    def order_rollups(self) -> OrderRollups:
+        """Сводки для аналитики, актуальные для текущей версии таблицы"""
+        self.load_orders()
+        return self.rollups.sync(self.table)
+
+    def slot_occupancy(self, fresh: bool = True) -> SlotOccupancyIndex:
+        """Загрузка слотов доставки, актуальная для текущей версии таблицы.
+
+        fresh=False - по уже загруженной копии без сверки с источником (её догоняет
+        фоновая синхронизация и любое чтение списка заявок).
+        """
+        if fresh or not self.table.loaded:
+            self.load_orders()
+        return self.slot_index.sync(self.table)
+
+    def customer_profile(self, phone: str) -> Optional[CustomerProfile]:
+        """История клиента с телефоном phone (в форме is_valid_phone) или None"""
+        self.load_orders()
+        return self.customer_index.sync(self.table).lookup(phone)
+
+    def load_orders(self) -> pd.DataFrame:
+        """Возвращает все заявки в порядке хранения"""
+        raise NotImplementedError
+
+    def load_orders_window(self, start: datetime, end: datetime) -> Tuple[pd.DataFrame, Optional[int]]:
+        """Заявки с датой доставки в [start, end) в порядке хранения и версия таблицы.
+
+        Пока таблица не загружена, окно читается из источника напрямую, без
+        загрузки всех заявок; тогда версия - None, а индекс выборки не совпадает
+        с идентификаторами строк таблицы.
+        """
+        if not self.table.loaded:
+            frame = self._fetch_orders_window(start, end)
+            if frame is not None:
+                return frame, None
+        date_index = self.delivery_index()
+        df = self.table.df
+        return df.iloc[date_index.window_positions(start, end)], date_index.version
+
+    def _fetch_orders_window(self, start: datetime, end: datetime) -> Optional[pd.DataFrame]:
+        """Чтение окна из источника в обход таблицы; None - не поддерживается"""
+        return None
+
+    def iter_orders(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                    chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+        """Заявки (все или с доставкой в [start, end)) в порядке хранения, кусками по chunk_rows строк.
+
+        Хранилище может читать куски из источника в обход таблицы; тогда их индекс
+        не совпадает с идентификаторами строк таблицы.
+        """
+        return self.iter_loaded_orders(start, end, chunk_rows)
+
+    def iter_loaded_orders(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                           chunk_rows: int = EXPORT_CHUNK_ROWS,
+                           row_ids: Optional[List[int]] = None) -> Iterator[pd.DataFrame]:
+        """Куски загруженной таблицы (индекс - идентификаторы строк); row_ids - только эти строки"""
+        df = self.load_orders()
+        positions = self.delivery_index().window_positions(start, end) if start else np.arange(len(df))
+        if row_ids is not None:
+            positions = positions[df.index.isin(row_ids)[positions]]
+        for first in range(0, len(positions), chunk_rows):
+            yield df.iloc[positions[first:first + chunk_rows]]
+
+    def append_order(self, data_row: List[Any], items: Optional[List[Dict[str, Any]]] = None) -> int:
+        """Добавляет заявку (и её позиции, если переданы) с сохранением сортировки по дате доставки.
+
+        Возвращает позицию заявки.
+        """
+        raise NotImplementedError
+
+    def append_orders(self, data_rows: List[List[Any]],
+                      items_list: Optional[List[List[Dict[str, Any]]]] = None) -> List[int]:
+        """Добавляет пачку заявок (импорт) минимальным числом записей, возвращает их позиции"""
+        items_list = items_list or [None] * len(data_rows)
+        return [self.append_order(data_row, items) for data_row, items in zip(data_rows, items_list)]
+
+    def update_order(self, order_number: str, data_row: List[Any],
+                     items: Optional[List[Dict[str, Any]]] = None) -> int:
+        """Перезаписывает последнюю заявку с указанным номером (и её позиции).
+
+        Возвращает позицию, ARCHIVED_ORDER_POSITION для заявки из архива или -1.
+        """
+        raise NotImplementedError
+
+    def load_order_items(self, order: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+        """Сохранённые позиции заявки (запись из find_order); None - позиции не сохранялись"""
+        return None
+
+    def _stored_items_frame(self, orders: pd.DataFrame) -> pd.DataFrame:
+        """Сохранённые позиции текущих версий заявок orders (столбцы ORDER_ITEM_COLUMNS)"""
+        return pd.DataFrame(columns=ORDER_ITEM_COLUMNS)
+
+    def _write_backfill_items(self, orders: pd.DataFrame, items: pd.DataFrame):
+        raise NotImplementedError
+
+    def _split_items(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        orders = self.load_orders()
+        stored = self._stored_items_frame(orders)
+        legacy = orders[~orders['НОМЕР_ЗАЯВКИ'].astype(str).isin(stored['НОМЕР_ЗАЯВКИ'].astype(str))]
+        return stored, legacy
+
+    def order_items_frame(self) -> pd.DataFrame:
+        """Позиции всех заявок: сохранённые построчно, для старых заявок - разобранные из ЗАКАЗ"""
+        stored, legacy = self._split_items()
+        parsed = parse_order_items_frame(legacy)
+        return pd.concat([stored, parsed], ignore_index=True) if len(parsed) else stored
+
+    def backfill_order_items(self) -> int:
+        """Сохраняет позиции заявок, у которых есть только текст ЗАКАЗ; возвращает число заявок"""
+        _, legacy = self._split_items()
+        parsed = parse_order_items_frame(legacy)
+        if parsed.empty:
+            return 0
+        self._write_backfill_items(legacy, parsed)
+        return parsed['НОМЕР_ЗАЯВКИ'].nunique()
+
+    def find_order(self, order_number: str) -> Optional[Dict[str, Any]]:
+        """Возвращает последнюю заявку с указанным номером или None"""
+        position = self.order_position(order_number)
+        if position == -1:
+            return None
+        return self.table.df.iloc[position].to_dict()
+
+    def load_prices(self) -> pd.DataFrame:
+        """Возвращает прайс (столбцы НАИМЕНОВАНИЕ и ЦЕНА, если есть - АРТИКУЛ)"""
+        raise NotImplementedError
+
+    def price_revision(self) -> Optional[str]:
+        """Дешёвая метка версии прайса (меняется при любой правке); None - не поддерживается"""
+        return None
+
+    def resync(self):
+        """Принудительно перечитывает данные из источника (если хранилище кэширует)"""
+
+    def archive_orders(self, cutoff: datetime) -> int:
+        """Переносит заявки с доставкой раньше cutoff в архив, возвращает их число.
+
+        find_order и update_order находят перенесённые заявки через индекс архива.
+        """
+        raise NotImplementedError
+
+    def reserve_number_block(self, size: int) -> int:
+        """Атомарно резервирует подряд не меньше size номеров заявок, возвращает первый из них.
+
+        Блоки не пересекаются между процессами и репликами, использующими одно хранилище.
+        """
+        raise NotImplementedError
+
+    def initial_order_number(self) -> int:
+        """Начальное значение счётчика: следующий после наибольшего существующего номера"""
+        self.load_orders()
+        max_number = self.number_index.sync(self.table).max_number()
+        return max(max_number + 1, ORDER_NUMBER_START) if max_number is not None else ORDER_NUMBER_START
+
+
+
+def new_revision() -> str:
+    """Метка изменения строки для столбца РЕВИЗИЯ (миллисекунды, строкой)"""
+    return str(time_module.time_ns() // 1_000_000)
+
+
+class ArrowSnapshot:
+    """Таблица в файле Arrow на локальном диске, общая для процессов и перезапусков.
+
+    Для заявок это копия листа ЗАЯВКИ: процесс, изменивший свою копию (запись
+    заявки, проверка листа), атомарно перезаписывает файл; остальные сравнивают
+    его метку (inode, размер, mtime) одним stat() и перечитывают файл через
+    memory_map только при её смене. Публикация и проверка листа идут под
+    блокировкой файла .lock, время изменения которого - время последней проверки
+    листа любым из процессов. Строковые метаданные (источник, ревизия) хранятся
+    в схеме файла.
+    """
+
+    MIXED_COLUMNS_KEY = b'crm.mixed_columns'
+    METADATA_KEY = b'crm.metadata'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self._local = threading.local()
+
+    @staticmethod
+    def _file_stamp(path: str) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def stamp(self) -> Optional[Tuple[int, int, int]]:
+        return self._file_stamp(self.path)
+
+    @contextlib.contextmanager
+    def lock(self, blocking: bool = True):
+        """Межпроцессная блокировка (повторный вход в том же потоке разрешён).
+
+        Выдаёт False, если blocking=False и блокировку держит другой процесс или поток.
+        """
+        depth = getattr(self._local, 'depth', 0)
+        if depth or fcntl is None:
+            self._local.depth = depth + 1
+            try:
+                yield True
+            finally:
+                self._local.depth = depth
+            return
+        with open(self.lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            self._local.depth = 1
+            try:
+                yield True
+            finally:
+                self._local.depth = 0
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def checked_at(self) -> float:
+        """Время (time.time) последней проверки листа каким-либо процессом"""
+        stamp = self._file_stamp(self.lock_path)
+        return stamp[2] / 1e9 if stamp else 0.0
+
+    def mark_checked(self):
+        with open(self.lock_path, "a"):
+            os.utime(self.lock_path)
+
+    def read(self) -> Tuple[pd.DataFrame, Dict[str, str], Optional[Tuple[int, int, int]]]:
+        """Таблица, метаданные и метка файла. Файл заменяется атомарно - читается целиком старый или новый"""
+        stamp = self.stamp()
+        with pa.memory_map(self.path) as source:
+            table = pa.ipc.open_file(source).read_all()
+        frame = table.to_pandas()
+        metadata = table.schema.metadata or {}
+        for column in json.loads(metadata.get(self.MIXED_COLUMNS_KEY, b'[]')):
+            # Столбец с числами и текстом вперемешку хранится текстом, типы - как у get_all_records()
+            frame[column] = pd.Series(numericise_all(frame[column].tolist()), index=frame.index, dtype=object)
+        return frame, json.loads(metadata.get(self.METADATA_KEY, b'{}')), stamp
+
+    def write(self, frame: pd.DataFrame, metadata: Optional[Dict[str, str]] = None) -> Optional[Tuple[int, int, int]]:
+        """Атомарно заменяет снимок, возвращает метку нового файла"""
+        columns, mixed = {}, []
+        for column in frame.columns:
+            values = frame[column]
+            if pd.api.types.is_object_dtype(values) and not all(isinstance(v, str) for v in values):
+                values = values.astype(str)
+                mixed.append(column)
+            columns[column] = values.reset_index(drop=True)
+        table = pa.Table.from_pandas(pd.DataFrame(columns, columns=list(frame.columns)), preserve_index=False)
+        table = table.replace_schema_metadata({
+            self.MIXED_COLUMNS_KEY: json.dumps(mixed).encode('utf-8'),
+            self.METADATA_KEY: json.dumps(metadata or {}, ensure_ascii=False).encode('utf-8'),
+        })
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        stamp = self._file_stamp(tmp_path)
+        os.replace(tmp_path, self.path)
+        return stamp
+
+
+class SheetDeltaSync:
+    """Локальная копия листа ЗАЯВКИ с дозагрузкой только изменившихся строк.
+
+    Ключ строки - пара (НОМЕР_ЗАЯВКИ, РЕВИЗИЯ), не зависящая от её позиции, поэтому
+    вставка строки выше не делает строки ниже «изменёнными». Проверка читает только
+    столбцы B и I одним запросом, изменившиеся строки дочитываются диапазонами.
+    Полная перезагрузка - при первом чтении, по resync() или если проверка
+    согласованности не прошла. Новая копия вливается в таблицу через
+    OrdersTable.merge() по тому же ключу, поэтому производные индексы получают
+    в журнале только изменившиеся строки.
+
+    С общим снимком (shared) копия делится между процессами: каждый сначала
+    подхватывает свежий снимок, лист проверяет только процесс, получивший
+    блокировку снимка, а свои записи процесс публикует сразу (см. shared_write).
+    Копия, поднятая из снимка после запуска процесса, сверяется с листом в
+    фоновом потоке - первая страница не ждёт авторизации и чтения листа.
+    """
+
+    # Снимок другой таблицы или листа (после смены настроек) не используется
+    SNAPSHOT_SOURCE = f"{SPREADSHEET_KEY or SPREADSHEET_NAME}/{WORKSHEET_NAME_ORDERS}"
+    KEY_COLUMNS = ['НОМЕР_ЗАЯВКИ', REVISION_HEADER]
+
+    def __init__(self, orders_ws, table: OrdersTable, shared: Optional[ArrowSnapshot] = None):
+        self.orders_ws = orders_ws
+        self.table = table
+        self.shared = shared
+        self._shared_stamp = None
+        # False - копия взята из снимка и ещё не сверена с листом в этом процессе
+        self.reconciled = True
+        self._reconcile_thread: Optional[threading.Thread] = None
+        self.keys: List[Tuple[str, str]] = []
+        self.write_queue: Optional['SheetWriteQueue'] = None
+        self.stale = False
+        self.last_check = 0.0
+        self.stats = {'full_reloads': 0, 'delta_checks': 0, 'rows_fetched': 0}
+        # Повторный вход: запись под shared_write обращается к refresh(); порядок - _lock, затем файл
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _frame_keys(frame: pd.DataFrame) -> List[Tuple[str, str]]:
+        return list(zip(frame['НОМЕР_ЗАЯВКИ'].astype(str), frame[REVISION_HEADER].astype(str)))
+
+    @staticmethod
+    def record_key(record: Dict[str, Any]) -> Tuple[str, str]:
+        return str(record['НОМЕР_ЗАЯВКИ']), str(record[REVISION_HEADER])
+
+    @staticmethod
+    def _cell(column: List[List[Any]], i: int) -> str:
+        return str(column[i][0]) if i < len(column) and column[i] else ""
+
+    def mark_stale(self):
+        """Следующий refresh() проверит лист, не дожидаясь интервала"""
+        self.stale = True
+
+    def record_insert(self, position: int, record: Dict[str, Any]):
+        """Учитывает собственную вставку строки, чтобы не дочитывать её из листа"""
+        self.record_inserts([(position, record)])
+
+    def record_inserts(self, rows: List[Tuple[int, Dict[str, Any]]]):
+        """Учитывает пачку собственных вставок (итоговые позиции, как в OrdersTable.insert_many)"""
+        with self._lock:
+            for position, record in sorted(rows, key=lambda row: row[0]):
+                self.keys.insert(position, self.record_key(record))
+            self.publish()
+
+    def record_update(self, position: int, record: Dict[str, Any]):
+        """Учитывает собственную перезапись строки"""
+        with self._lock:
+            self.keys[position] = self.record_key(record)
+            self.publish()
+
+    @contextlib.contextmanager
+    def shared_write(self):
+        """Запись заявки под блокировкой общего снимка: другие процессы не опубликуют
+        свою копию между чтением актуального снимка и публикацией этой записи"""
+        if self.shared is None:
+            yield
+            return
+        with self._lock, self.shared.lock():
+            yield
+
+    def publish(self):
+        """Публикует локальную копию в общий снимок (вызывается под shared_write или _lock)"""
+        if self.shared is None:
+            return
+        with self.shared.lock():
+            self._shared_stamp = self.shared.write(
+                self.table.df, {'source': self.SNAPSHOT_SOURCE, 'saved_at': datetime.now().isoformat(timespec='seconds')}
+            )
+
+    def _adopt_shared(self):
+        # Снимок, опубликованный другим процессом, вливается в локальную копию
+        if self.shared is None:
+            return
+        stamp = self.shared.stamp()
+        if stamp is None or stamp == self._shared_stamp:
+            return
+        try:
+            frame, metadata, stamp = self.shared.read()
+        except (OSError, ValueError, pa.ArrowException):
+            # Повреждённый файл пропускается до следующей публикации: копия читается из листа
+            self._shared_stamp = stamp
+            return
+        self._shared_stamp = stamp
+        if metadata.get('source') != self.SNAPSHOT_SOURCE or not set(self.KEY_COLUMNS) <= set(frame.columns):
+            return
+        if not self.table.loaded:
+            self.reconciled = False
+        self.table.merge(frame, self.KEY_COLUMNS)
+        self.keys = self._frame_keys(self.table.df)
+
+    @property
+    def reconciling(self) -> bool:
+        return self._reconcile_thread is not None
+
+    def _start_reconcile(self):
+        if self._reconcile_thread is None:
+            self._reconcile_thread = threading.Thread(target=self._reconcile, name="orders-reconcile", daemon=True)
+            self._reconcile_thread.start()
+
+    def _reconcile(self):
+        try:
+            # Авторизация, открытие таблицы и проверка заголовков - вне блокировки копии
+            if isinstance(self.orders_ws, LazySheetHandle):
+                self.orders_ws.resolve()
+            with self._lock:
+                self._check_sheet()
+        except Exception:
+            # Ошибку покажет следующая обычная проверка листа
+            self.last_check = 0.0
+        finally:
+            self.reconciled = True
+            self._reconcile_thread = None
+
+    def refresh(self) -> pd.DataFrame:
+        # Пока лист проверяет другой поток (например, фоновая сверка), отдаём текущую копию;
+        # ждём только без копии или если нужна свежая (stale - заявка не найдена)
+        if not self._lock.acquire(blocking=not self.table.loaded or self.stale):
+            return self.table.df
+        try:
+            self._adopt_shared()
+            if not self.table.loaded:
+                with self.shared_write():
+                    self._adopt_shared()
+                    if not self.table.loaded:
+                        self._full_reload()
+            elif not self.reconciled and not self.stale:
+                self._start_reconcile()
+            elif self.write_queue and self.write_queue.has_queued():
+                # Пока свои записи не отправлены, лист отстаёт от локальной копии
+                pass
+            elif self.stale or time_module.monotonic() - self.last_check >= SHEETS_SYNC_INTERVAL_SECONDS:
+                self._check_sheet()
+            return self.table.df
+        finally:
+            self._lock.release()
+
+    def _check_sheet(self):
+        self.reconciled = True
+        if self.shared is None:
+            self._delta_sync()
+            return
+        with self.shared.lock(blocking=False) as acquired:
+            self.last_check = time_module.monotonic()
+            if not acquired:
+                # Лист сейчас проверяет или пишет другой процесс - результат придёт через снимок
+                return
+            self._adopt_shared()
+            if not self.stale and time_module.time() - self.shared.checked_at() < SHEETS_SYNC_INTERVAL_SECONDS:
+                return
+            if self.write_queue and self.write_queue.has_queued():
+                return
+            self._delta_sync()
+            self.shared.mark_checked()
+
+    def resync(self) -> pd.DataFrame:
+        with self._lock, self.shared_write():
+            self._full_reload()
+            return self.table.df
+
+    def _full_reload(self):
+        frame = pd.DataFrame(self.orders_ws.get_all_records())
+        self.table.merge(self._with_unsent(frame), self.KEY_COLUMNS)
+        self.keys = self._frame_keys(self.table.df)
+        self.stale = False
+        self.last_check = time_module.monotonic()
+        self.stats['full_reloads'] += 1
+        self.publish()
+
+    def _delta_sync(self):
+        self.stats['delta_checks'] += 1
+        number_col, revision_col = self.orders_ws.batch_get(['B2:B', 'I2:I'])
+        n_rows = max(len(number_col), len(revision_col))
+        remote_keys = [(self._cell(number_col, i), self._cell(revision_col, i)) for i in range(n_rows)]
+        self.last_check = time_module.monotonic()
+        self.stale = False
+        if remote_keys == self.keys:
+            return
+
+        # Сопоставляем строки листа с локальными по ключу; несопоставленные - дочитываем
+        local_positions: Dict[Tuple[str, str], List[int]] = {}
+        for position, key in enumerate(self.keys):
+            local_positions.setdefault(key, []).append(position)
+        sources = []
+        for key in remote_keys:
+            candidates = local_positions.get(key)
+            sources.append(candidates.pop(0) if candidates else -1)
+        missing = [i for i, src in enumerate(sources) if src == -1]
+
+        ranges = []
+        for i in missing:
+            if ranges and ranges[-1][1] == i - 1:
+                ranges[-1][1] = i
+            else:
+                ranges.append([i, i])
+        if len(missing) > SHEETS_DELTA_MAX_FRACTION * max(n_rows, 1) or len(ranges) > SHEETS_DELTA_MAX_RANGES:
+            self._full_reload()
+            return
+
+        fetched_records = []
+        if ranges:
+            blocks = self.orders_ws.batch_get([f'A{start + 2}:I{end + 2}' for start, end in ranges])
+            for (start, end), block in zip(ranges, blocks):
+                rows = list(block) + [[]] * (end - start + 1 - len(block))
+                for offset, values in enumerate(rows):
+                    values = list(values) + [""] * (len(SHEET_HEADERS) - len(values))
+                    # Строка сдвинулась между запросами - локальная копия ненадёжна
+                    if (str(values[1]), str(values[8])) != remote_keys[start + offset]:
+                        self._full_reload()
+                        return
+                    fetched_records.append(numericise_all(values[:len(SHEET_HEADERS)]))
+            self.stats['rows_fetched'] += len(fetched_records)
+
+        reused = self.table.df.iloc[[src for src in sources if src != -1]]
+        fetched = pd.DataFrame(fetched_records, columns=SHEET_HEADERS)
+        combined = pd.concat([reused, fetched], ignore_index=True)
+        take, next_reused, next_fetched = [], 0, len(reused)
+        for src in sources:
+            if src != -1:
+                take.append(next_reused)
+                next_reused += 1
+            else:
+                take.append(next_fetched)
+                next_fetched += 1
+        frame = combined.iloc[take]
+        merged = self._with_unsent(frame)
+        self.table.merge(merged, self.KEY_COLUMNS)
+        self.keys = remote_keys if merged is frame else self._frame_keys(self.table.df)
+        self.publish()
+
+    def _with_unsent(self, frame: pd.DataFrame) -> pd.DataFrame:
+        """frame (строки листа) со своими записями, которые ещё не отправлены или не прошли.
+
+        Иначе сверка с листом молча убрала бы из копии заявку, сохранённую только
+        локально: перезапись заменяет строку с тем же номером, новая заявка встаёт
+        на место по дате доставки. Статус таких заявок виден в списке по очереди.
+        """
+        unsent = self.write_queue.unsent_rows() if self.write_queue else []
+        if not unsent:
+            return frame
+        frame = frame.reindex(columns=SHEET_HEADERS, fill_value="")
+        positions = {number: i for i, number in enumerate(frame['НОМЕР_ЗАЯВКИ'].astype(str))}
+        rows = frame.values.tolist()
+        inserts = []
+        for sheet_row in unsent:
+            record = [GSheetStorage._sheet_record(sheet_row)[h] for h in SHEET_HEADERS]
+            position = positions.get(str(sheet_row[1]))
+            if position is None:
+                inserts.append(record)
+            else:
+                rows[position] = record
+        plan = plan_sorted_inserts(DeliveryDateIndex.from_dates(frame['ДАТА_ДОСТАВКИ'].tolist()),
+                                   [record[4] for record in inserts])
+        for boundary, group in reversed(plan):
+            rows[boundary:boundary] = [inserts[seq] for seq in group]
+        return pd.DataFrame(rows, columns=SHEET_HEADERS)
+
+
+def archive_partition_name(delivery_date_str: Any) -> str:
+    """Лист архива для заявки: АРХИВ_ГГГГ-ММ по месяцу доставки"""
+    dt = parse_sheet_datetime(delivery_date_str)
+    return f"{ARCHIVE_SHEET_PREFIX}{dt:%Y-%m}" if dt else f"{ARCHIVE_SHEET_PREFIX}БЕЗ_ДАТЫ"
+
+
+def appended_first_row(response: Dict[str, Any]) -> int:
+    """Номер первой строки, дописанной values.append (из updatedRange ответа)"""
+    updated_range = response['updates']['updatedRange']
+    return int(re.search(r'!\$?[A-Z]+\$?(\d+)', updated_range).group(1))
+
+
+class SheetArchive:
+    """Архив листа ЗАЯВКИ: помесячные листы АРХИВ_ГГГГ-ММ и лист АРХИВ_ИНДЕКС.
+
+    Индекс НОМЕР_ЗАЯВКИ -> (лист, строка) читается один раз и дополняется при
+    архивации, поэтому поиск заявки в архиве - чтение одной строки месячного листа.
+    Строка проверяется по номеру; если лист правили вручную (или запись индекса
+    старая, без строки), лист перечитывается целиком. При повторе номера
+    действует последняя запись индекса.
+    """
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self._index: Optional[Dict[str, Tuple[str, Optional[int]]]] = None
+        self._index_ws = None
+        self._worksheets: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _worksheet(self, title: str, headers: List[str], create: bool):
+        # Листы архива не удаляются, поэтому найденный лист запоминается без повторного запроса
+        if title in self._worksheets:
+            return self._worksheets[title]
+        try:
+            worksheet = self.spreadsheet.worksheet(title)
+        except gspread.WorksheetNotFound:
+            if not create:
+                return None
+            worksheet = self.spreadsheet.add_worksheet(title=title, rows=1000, cols=len(headers))
+            worksheet.update(values=[headers], range_name='A1')
+        self._worksheets[title] = worksheet
+        return worksheet
+
+    def _load_index(self) -> Dict[str, Tuple[str, Optional[int]]]:
+        if self._index is None:
+            self._index_ws = self._worksheet(WORKSHEET_NAME_ARCHIVE_INDEX, ARCHIVE_INDEX_HEADERS, create=False)
+            rows = self._index_ws.get_all_values()[1:] if self._index_ws else []
+            self._index = {
+                str(row[0]): (str(row[1]), int(row[2]) if len(row) > 2 and str(row[2]).isdigit() else None)
+                for row in rows if len(row) >= 2 and row[0]
+            }
+        return self._index
+
+    def partition_of(self, order_number: str) -> Optional[str]:
+        with self._lock:
+            entry = self._load_index().get(str(order_number).strip())
+        return entry[0] if entry else None
+
+    def max_number(self) -> Optional[int]:
+        with self._lock:
+            numbers = [int(n) for n in self._load_index() if n.isdigit()]
+        return max(numbers) if numbers else None
+
+    def find(self, order_number: str) -> Optional[Tuple[Any, int, Dict[str, Any]]]:
+        """(лист, номер строки, запись) последней строки заявки в её листе архива или None"""
+        order_number = str(order_number).strip()
+        with self._lock:
+            entry = self._load_index().get(order_number)
+        worksheet = self._worksheet(entry[0], SHEET_HEADERS, create=False) if entry else None
+        if worksheet is None:
+            return None
+        partition, row_number = entry
+        if row_number:
+            block = worksheet.get(f'A{row_number}:I{row_number}')
+            row = list(block[0]) if block else []
+            if len(row) > 1 and str(row[1]) == order_number:
+                return worksheet, row_number, self._record(row)
+        values = worksheet.get_all_values()
+        for row_number in range(len(values), 1, -1):
+            if len(values[row_number - 1]) > 1 and str(values[row_number - 1][1]) == order_number:
+                with self._lock:
+                    self._index[order_number] = (partition, row_number)
+                return worksheet, row_number, self._record(values[row_number - 1])
+        return None
+
+    @staticmethod
+    def _record(row: List[Any]) -> Dict[str, Any]:
+        row = list(row) + [""] * (len(SHEET_HEADERS) - len(row))
+        return dict(zip(SHEET_HEADERS, numericise_all(row[:len(SHEET_HEADERS)])))
+
+    def append(self, sheet_rows: List[List[Any]]):
+        """Дописывает строки в листы архива по месяцам доставки и пополняет индекс"""
+        with self._lock:
+            index = self._load_index()
+            partitions: Dict[str, List[List[Any]]] = {}
+            for row in sheet_rows:
+                partitions.setdefault(archive_partition_name(row[4]), []).append(row)
+            index_rows = []
+            for title, rows in partitions.items():
+                response = self._worksheet(title, SHEET_HEADERS, create=True).append_rows(
+                    rows, value_input_option='RAW', table_range='A1')
+                first_row = appended_first_row(response)
+                index_rows.extend([str(row[1]), title, first_row + i] for i, row in enumerate(rows))
+            if self._index_ws is None:
+                self._index_ws = self._worksheet(WORKSHEET_NAME_ARCHIVE_INDEX, ARCHIVE_INDEX_HEADERS, create=True)
+            self._index_ws.append_rows(index_rows, value_input_option='RAW', table_range='A1')
+            index.update((number, (title, row_number)) for number, title, row_number in index_rows)
+
+
+class GSheetStorage(OrderStorage):
+    """Заявки и прайс в Google Sheets (листы ЗАЯВКИ и ПРАЙС)"""
+
+    name = "gsheets"
+    columns = SHEET_HEADERS
+
+    def __init__(self, orders_ws, write_queue: Optional['SheetWriteQueue'] = None,
+                 shared: Optional[ArrowSnapshot] = None):
+        super().__init__()
+        self.orders_ws = orders_ws
+        self.write_queue = write_queue
+        self.sync = SheetDeltaSync(orders_ws, self.table, shared)
+        self.sync.write_queue = write_queue
+        self._write_lock = threading.Lock()
+        self._counter_ws = None
+        self._counter_base = ORDER_NUMBER_START
+        self._counter_block = ORDER_NUMBER_BLOCK_SIZE
+        self._window_cache: Dict[Tuple[datetime, datetime], Tuple[float, pd.DataFrame]] = {}
+        # Позиции по ключу (НОМЕР_ЗАЯВКИ, РЕВИЗИЯ): строки листа ПОЗИЦИИ только дописываются
+        self._items_ws = None
+        self._items: Dict[Tuple[str, str], List[List[Any]]] = {}
+        self._items_rows_read = 0
+        self._items_loaded_at: Optional[float] = None
+        self._price_ws = None
+        self._price_revision_supported = True
+        self.archive = SheetArchive(LazySheetHandle(lambda: self.orders_ws.spreadsheet))
+
+    def load_orders(self) -> pd.DataFrame:
+        return self.sync.refresh()
+
+    def _local_copy_available(self) -> bool:
+        """Копия в памяти или в снимке на диске (общем для процессов).
+
+        Снимок читается локально и сразу даёт таблицу с идентификаторами строк и
+        индексами - это дешевле запросов к листу, поэтому при нём окно и выгрузка
+        берутся из копии, а не читаются из листа.
+        """
+        return self.table.loaded or (self.sync.shared is not None and self.sync.shared.stamp() is not None)
+
+    def iter_orders(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                    chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+        # Без копии лист читается диапазонами по chunk_rows строк: в памяти только текущий кусок
+        bounds = None if self._local_copy_available() else self._window_bounds(start, end)
+        if bounds is None:
+            yield from super().iter_orders(start, end, chunk_rows)
+            return
+        for first in range(bounds[0], bounds[1], chunk_rows):
+            yield self._read_rows(first, min(first + chunk_rows, bounds[1]))
+
+    def _fetch_orders_window(self, start: datetime, end: datetime) -> Optional[pd.DataFrame]:
+        if self._local_copy_available():
+            return None
+        cached = self._window_cache.get((start, end))
+        if cached and time_module.monotonic() - cached[0] < SHEETS_SYNC_INTERVAL_SECONDS:
+            return cached[1]
+        bounds = self._window_bounds(start, end)
+        if bounds is None:
+            return None
+        frame = self._read_rows(*bounds)
+        self._window_cache = {(start, end): (time_module.monotonic(), frame)}
+        return frame
+
+    def _window_bounds(self, start: Optional[datetime], end: Optional[datetime]) -> Optional[Tuple[int, int]]:
+        """Позиции [first, stop) заявок с доставкой в [start, end) - поиском по столбцу E.
+
+        Лист отсортирован по ДАТА_ДОСТАВКИ, поэтому столбец целиком не читается: за раунд
+        один batch_get из SHEETS_WINDOW_PROBES ячеек на каждую границу сужает её интервал
+        в SHEETS_WINDOW_PROBES + 1 раз (для миллиона строк - четыре раунда). None у start
+        и end - начало и конец данных. Пустая ячейка - конец данных; нераспознанная дата
+        нарушает порядок - тогда None, и окно берётся из загруженной таблицы.
+        """
+        size = max(getattr(self.orders_ws, 'row_count', 0) - 1, 1)
+        cells: Dict[int, Optional[datetime]] = {}  # позиция -> дата, None - пустая ячейка
+
+        def read(positions: List[int]) -> bool:
+            positions = sorted(set(positions) - set(cells))
+            if not positions:
+                return True
+            for position, block in zip(positions, self.orders_ws.batch_get([f'E{p + 2}' for p in positions])):
+                text = str(block[0][0]).strip() if block and block[0] else ""
+                cells[position] = parse_sheet_datetime(text) if text else None
+                if text and cells[position] is None:
+                    return False
+            return True
+
+        # Размер сетки из свойств листа мог устареть: за последней строкой данных - пустая ячейка
+        while True:
+            if not read([size]):
+                return None
+            if cells[size] is None:
+                break
+            size *= 2
+
+        def after(position: int, target: Optional[datetime]) -> bool:
+            value = cells[position]
+            return value is None or (target is not None and value >= target)
+
+        targets = [start, end]
+        intervals = [[0, 0] if start is None else [0, size], [0, size]]
+        while any(lo < hi for lo, hi in intervals):
+            probes = []
+            for lo, hi in intervals:
+                if lo < hi:
+                    probes += [lo + (hi - lo) * i // (SHEETS_WINDOW_PROBES + 1)
+                               for i in range(1, SHEETS_WINDOW_PROBES + 1)] + [lo]
+            if not read(probes):
+                return None
+            for interval, target in zip(intervals, targets):
+                for position in sorted(p for p in cells if interval[0] <= p < interval[1]):
+                    if after(position, target):
+                        interval[1] = position
+                        break
+                    interval[0] = position + 1
+        return intervals[0][0], max(intervals[1][0], intervals[0][0])
+
+    def _read_rows(self, first: int, stop: int) -> pd.DataFrame:
+        """Строки листа на позициях [first, stop) одним диапазоном, с типами get_all_records()"""
+        records = []
+        if stop > first:
+            block = self.orders_ws.get(f'A{first + 2}:I{stop + 1}')
+            for offset in range(stop - first):
+                values = list(block[offset]) if offset < len(block) else []
+                values += [""] * (len(SHEET_HEADERS) - len(values))
+                records.append(numericise_all([str(v) for v in values[:len(SHEET_HEADERS)]]))
+        return pd.DataFrame(records, columns=SHEET_HEADERS)
+
+    def resync(self):
+        self.sync.resync()
+
+    @staticmethod
+    def _sheet_record(sheet_row: List[Any]) -> Dict[str, Any]:
+        # Те же типы, что вернул бы get_all_records() при перечитывании листа
+        return dict(zip(SHEET_HEADERS, numericise_all([str(v) for v in sheet_row])))
+
+    def _rows_match(self, first: int, last: int) -> bool:
+        """Строки листа на позициях first..last - те же заявки (НОМЕР_ЗАЯВКИ, РЕВИЗИЯ), что в копии"""
+        keys = self.sync.keys
+        expected = [keys[p] if p < len(keys) else ("", "") for p in range(first, last + 1)]
+        block = self.orders_ws.get(f'B{first + 2}:I{last + 2}')
+        actual = [(str(cells[0]), str(cells[7])) for cells in (list(row) + [""] * 8 for row in block)]
+        return actual + [("", "")] * (len(expected) - len(actual)) == expected
+
+    def _checked_position(self, locate: Callable[[], int], above: int) -> int:
+        """Позиция locate() в копии, подтверждённая одним чтением листа перед прямой записью.
+
+        Копия может отставать от листа до SHEETS_SYNC_INTERVAL_SECONDS: другой процесс
+        мог вставить или удалить строки выше. Если строки position-above..position в листе
+        уже другие, копия догоняет лист и позиция считается заново.
+        """
+        for _ in range(2):
+            position = locate()
+            if position < 0 or self._rows_match(max(position - above, 0), position):
+                return position
+            self.sync.mark_stale()
+            self.load_orders()
+        raise RuntimeError("Лист ЗАЯВКИ одновременно меняет другой оператор, повторите сохранение.")
+
+    def append_order(self, data_row: List[Any], items: Optional[List[Dict[str, Any]]] = None) -> int:
+        sheet_row = list(data_row) + [new_revision()]
+        with self._write_lock, self.sync.shared_write():
+            if self.write_queue:
+                # Позиция в копии - по локальному индексу без запроса к API; в листе её
+                # пересчитает SheetWriteWorker по свежим столбцам
+                insert_index = get_insert_index(data_row[4], self.delivery_index())
+                self.write_queue.enqueue('insert', sheet_row)
+            else:
+                # Соседи сверху и снизу те же, что в копии, - строка встаёт на своё место по дате
+                insert_index = self._checked_position(
+                    lambda: get_insert_index(data_row[4], self.delivery_index()) - 2, above=1) + 2
+                self.orders_ws.insert_row(sheet_row, index=insert_index)
+            record = self._sheet_record(sheet_row)
+            self.table.insert(insert_index - 2, record)
+            self.sync.record_insert(insert_index - 2, record)
+        if items is not None:
+            self._save_items(str(data_row[1]), sheet_row[-1], items)
+        return insert_index - 2
+
+    def append_orders(self, data_rows: List[List[Any]],
+                      items_list: Optional[List[List[Dict[str, Any]]]] = None) -> List[int]:
+        sheet_rows = [list(data_row) + [new_revision()] for data_row in data_rows]
+        with self._write_lock, self.sync.shared_write():
+            if not self.write_queue:
+                # Места вставки - по копии, сверенной с листом перед записью (чтение столбцов B и I)
+                self.sync.mark_stale()
+                self.load_orders()
+            plan = plan_sorted_inserts(self.delivery_index(), [row[4] for row in sheet_rows])
+            if self.write_queue:
+                # Очередь отправит вставки тем же одним batchUpdate на пачку
+                for sheet_row in sheet_rows:
+                    self.write_queue.enqueue('insert', sheet_row)
+            elif sheet_rows:
+                self.orders_ws.spreadsheet.batch_update(
+                    {'requests': SheetWriteWorker.insert_requests(self.orders_ws.id, plan, sheet_rows)}
+                )
+            positions = planned_positions(plan)
+            records = [(positions[seq], self._sheet_record(sheet_row)) for seq, sheet_row in enumerate(sheet_rows)]
+            self.table.insert_many(records)
+            self.sync.record_inserts(records)
+        if items_list is not None:
+            self._save_items_many([(str(sheet_row[1]), sheet_row[-1], items)
+                                   for sheet_row, items in zip(sheet_rows, items_list) if items is not None])
+        return [positions[seq] for seq in range(len(sheet_rows))]
+
+    def order_position(self, order_number: str) -> int:
+        position = super().order_position(order_number)
+        if position == -1:
+            # Заявка могла появиться у другого оператора после последней синхронизации
+            self.sync.mark_stale()
+            position = super().order_position(order_number)
+        return position
+
+    def find_order(self, order_number: str) -> Optional[Dict[str, Any]]:
+        record = super().find_order(order_number)
+        if record is None:
+            found = self.archive.find(order_number)
+            record = found[2] if found else None
+        return record
+
+    def update_order(self, order_number: str, data_row: List[Any],
+                     items: Optional[List[Dict[str, Any]]] = None) -> int:
+        sheet_row = list(data_row) + [new_revision()]
+        with self._write_lock, self.sync.shared_write():
+            if self.write_queue:
+                position = self.order_position(order_number)
+            else:
+                position = self._checked_position(lambda: self.order_position(order_number), above=0)
+            if position == -1:
+                return self._update_archived(order_number, sheet_row, items)
+            if self.write_queue:
+                self.write_queue.enqueue('update', sheet_row)
+            else:
+                self.orders_ws.update(values=[sheet_row], range_name=f'A{position + 2}:I{position + 2}')
+            record = self._sheet_record(sheet_row)
+            self.table.update(position, record)
+            self.sync.record_update(position, record)
+        if items is not None:
+            self._save_items(str(data_row[1]), sheet_row[-1], items)
+        return position
+
+    def _update_archived(self, order_number: str, sheet_row: List[Any],
+                         items: Optional[List[Dict[str, Any]]]) -> int:
+        # Строка в листе архива перезаписывается на месте, мимо очереди записи
+        found = self.archive.find(order_number)
+        if not found:
+            return -1
+        worksheet, row_number, _ = found
+        worksheet.update(values=[sheet_row], range_name=f'A{row_number}:I{row_number}')
+        if items is not None:
+            self._save_items(str(sheet_row[1]), sheet_row[-1], items)
+        return ARCHIVED_ORDER_POSITION
+
+    def archive_orders(self, cutoff: datetime) -> int:
+        with self._write_lock, self.sync.shared_write():
+            if self.write_queue and self.write_queue.has_queued():
+                raise RuntimeError("В очереди записи есть неотправленные заявки, повторите позже.")
+            self.sync.mark_stale()
+            self.load_orders()
+            positions = self.delivery_index().positions_before(cutoff)
+            if not len(positions):
+                return 0
+            expected_keys = [self.sync.keys[p] for p in positions]
+
+            # Исходные значения ячеек (числа - числами), непрерывными диапазонами строк
+            ranges = []
+            for p in positions.tolist():
+                if ranges and ranges[-1][1] == p - 1:
+                    ranges[-1][1] = p
+                else:
+                    ranges.append([p, p])
+            blocks = self.orders_ws.batch_get([f'A{start + 2}:I{end + 2}' for start, end in ranges],
+                                              value_render_option='UNFORMATTED_VALUE')
+            sheet_rows = []
+            for (start, end), block in zip(ranges, blocks):
+                rows = list(block) + [[]] * (end - start + 1 - len(block))
+                sheet_rows.extend(list(row) + [""] * (len(SHEET_HEADERS) - len(row)) for row in rows)
+            if [(str(row[1]), str(row[8])) for row in sheet_rows] != expected_keys:
+                self.sync.mark_stale()
+                raise RuntimeError("Лист ЗАЯВКИ изменился во время архивации, повторите позже.")
+
+            # Сначала копия в архив, затем удаление из листа одним batchUpdate снизу вверх
+            self.archive.append(sheet_rows)
+            number_col, revision_col = self.orders_ws.batch_get(['B2:B', 'I2:I'])
+            if [(SheetDeltaSync._cell(number_col, p), SheetDeltaSync._cell(revision_col, p))
+                    for p in positions] != expected_keys:
+                self.sync.mark_stale()
+                raise RuntimeError("Лист ЗАЯВКИ изменился во время архивации: заявки скопированы "
+                                   "в архив, но не удалены из листа. Повторите архивацию.")
+            self.orders_ws.spreadsheet.batch_update({'requests': [
+                {'deleteDimension': {'range': {'sheetId': self.orders_ws.id, 'dimension': 'ROWS',
+                                               'startIndex': start + 1, 'endIndex': end + 2}}}
+                for start, end in reversed(ranges)
+            ]})
+            remaining = np.ones(len(self.table.df), dtype=bool)
+            remaining[positions] = False
+            self.table.merge(self.table.df.iloc[np.flatnonzero(remaining)], SheetDeltaSync.KEY_COLUMNS)
+            self.sync.keys = [key for key, keep in zip(self.sync.keys, remaining) if keep]
+            self.sync.publish()
+            return len(sheet_rows)
+
+    def initial_order_number(self) -> int:
+        archived_max = self.archive.max_number()
+        start = super().initial_order_number()
+        return max(start, archived_max + 1) if archived_max is not None else start
+
+    def _open_items_ws(self):
+        if self._items_ws is None:
+            self._items_ws = open_order_items_worksheet(self.orders_ws.spreadsheet)
+        return self._items_ws
+
+    def _refresh_items(self):
+        # Лист ПОЗИЦИИ дочитывается не чаще интервала синхронизации и только ниже уже
+        # прочитанных строк: он только дописывается, а позиции одной заявки попадают
+        # в него одним запросом. Ключи неизменяемы, поэтому свои ещё не отправленные
+        # позиции просто остаются в кэше
+        if self._items_loaded_at and time_module.monotonic() - self._items_loaded_at < SHEETS_SYNC_INTERVAL_SECONDS:
+            return
+        first_row = self._items_rows_read + 2
+        last_column = gspread.utils.rowcol_to_a1(1, len(ORDER_ITEMS_SHEET_HEADERS)).rstrip('1')
+        try:
+            block = self._open_items_ws().get(f'A{first_row}:{last_column}')
+        except gspread.exceptions.APIError as e:
+            # Диапазон ниже последней строки сетки листа - новых строк нет
+            if e.code != 400:
+                raise
+            block = []
+        fresh: Dict[Tuple[str, str], List[List[Any]]] = {}
+        for values in block:
+            values = list(values) + [""] * (len(ORDER_ITEMS_SHEET_HEADERS) - len(values))
+            key = (str(values[0]), str(values[len(ORDER_ITEM_COLUMNS)]))
+            fresh.setdefault(key, []).append(numericise_all(values[:len(ORDER_ITEM_COLUMNS)]))
+        self._items.update(fresh)
+        self._items_rows_read += len(block)
+        self._items_loaded_at = time_module.monotonic()
+
+    def _save_items(self, order_number: str, revision: str, items: List[Dict[str, Any]]):
+        self._save_items_many([(order_number, revision, items)])
+
+    def _save_items_many(self, entries: List[Tuple[str, str, List[Dict[str, Any]]]]):
+        # Без очереди позиции всех заявок дописываются одним запросом
+        appended = []
+        for order_number, revision, items in entries:
+            rows = order_item_rows(order_number, items)
+            sheet_rows = [row + [revision] for row in rows]
+            if self.write_queue:
+                self.write_queue.enqueue_items(order_number, sheet_rows)
+            else:
+                appended.extend(sheet_rows)
+            self._items[(order_number, revision)] = rows
+        if appended:
+            self._open_items_ws().append_rows(appended, value_input_option='RAW')
+
+    def load_order_items(self, order: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+        key = (str(order.get('НОМЕР_ЗАЯВКИ', "")), str(order.get(REVISION_HEADER, "")))
+        if key not in self._items:
+            self._refresh_items()
+        rows = self._items.get(key)
+        return calculator_items_from_rows(rows) if rows else None
+
+    def _stored_items_frame(self, orders: pd.DataFrame) -> pd.DataFrame:
+        self._refresh_items()
+        keys = zip(orders['НОМЕР_ЗАЯВКИ'].astype(str), orders[REVISION_HEADER].astype(str))
+        rows = [row for key in keys for row in self._items.get(key, [])]
+        return pd.DataFrame(rows, columns=ORDER_ITEM_COLUMNS)
+
+    def _write_backfill_items(self, orders: pd.DataFrame, items: pd.DataFrame):
+        revisions = dict(zip(orders['НОМЕР_ЗАЯВКИ'].astype(str), orders[REVISION_HEADER].astype(str)))
+        rows = items[ORDER_ITEM_COLUMNS].values.tolist()
+        sheet_rows = [row + [revisions.get(row[0], "")] for row in rows]
+        self._open_items_ws().append_rows(sheet_rows, value_input_option='RAW')
+        for row in sheet_rows:
+            self._items.setdefault((row[0], row[-1]), []).append(row[:-1])
+
+    def _open_price_ws(self):
+        if self._price_ws is None:
+            self._price_ws = self.orders_ws.spreadsheet.worksheet(WORKSHEET_NAME_PRICE)
+        return self._price_ws
+
+    def load_prices(self) -> pd.DataFrame:
+        # Столбцы без заголовка и ячейка ревизии в строке заголовков пропускаются
+        values = self._open_price_ws().get_all_values()
+        if not values:
+            return pd.DataFrame()
+        revision_col = gspread.utils.a1_to_rowcol(PRICE_REVISION_CELL)[1] - 1
+        keep = [i for i, header in enumerate(values[0]) if header and i != revision_col]
+        rows = [list(row) + [""] * (len(values[0]) - len(row)) for row in values[1:]]
+        return pd.DataFrame(
+            [numericise_all([row[i] for i in keep]) for row in rows if any(row)],
+            columns=[values[0][i] for i in keep]
+        )
+
+    def price_revision(self) -> Optional[str]:
+        # Контрольная сумма считается формулой в самой таблице: проверка - чтение одной ячейки
+        if not self._price_revision_supported:
+            return None
+        price_ws = self._open_price_ws()
+        revision = price_ws.acell(PRICE_REVISION_CELL).value
+        if not revision:
+            try:
+                price_ws.update(values=[[PRICE_REVISION_FORMULA]], range_name=PRICE_REVISION_CELL,
+                                value_input_option='USER_ENTERED')
+            except gspread.exceptions.APIError:
+                # Например, в листе меньше столбцов, чем нужно для ячейки ревизии
+                self._price_revision_supported = False
+                return None
+            revision = price_ws.acell(PRICE_REVISION_CELL).value
+        return str(revision) if revision else None
+
+    def _open_counter_ws(self):
+        # Лист НОМЕРА: A1:C1 - ["НАЧАЛО", первый номер, размер блока], далее строка на каждый блок
+        spreadsheet = self.orders_ws.spreadsheet
+        try:
+            counter_ws = spreadsheet.worksheet(WORKSHEET_NAME_COUNTER)
+        except gspread.WorksheetNotFound:
+            counter_ws = spreadsheet.add_worksheet(title=WORKSHEET_NAME_COUNTER, rows=100, cols=3)
+            counter_ws.update(
+                values=[["НАЧАЛО", self.initial_order_number(), ORDER_NUMBER_BLOCK_SIZE]],
+                range_name='A1:C1'
+            )
+        header = counter_ws.row_values(1)
+        self._counter_base = int(header[1])
+        self._counter_block = int(header[2])
+        self._counter_ws = counter_ws
+
+    def reserve_number_block(self, size: int) -> int:
+        # values.append выполняется Google Sheets последовательно, поэтому добавленные
+        # одним запросом строки идут подряд, уникальны и задают блоки без гонки между
+        # репликами; size округляется вверх до целого числа блоков
+        if self._counter_ws is None:
+            self._open_counter_ws()
+        blocks = max(1, -(-size // self._counter_block))
+        now = datetime.now().strftime(SHEET_DATETIME_FORMAT)
+        response = self._counter_ws.append_rows([[now, self._counter_block]] * blocks, table_range='A1')
+        row = appended_first_row(response)
+        return self._counter_base + (row - 2) * self._counter_block
+
+
+class SQLiteStorage(OrderStorage):
+    """Заявки и прайс в локальном файле SQLite.
+
+    Порядок строк - по дате доставки (sort_ts, обновляется при перезаписи заявки),
+    новая заявка встаёт перед заявками с той же датой. Если задано
+    зеркало (mirror), каждая запись дублируется в него после локального commit.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, mirror: Optional[OrderStorage] = None,
+                 write_queue: Optional['SheetWriteQueue'] = None):
+        super().__init__()
+        self.path = path
+        self.mirror = mirror
+        self.write_queue = write_queue
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._data_version = None
+        self._init_schema()
+
+    @staticmethod
+    def _quoted_columns() -> str:
+        return ", ".join(f'"{h}"' for h in EXPECTED_HEADERS)
+
+    def _init_schema(self):
+        columns_ddl = ", ".join(
+            f'"{h}" REAL' if h == "СУММА" else f'"{h}" TEXT' for h in EXPECTED_HEADERS
+        )
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS orders ("
+                f"id INTEGER PRIMARY KEY AUTOINCREMENT, sort_ts TEXT, {columns_ddl})"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_sort ON orders (sort_ts, id)")
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_number ON orders ("НОМЕР_ЗАЯВКИ")')
+            # Архив: те же строки с меткой месяца доставки (partition), вне основной таблицы
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS orders_archive ("
+                f"id INTEGER PRIMARY KEY, sort_ts TEXT, partition TEXT, {columns_ddl})"
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_orders_archive_number ON orders_archive ("НОМЕР_ЗАЯВКИ")'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS order_items (order_number TEXT, line INTEGER, '
+                '"НАИМЕНОВАНИЕ" TEXT, "КОЛИЧЕСТВО" INTEGER, "ЦЕНА_ЗА_ЕД" REAL, "КОММЕНТАРИЙ_ПОЗИЦИИ" TEXT)'
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_order_items_number ON order_items (order_number, line)")
+            self._conn.execute('CREATE TABLE IF NOT EXISTS prices ("НАИМЕНОВАНИЕ" TEXT PRIMARY KEY, "ЦЕНА" REAL)')
+            self._conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+
+    @staticmethod
+    def _sort_ts(delivery_date_str: Any) -> Optional[str]:
+        dt = parse_sheet_datetime(delivery_date_str)
+        return dt.isoformat(sep=' ') if dt else None
+
+    @staticmethod
+    def _db_values(data_row: List[Any]) -> List[Any]:
+        return [v if h == "СУММА" else str(v) for h, v in zip(EXPECTED_HEADERS, data_row)]
+
+    def _position_of(self, sort_ts: Optional[str], row_id: int) -> int:
+        # Строки без распознанной даты (NULL) идут первыми, при равной дате - более новые выше
+        if sort_ts is None:
+            query, params = "SELECT COUNT(*) FROM orders WHERE sort_ts IS NULL AND id > ?", (row_id,)
+        else:
+            query = ("SELECT COUNT(*) FROM orders WHERE sort_ts IS NULL OR sort_ts < ? "
+                     "OR (sort_ts = ? AND id > ?)")
+            params = (sort_ts, sort_ts, row_id)
+        return self._conn.execute(query, params).fetchone()[0]
+
+    def _find_row(self, order_number: str):
+        return self._conn.execute(
+            'SELECT id, sort_ts FROM orders WHERE "НОМЕР_ЗАЯВКИ" = ? '
+            'ORDER BY sort_ts IS NOT NULL DESC, sort_ts DESC, id ASC LIMIT 1',
+            (str(order_number),)
+        ).fetchone()
+
+    def _replace_items(self, order_number: str, items: List[Dict[str, Any]]):
+        self._conn.execute("DELETE FROM order_items WHERE order_number = ?", (order_number,))
+        self._conn.executemany(
+            "INSERT INTO order_items VALUES (?, ?, ?, ?, ?, ?)",
+            [[row[0], line] + row[1:] for line, row in enumerate(order_item_rows(order_number, items))]
+        )
+
+    def _mirror_write(self, op: str, data_row: List[Any], items: Optional[List[Dict[str, Any]]] = None):
+        if self.write_queue:
+            revision = new_revision()
+            self.write_queue.enqueue(op, list(data_row) + [revision])
+            if items is not None:
+                self.write_queue.enqueue_items(
+                    str(data_row[1]), [row + [revision] for row in order_item_rows(str(data_row[1]), items)]
+                )
+            return
+        if not self.mirror:
+            return
+        try:
+            if op == 'insert':
+                self.mirror.append_order(data_row, items)
+            else:
+                self.mirror.update_order(str(data_row[1]), data_row, items)
+        except Exception as e:
+            st.warning(f"Заявка сохранена локально, но не попала в зеркало '{self.mirror.name}': {e}")
+
+    def _read_data_version(self) -> int:
+        # Меняется, только если в файл записало другое соединение (другой процесс)
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def load_orders(self) -> pd.DataFrame:
+        with self._lock:
+            data_version = self._read_data_version()
+        if not self.table.loaded or data_version != self._data_version:
+            self.resync()
+        return self.table.df
+
+    def _fetch_orders_window(self, start: datetime, end: datetime) -> Optional[pd.DataFrame]:
+        with self._lock:
+            return pd.read_sql_query(
+                f"SELECT {self._quoted_columns()} FROM orders WHERE sort_ts >= ? AND sort_ts < ? "
+                f"ORDER BY sort_ts, id DESC",
+                self._conn, params=(start.isoformat(sep=' '), end.isoformat(sep=' '))
+            )
+
+    def iter_orders(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                    chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+        # Курсор отдельного соединения: выгрузка не держит блокировку записи и не грузит таблицу целиком
+        query, params = f"SELECT {self._quoted_columns()} FROM orders", ()
+        if start:
+            query, params = query + " WHERE sort_ts >= ? AND sort_ts < ?", (start.isoformat(sep=' '),
+                                                                             end.isoformat(sep=' '))
+        conn = sqlite3.connect(self.path)
+        try:
+            yield from pd.read_sql_query(query + " ORDER BY sort_ts, id DESC", conn,
+                                         params=params, chunksize=chunk_rows)
+        finally:
+            conn.close()
+
+    def resync(self):
+        with self._lock:
+            self._data_version = self._read_data_version()
+            frame = pd.read_sql_query(
+                f"SELECT {self._quoted_columns()} FROM orders ORDER BY sort_ts, id DESC",
+                self._conn
+            )
+            self.table.merge(frame)
+
+    def append_order(self, data_row: List[Any], items: Optional[List[Dict[str, Any]]] = None) -> int:
+        sort_ts = self._sort_ts(data_row[4])
+        placeholders = ", ".join("?" * (len(EXPECTED_HEADERS) + 1))
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                f"INSERT INTO orders (sort_ts, {self._quoted_columns()}) VALUES ({placeholders})",
+                [sort_ts] + self._db_values(data_row)
+            )
+            if items is not None:
+                self._replace_items(str(data_row[1]), items)
+            position = self._position_of(sort_ts, cursor.lastrowid)
+            if self.table.loaded:
+                self.table.insert(position, dict(zip(EXPECTED_HEADERS, self._db_values(data_row))))
+        self._mirror_write('insert', data_row, items)
+        return position
+
+    def append_orders(self, data_rows: List[List[Any]],
+                      items_list: Optional[List[List[Dict[str, Any]]]] = None) -> List[int]:
+        placeholders = ", ".join("?" * (len(EXPECTED_HEADERS) + 1))
+        items_list = items_list or [None] * len(data_rows)
+        row_keys = []
+        with self._lock, self._conn:
+            for data_row, items in zip(data_rows, items_list):
+                sort_ts = self._sort_ts(data_row[4])
+                cursor = self._conn.execute(
+                    f"INSERT INTO orders (sort_ts, {self._quoted_columns()}) VALUES ({placeholders})",
+                    [sort_ts] + self._db_values(data_row)
+                )
+                if items is not None:
+                    self._replace_items(str(data_row[1]), items)
+                row_keys.append((sort_ts, cursor.lastrowid))
+            positions = [self._position_of(sort_ts, row_id) for sort_ts, row_id in row_keys]
+            if self.table.loaded:
+                self.table.insert_many([
+                    (position, dict(zip(EXPECTED_HEADERS, self._db_values(data_row))))
+                    for position, data_row in zip(positions, data_rows)
+                ])
+        if self.mirror and not self.write_queue:
+            try:
+                self.mirror.append_orders(data_rows, items_list)
+            except Exception as e:
+                st.warning(f"Заявки сохранены локально, но не попали в зеркало '{self.mirror.name}': {e}")
+        else:
+            for data_row, items in zip(data_rows, items_list):
+                self._mirror_write('insert', data_row, items)
+        return positions
+
+    def update_order(self, order_number: str, data_row: List[Any],
+                     items: Optional[List[Dict[str, Any]]] = None) -> int:
+        assignments = ", ".join(f'"{h}" = ?' for h in EXPECTED_HEADERS)
+        with self._lock, self._conn:
+            found = self._find_row(order_number)
+            if not found:
+                archived_id = self._find_archived_row(order_number)
+                if archived_id is None:
+                    return -1
+                self._conn.execute(
+                    f"UPDATE orders_archive SET sort_ts = ?, {assignments} WHERE id = ?",
+                    [self._sort_ts(data_row[4])] + self._db_values(data_row) + [archived_id]
+                )
+                position = old_position = ARCHIVED_ORDER_POSITION
+            else:
+                # Новая дата доставки переносит строку: окна, выгрузка и архивация идут по sort_ts
+                row_id, old_sort_ts = found
+                sort_ts = self._sort_ts(data_row[4])
+                old_position = self._position_of(old_sort_ts, row_id)
+                self._conn.execute(
+                    f"UPDATE orders SET sort_ts = ?, {assignments} WHERE id = ?",
+                    [sort_ts] + self._db_values(data_row) + [row_id]
+                )
+                position = self._position_of(sort_ts, row_id)
+            if items is not None:
+                self._replace_items(str(data_row[1]), items)
+            if position >= 0 and self.table.loaded and old_position < len(self.table.df):
+                record = dict(zip(EXPECTED_HEADERS, self._db_values(data_row)))
+                if position == old_position:
+                    self.table.update(position, record)
+                else:
+                    self.table.move(old_position, position, record)
+        self._mirror_write('update', data_row, items)
+        return position
+
+    def _find_archived_row(self, order_number: str) -> Optional[int]:
+        found = self._conn.execute(
+            'SELECT id FROM orders_archive WHERE "НОМЕР_ЗАЯВКИ" = ? ORDER BY id DESC LIMIT 1',
+            (str(order_number),)
+        ).fetchone()
+        return found[0] if found else None
+
+    def find_order(self, order_number: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            found = self._find_row(order_number)
+            if found:
+                table, row_id = "orders", found[0]
+            else:
+                table, row_id = "orders_archive", self._find_archived_row(order_number)
+                if row_id is None:
+                    return None
+            values = self._conn.execute(
+                f"SELECT {self._quoted_columns()} FROM {table} WHERE id = ?", (row_id,)
+            ).fetchone()
+        return dict(zip(EXPECTED_HEADERS, values))
+
+    def archive_orders(self, cutoff: datetime) -> int:
+        # Зеркало в Google Sheets не архивируется: его лист остаётся полным
+        cutoff_ts = cutoff.isoformat(sep=' ')
+        with self._lock, self._conn:
+            moved = self._conn.execute(
+                f"INSERT INTO orders_archive (id, sort_ts, partition, {self._quoted_columns()}) "
+                f"SELECT id, sort_ts, substr(sort_ts, 1, 7), {self._quoted_columns()} "
+                f"FROM orders WHERE sort_ts < ?",
+                (cutoff_ts,)
+            ).rowcount
+            self._conn.execute("DELETE FROM orders WHERE sort_ts < ?", (cutoff_ts,))
+        if moved and self.table.loaded:
+            self.resync()
+        return moved
+
+    def load_order_items(self, order: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT order_number, "НАИМЕНОВАНИЕ", "КОЛИЧЕСТВО", "ЦЕНА_ЗА_ЕД", "КОММЕНТАРИЙ_ПОЗИЦИИ" '
+                'FROM order_items WHERE order_number = ? ORDER BY line',
+                (str(order.get('НОМЕР_ЗАЯВКИ', "")),)
+            ).fetchall()
+        return calculator_items_from_rows(rows) if rows else None
+
+    def _stored_items_frame(self, orders: pd.DataFrame) -> pd.DataFrame:
+        with self._lock:
+            return pd.read_sql_query(
+                'SELECT order_number AS "НОМЕР_ЗАЯВКИ", "НАИМЕНОВАНИЕ", "КОЛИЧЕСТВО", "ЦЕНА_ЗА_ЕД", '
+                '"КОММЕНТАРИЙ_ПОЗИЦИИ" FROM order_items ORDER BY rowid',
+                self._conn
+            )
+
+    def _write_backfill_items(self, orders: pd.DataFrame, items: pd.DataFrame):
+        lines = items.groupby('НОМЕР_ЗАЯВКИ', sort=False).cumcount().tolist()
+        rows = [[row[0], line] + row[1:] for row, line in zip(items[ORDER_ITEM_COLUMNS].values.tolist(), lines)]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT INTO order_items VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def load_prices(self) -> pd.DataFrame:
+        with self._lock:
+            df = pd.read_sql_query('SELECT "НАИМЕНОВАНИЕ", "ЦЕНА" FROM prices ORDER BY rowid', self._conn)
+        if df.empty and self.mirror:
+            # Первый запуск: прайс берём из зеркала и сохраняем локально
+            df = self.mirror.load_prices()
+            self.save_prices(df)
         return df
+
+    def price_revision(self) -> Optional[str]:
+        with self._lock:
+            found = self._conn.execute("SELECT value FROM counters WHERE name = 'price_revision'").fetchone()
+        return str(found[0] if found else 0)
+
+    def initial_order_number(self) -> int:
+        max_number = self._conn.execute(
+            'SELECT MAX(CAST("НОМЕР_ЗАЯВКИ" AS INTEGER)) FROM '
+            '(SELECT "НОМЕР_ЗАЯВКИ" FROM orders UNION ALL SELECT "НОМЕР_ЗАЯВКИ" FROM orders_archive) '
+            'WHERE "НОМЕР_ЗАЯВКИ" GLOB \'[0-9]*\' AND "НОМЕР_ЗАЯВКИ" NOT GLOB \'*[^0-9]*\''
+        ).fetchone()[0]
+        return max(max_number + 1, ORDER_NUMBER_START) if max_number is not None else ORDER_NUMBER_START
+
+    def reserve_number_block(self, size: int) -> int:
+        # BEGIN IMMEDIATE берёт блокировку записи файла: процессы резервируют по очереди
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                found = self._conn.execute("SELECT value FROM counters WHERE name = 'order_number'").fetchone()
+                start = found[0] if found else self.initial_order_number()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO counters (name, value) VALUES ('order_number', ?)", (start + size,)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return start
+
+    def save_prices(self, price_df: pd.DataFrame):
+        """Полностью заменяет локальный прайс"""
+        if 'НАИМЕНОВАНИЕ' not in price_df.columns or 'ЦЕНА' not in price_df.columns:
+            return
+        rows = [
+            (str(name), price)
+            for name, price in zip(price_df['НАИМЕНОВАНИЕ'], pd.to_numeric(price_df['ЦЕНА'], errors='coerce'))
+            if pd.notna(price)
+        ]
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM prices")
+            self._conn.executemany('INSERT OR REPLACE INTO prices VALUES (?, ?)', rows)
+            self._conn.execute(
+                "INSERT INTO counters (name, value) VALUES ('price_revision', 1) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + 1"
+            )
+
+
+# ================================================================
+# ОЧЕРЕДЬ ЗАПИСИ В GOOGLE SHEETS (фоновая пакетная синхронизация)
+# ================================================================
+WRITE_QUEUE_STATUS_LABELS = {
+    'queued': '⏳ В очереди',
+    'synced': '✅ Синхронизирована',
+    'failed': '❌ Ошибка записи',
+}
+
+
+class SheetWriteQueue:
+    """Очередь записей в листы ЗАЯВКИ и ПОЗИЦИИ, хранящаяся в локальном файле SQLite.
+
+    Сохранение заявки только добавляет операцию в очередь и сразу возвращается;
+    фоновый SheetWriteWorker отправляет накопившиеся операции пачкой. Очередь
+    переживает перезапуск процесса, статус синхронизации виден по номеру заявки.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.worker: Optional['SheetWriteWorker'] = None
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT, order_number TEXT, payload TEXT, "
+                "status TEXT, attempts INTEGER DEFAULT 0, error TEXT, updated_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status, id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_order ON outbox (order_number, id)")
+
+    def _execute(self, query: str, params=()):
+        with self._lock, self._conn:
+            return self._conn.execute(query, params).fetchall()
+
+    def enqueue(self, op: str, sheet_row: List[Any]) -> int:
+        """Добавляет операцию 'insert' или 'update' (строка листа A:I)"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO outbox (op, order_number, payload, status, updated_at) VALUES (?, ?, ?, 'queued', ?)",
+                (op, str(sheet_row[1]), json.dumps(list(sheet_row), ensure_ascii=False), time_module.time())
+            )
+        if self.worker:
+            self.worker.wake()
+        return cursor.lastrowid
+
+    def enqueue_items(self, order_number: str, item_rows: List[List[Any]]) -> int:
+        """Добавляет операцию 'items' - дописать строки в лист ПОЗИЦИИ"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO outbox (op, order_number, payload, status, updated_at) VALUES ('items', ?, ?, 'queued', ?)",
+                (str(order_number), json.dumps(item_rows, ensure_ascii=False), time_module.time())
+            )
+        if self.worker:
+            self.worker.wake()
+        return cursor.lastrowid
+
+    def take_queued(self, limit: int) -> List[Dict[str, Any]]:
+        rows = self._execute(
+            "SELECT id, op, order_number, payload FROM outbox WHERE status = 'queued' ORDER BY id LIMIT ?",
+            (limit,)
+        )
+        return [
+            {'id': row_id, 'op': op, 'order_number': number, 'row': json.loads(payload)}
+            for row_id, op, number, payload in rows
+        ]
+
+    def has_queued(self) -> bool:
+        return bool(self._execute("SELECT 1 FROM outbox WHERE status = 'queued' LIMIT 1"))
+
+    def _mark(self, ids: List[int], status: str, error: Optional[str] = None):
+        if not ids:
+            return
+        placeholders = ", ".join("?" * len(ids))
+        self._execute(
+            f"UPDATE outbox SET status = ?, error = ?, updated_at = ? WHERE id IN ({placeholders})",
+            [status, error, time_module.time()] + list(ids)
+        )
+
+    def mark_synced(self, ids: List[int]):
+        self._mark(ids, 'synced')
+
+    def mark_failed(self, ids: List[int], error: str):
+        self._mark(ids, 'failed', error)
+
+    def mark_retry(self, ids: List[int], error: str):
+        """Неудачная попытка: операция остаётся в очереди, после WRITE_QUEUE_MAX_ATTEMPTS - ошибка"""
+        if not ids:
+            return
+        placeholders = ", ".join("?" * len(ids))
+        self._execute(
+            f"UPDATE outbox SET attempts = attempts + 1, error = ?, updated_at = ?, "
+            f"status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE status END "
+            f"WHERE status = 'queued' AND id IN ({placeholders})",
+            [error, time_module.time(), WRITE_QUEUE_MAX_ATTEMPTS] + list(ids)
+        )
+
+    def retry_failed(self):
+        self._execute("UPDATE outbox SET status = 'queued', attempts = 0 WHERE status = 'failed'")
+        if self.worker:
+            self.worker.wake()
+
+    def purge_synced(self, older_than_seconds: float):
+        self._execute(
+            "DELETE FROM outbox WHERE status = 'synced' AND updated_at < ?",
+            (time_module.time() - older_than_seconds,)
+        )
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self._execute("SELECT status, COUNT(*) FROM outbox GROUP BY status"))
+
+    def status_by_order(self) -> Dict[str, str]:
+        """Статус последней операции по каждой заявке, которая есть в очереди"""
+        return dict(self._execute(
+            "SELECT order_number, status FROM outbox WHERE id IN (SELECT MAX(id) FROM outbox GROUP BY order_number)"
+        ))
+
+    def unsent_rows(self) -> List[List[Any]]:
+        """Строки листа A:I заявок, последняя запись которых ещё не отправлена или не прошла"""
+        rows = self._execute(
+            "SELECT payload FROM outbox WHERE status IN ('queued', 'failed') AND id IN "
+            "(SELECT MAX(id) FROM outbox WHERE op != 'items' GROUP BY order_number) ORDER BY id"
+        )
+        return [json.loads(payload) for (payload,) in rows]
+
+    def failed_items(self, limit: int = 20) -> List[Tuple[str, str]]:
+        return self._execute(
+            "SELECT order_number, error FROM outbox WHERE status = 'failed' ORDER BY id DESC LIMIT ?", (limit,)
+        )
+
+
+class SheetWriteWorker(threading.Thread):
+    """Фоновый поток, отправляющий операции очереди в лист ЗАЯВКИ пачками.
+
+    За один проход - два запроса независимо от размера пачки: чтение столбцов B, E
+    и I и один атомарный batchUpdate со вставкой строк и записью всех значений. Позиции
+    считаются по свежему состоянию листа, поэтому записи других процессов не мешают.
+    Строки, ключ (НОМЕР_ЗАЯВКИ, РЕВИЗИЯ) которых уже есть в листе, повторно не пишутся:
+    сбой между batchUpdate и отметкой в очереди не задваивает заявки и их позиции.
+    """
+
+    def __init__(self, queue: SheetWriteQueue, orders_ws):
+        super().__init__(name="sheet-write-worker", daemon=True)
+        self.queue = queue
+        self.orders_ws = orders_ws
+        self._items_ws = None
+        self._wake = threading.Event()
+        queue.worker = self
+
+    def wake(self):
+        self._wake.set()
+
+    def run(self):
+        last_purge = 0.0
+        while True:
+            # Ждём интервал, чтобы собрать в одну пачку заявки, пришедшие почти одновременно
+            self._wake.wait(timeout=WRITE_QUEUE_FLUSH_SECONDS)
+            self._wake.clear()
+            time_module.sleep(WRITE_QUEUE_FLUSH_SECONDS)
+            self.flush_once()
+            if time_module.time() - last_purge > 3600:
+                self.queue.purge_synced(older_than_seconds=86400)
+                last_purge = time_module.time()
+
+    def flush_once(self) -> int:
+        items = self.queue.take_queued(WRITE_QUEUE_MAX_BATCH)
+        if not items:
+            return 0
+        try:
+            self._flush(items)
+        except Exception as e:
+            self.queue.mark_retry([item['id'] for item in items], str(e))
+        return len(items)
+
+    def _flush(self, items: List[Dict[str, Any]]):
+        number_col, date_col, revision_col = self.orders_ws.batch_get(['B2:B', 'E2:E', 'I2:I'])
+        n_rows = max(len(number_col), len(date_col), len(revision_col))
+        existing_positions = {SheetDeltaSync._cell(number_col, i): i for i in range(n_rows)}
+        existing_keys = {(SheetDeltaSync._cell(number_col, i), SheetDeltaSync._cell(revision_col, i))
+                         for i in range(n_rows)}
+
+        # Схлопываем операции: перезапись ещё не отправленной заявки меняет строку вставки.
+        # Уже записанные (прошлый проход упал после batchUpdate) только отмечаются; их позиции
+        # были в том же batchUpdate, а повторный проход берёт ту же пачку с начала очереди
+        inserts, pending_inserts, updates, item_appends = [], {}, {}, []
+        applied, applied_keys = [], set()
+        for item in items:
+            number = str(item['order_number'])
+            if item['op'] == 'items':
+                if item['row'] and (number, str(item['row'][0][-1])) in applied_keys:
+                    applied.append(item['id'])
+                else:
+                    item_appends.append(item)
+                continue
+            key = (number, str(item['row'][8]))
+            if key in existing_keys:
+                applied.append(item['id'])
+                applied_keys.add(key)
+                continue
+            if item['op'] == 'insert':
+                entry = {'ids': [item['id']], 'row': item['row']}
+                inserts.append(entry)
+                pending_inserts[number] = entry
+                continue
+            entry = pending_inserts.get(number)
+            if entry is None and number in existing_positions:
+                entry = updates.setdefault(number, {'ids': [], 'row': None})
+            if entry is None:
+                self.queue.mark_failed([item['id']], f"Заявка с номером {number} не найдена в таблице.")
+                continue
+            entry['ids'].append(item['id'])
+            entry['row'] = item['row']
+
+        # Место вставки - число существующих строк выше новой; одинаковые места - одной пачкой
+        date_index = DeliveryDateIndex.from_dates([SheetDeltaSync._cell(date_col, i) for i in range(n_rows)])
+        plan = plan_sorted_inserts(date_index, [entry['row'][4] for entry in inserts])
+
+        # Один атомарный batchUpdate со вставкой новых строк и записью изменённых
+        sheet_id = self.orders_ws.id
+        requests = self.insert_requests(sheet_id, plan, [entry['row'] for entry in inserts])
+        written = [inserts[seq] for _, group in plan for seq in group]
+        for number, entry in updates.items():
+            position = existing_positions[number]
+            shift = sum(len(group) for boundary, group in plan if boundary <= position)
+            requests.append(self._update_cells_request(sheet_id, position + 1 + shift, [entry['row']]))
+            written.append(entry)
+        # Позиции заказов дописываются в лист ПОЗИЦИИ тем же запросом
+        item_rows = [row for item in item_appends for row in item['row']]
+        if item_rows:
+            if self._items_ws is None:
+                self._items_ws = open_order_items_worksheet(self.orders_ws.spreadsheet)
+            requests.append({'appendCells': {
+                'sheetId': self._items_ws.id,
+                'rows': self._cell_rows(item_rows),
+                'fields': 'userEnteredValue',
+            }})
+        written.extend({'ids': [item['id']]} for item in item_appends)
+        if requests:
+            self.orders_ws.spreadsheet.batch_update({'requests': requests})
+        self.queue.mark_synced(applied + [row_id for entry in written for row_id in entry['ids']])
+
+    @staticmethod
+    def _cell_rows(rows: List[List[Any]]) -> List[Dict[str, Any]]:
+        # Значения пишутся как есть (аналог RAW): числа - числами, остальное - строками
+        def cell(value):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return {'userEnteredValue': {'numberValue': value}}
+            return {'userEnteredValue': {'stringValue': str(value)}}
+        return [{'values': [cell(v) for v in row]} for row in rows]
+
+    @classmethod
+    def _update_cells_request(cls, sheet_id: int, row_index: int, rows: List[List[Any]]) -> Dict[str, Any]:
+        return {'updateCells': {
+            'start': {'sheetId': sheet_id, 'rowIndex': row_index, 'columnIndex': 0},
+            'rows': cls._cell_rows(rows),
+            'fields': 'userEnteredValue',
+        }}
+
+    @classmethod
+    def insert_requests(cls, sheet_id: int, plan: List[Tuple[int, List[int]]],
+                        rows: List[List[Any]]) -> List[Dict[str, Any]]:
+        """Запросы batchUpdate для вставки rows по плану plan_sorted_inserts: пустые строки
+        снизу вверх (места выше не сдвигаются), затем значения на итоговые позиции"""
+        requests = [{'insertDimension': {
+            'range': {'sheetId': sheet_id, 'dimension': 'ROWS',
+                      'startIndex': boundary + 1, 'endIndex': boundary + 1 + len(group)},
+            'inheritFromBefore': False,
+        }} for boundary, group in reversed(plan)]
+        inserted_above = 0
+        for boundary, group in plan:
+            requests.append(cls._update_cells_request(
+                sheet_id, boundary + 1 + inserted_above, [rows[seq] for seq in group]
+            ))
+            inserted_above += len(group)
+        return requests
+
+
+@traced_cache(st.cache_resource, "get_write_queue")
+def get_write_queue() -> Optional[SheetWriteQueue]:
+    """Очередь записи в Google Sheets с запущенным фоновым потоком (одна на процесс)"""
+    if not WRITE_QUEUE_ENABLED:
+        return None
+    try:
+        queue = SheetWriteQueue(WRITE_QUEUE_PATH)
+    except sqlite3.Error as e:
+        st.error(f"Ошибка открытия очереди записи '{WRITE_QUEUE_PATH}': {e}")
+        return None
+    SheetWriteWorker(queue, LazySheetHandle(get_orders_worksheet)).start()
+    return queue
+
+
+class OrderNumberAllocator:
+    """Выдача номеров заявок из блоков, заранее зарезервированных в хранилище.
+
+    reserve() выдаёт номер без обращения к хранилищу, пока в блоке есть номера;
+    commit() отмечает номер использованным, release() возвращает неиспользованный
+    номер для повторной выдачи в этом процессе. Уникальность между процессами и
+    репликами обеспечивает хранилище (reserve_number_block); номера, занятые
+    заявками вне счётчика (введёнными в лист вручную), отсеиваются по локальной
+    копии без внеочередных запросов к источнику.
+    """
+
+    def __init__(self, storage: OrderStorage, block_size: int = ORDER_NUMBER_BLOCK_SIZE):
+        self.storage = storage
+        self.block_size = block_size
+        self._next = 0
+        self._block_end = 0
+        self._released: List[int] = []
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def _take(self) -> int:
+        if self._released:
+            return self._released.pop()
+        if self._next >= self._block_end:
+            self._next = self.storage.reserve_number_block(self.block_size)
+            self._block_end = self._next + self.block_size
+        number = self._next
+        self._next += 1
+        return number
+
+    def reserve(self) -> str:
+        with self._lock:
+            number = self._take()
+            # Номер, уже занятый заявкой (например, введённой в лист вручную), пропускаем
+            while self.storage.used_order_numbers([str(number)]):
+                number = self._take()
+            self._pending.add(number)
+            return str(number)
+
+    def reserve_many(self, count: int) -> List[str]:
+        """count номеров одним резервированием в хранилище (импорт), минуя блоки reserve()"""
+        with self._lock:
+            numbers: List[int] = []
+            while len(numbers) < count:
+                needed = count - len(numbers)
+                first = self.storage.reserve_number_block(needed)
+                block = [str(n) for n in range(first, first + needed)]
+                used = self.storage.used_order_numbers(block)
+                numbers += [int(n) for n in block if n not in used]
+            self._pending.update(numbers)
+            return [str(number) for number in numbers]
+
+    def commit(self, order_number: str):
+        with self._lock:
+            self._pending.discard(int(order_number))
+
+    def release(self, order_number: str):
+        with self._lock:
+            number = int(order_number)
+            if number in self._pending:
+                self._pending.discard(number)
+                self._released.append(number)
+
+
+@traced_cache(st.cache_resource, "get_order_number_allocator")
+def get_order_number_allocator() -> Optional[OrderNumberAllocator]:
+    storage = get_storage()
+    return OrderNumberAllocator(storage) if storage else None
+
+
+@traced_cache(st.cache_resource, "get_storage")
+def get_storage() -> Optional[OrderStorage]:
+    """Создаёт хранилище заявок согласно STORAGE_BACKEND (общее для всех сессий процесса)"""
+    if STORAGE_BACKEND == "sqlite":
+        mirror, write_queue = None, None
+        if SHEETS_MIRROR_ENABLED:
+            orders_ws = get_orders_worksheet()
+            mirror = GSheetStorage(orders_ws) if orders_ws else None
+            write_queue = get_write_queue()
+        try:
+            return SQLiteStorage(SQLITE_DB_PATH, mirror=mirror, write_queue=write_queue)
+        except sqlite3.Error as e:
+            st.error(f"Ошибка открытия локальной базы '{SQLITE_DB_PATH}': {e}")
+            return None
+    # Лист откроется при первом обращении: со снимком на диске - в фоновой сверке
+    shared = ArrowSnapshot(SHARED_SNAPSHOT_PATH) if SHARED_SNAPSHOT_PATH else None
+    return GSheetStorage(LazySheetHandle(get_orders_worksheet), write_queue=get_write_queue(), shared=shared)
+
+
+def load_orders_window(start: datetime, end: datetime) -> Tuple[pd.DataFrame, Optional[int]]:
+    """Заявки с доставкой в [start, end) и версия таблицы (None - выборка прочитана из источника)"""
+    storage = get_storage()
+    if not storage:
+        return pd.DataFrame(), None
+    try:
+        return storage.load_orders_window(start, end)
     except Exception as e:
         st.error(f"Ошибка загрузки списка заявок: {e}")
-        return pd.DataFrame()
+        return pd.DataFrame(), None
 
 
-@st.cache_data(ttl="1h")
-def load_price_list():
-    gc = get_gsheet_client()
-    if not gc:
+def load_slot_occupancy() -> Optional[SlotOccupancyIndex]:
+    storage = get_storage()
+    if not storage:
+        return None
+    try:
+        # Фрагмент формы перезапускается на каждое изменение поля: без сверки с источником
+        return storage.slot_occupancy(fresh=False)
+    except Exception as e:
+        st.error(f"Ошибка загрузки занятости слотов доставки: {e}")
+        return None
+
+
+def check_delivery_slot(occupancy: SlotOccupancyIndex, delivery_datetime: datetime,
+                        edited_datetime: Optional[datetime] = None) -> Tuple[int, bool, bool]:
+    """Заявок в слоте delivery_datetime, заполнен ли он и отказывать ли в сохранении.
+
+    edited_datetime - прежняя доставка редактируемой заявки: в своём слоте она уже
+    учтена и места себе не занимает (если она не в архиве).
+    """
+    taken = occupancy.count(delivery_datetime)
+    if edited_datetime and edited_datetime.date() == delivery_datetime.date() and \
+            delivery_slot(edited_datetime) == delivery_slot(delivery_datetime):
+        taken = max(taken - 1, 0)
+    full = taken >= SLOT_CAPACITY
+    return taken, full, full and SLOT_OVERBOOKING == "refuse"
+
+
+def load_customer_profile(phone: str) -> Optional[CustomerProfile]:
+    storage = get_storage()
+    if not storage:
+        return None
+    try:
+        return storage.customer_profile(phone)
+    except Exception as e:
+        st.error(f"Ошибка загрузки истории клиента: {e}")
+        return None
+
+
+def load_all_orders():
+    """Заявки из хранилища; для Google Sheets - из локальной копии с дозагрузкой изменений"""
+    storage = get_storage()
+    if not storage:
         return pd.DataFrame()
     try:
-        sh = gc.open(SPREADSHEET_NAME)
-        worksheet = sh.worksheet(WORKSHEET_NAME_PRICE)
-        data = worksheet.get_all_records()
-        df = pd.DataFrame(data)
+        return storage.load_orders()
+    except Exception as e:
+        st.error(f"Ошибка загрузки списка заявок: {e}")
+        return pd.DataFrame()
+
+
+class PriceCatalogue:
+    """Прайс в памяти процесса с индексами НАИМЕНОВАНИЕ -> ЦЕНА и АРТИКУЛ -> НАИМЕНОВАНИЕ.
+
+    Общий для всех сессий. refresh() не чаще PRICE_REVISION_CHECK_SECONDS сверяет
+    дешёвую ревизию прайса в хранилище и перечитывает прайс целиком при её смене,
+    а также не реже PRICE_RELOAD_FALLBACK_SECONDS: контрольная сумма в листе
+    пропускает часть правок (например, обмен ценами между строками). При повторе
+    наименования действует первая строка, как и раньше.
+    Со снимком (snapshot) первый refresh() берёт прайс с диска, а ревизию
+    сверяет в фоне; каждая перезагрузка прайса сохраняется в снимок.
+    """
+
+    def __init__(self, storage: OrderStorage, snapshot: Optional[ArrowSnapshot] = None):
+        self.storage = storage
+        self.snapshot = snapshot
+        self.revision: Optional[str] = None
+        self.df = pd.DataFrame(columns=['НАИМЕНОВАНИЕ', 'ЦЕНА'])
+        self.names: List[str] = []
+        self.prices: Dict[str, float] = {}
+        self.by_sku: Dict[str, str] = {}
+        self.loaded = False
+        self._loaded_at = 0.0
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def empty(self) -> bool:
+        return not self.names
+
+    def refresh(self) -> 'PriceCatalogue':
+        # Ревизию сейчас сверяет другой поток - отдаём уже загруженный прайс без ожидания
+        if not self._lock.acquire(blocking=not self.loaded):
+            return self
+        try:
+            now = time_module.monotonic()
+            if not self.loaded and self._load_snapshot():
+                self._loaded_at = self._checked_at = now
+                threading.Thread(target=self._check_in_background, name="price-reconcile", daemon=True).start()
+                return self
+            if self.loaded and now - self._checked_at < PRICE_REVISION_CHECK_SECONDS:
+                return self
+            self._check(now)
+            return self
+        finally:
+            self._lock.release()
+
+    def _check(self, now: float):
+        revision = self.storage.price_revision()
+        self._checked_at = now
+        if self.loaded and revision == self.revision and now - self._loaded_at < PRICE_RELOAD_FALLBACK_SECONDS:
+            return
+        self._rebuild(self.storage.load_prices(), revision)
+        self._loaded_at = now
+        if self.snapshot:
+            self.snapshot.write(self.df, {'revision': revision or ""})
+
+    def _load_snapshot(self) -> bool:
+        if not self.snapshot or self.snapshot.stamp() is None:
+            return False
+        try:
+            frame, metadata, _ = self.snapshot.read()
+            self._rebuild(frame, metadata.get('revision') or None)
+        except (OSError, ValueError, pa.ArrowException):
+            return False
+        return True
+
+    def _check_in_background(self):
+        with self._lock:
+            try:
+                self._check(time_module.monotonic())
+            except Exception:
+                # Ошибку покажет следующая обычная проверка ревизии
+                self._checked_at = 0.0
+
+    def _rebuild(self, df: pd.DataFrame, revision: Optional[str]):
         if 'НАИМЕНОВАНИЕ' not in df.columns or 'ЦЕНА' not in df.columns:
-            st.error("В прайсе отсутствуют обязательные столбцы: 'НАИМЕНОВАНИЕ' или 'ЦЕНА'.")
-            return pd.DataFrame()
-        df['ЦЕНА'] = pd.to_numeric(df['ЦЕНА'], errors='coerce')
-        df.dropna(subset=['ЦЕНА'], inplace=True)
-        return df
+            raise ValueError("В прайсе отсутствуют обязательные столбцы: 'НАИМЕНОВАНИЕ' или 'ЦЕНА'.")
+        df = df.assign(НАИМЕНОВАНИЕ=df['НАИМЕНОВАНИЕ'].astype(str), ЦЕНА=pd.to_numeric(df['ЦЕНА'], errors='coerce'))
+        df = df.dropna(subset=['ЦЕНА'])
+        first = df.drop_duplicates(subset='НАИМЕНОВАНИЕ', keep='first')
+        self.df = df
+        self.names = df['НАИМЕНОВАНИЕ'].tolist()
+        self.prices = dict(zip(first['НАИМЕНОВАНИЕ'], first['ЦЕНА'].astype(float)))
+        self.by_sku = {}
+        if PRICE_SKU_HEADER in df.columns:
+            for sku, name in zip(df[PRICE_SKU_HEADER].astype(str), df['НАИМЕНОВАНИЕ']):
+                if sku:
+                    self.by_sku.setdefault(sku, name)
+        self.revision = revision
+        self.loaded = True
+
+    def price_of(self, name: str) -> Optional[float]:
+        return self.prices.get(name)
+
+    def price_of_sku(self, sku: str) -> Optional[float]:
+        name = self.by_sku.get(str(sku))
+        return self.prices.get(name) if name is not None else None
+
+
+@traced_cache(st.cache_resource, "get_price_catalogue")
+def get_price_catalogue() -> Optional[PriceCatalogue]:
+    storage = get_storage()
+    if not storage:
+        return None
+    snapshot = ArrowSnapshot(PRICE_SNAPSHOT_PATH) if PRICE_SNAPSHOT_PATH and STORAGE_BACKEND == "gsheets" else None
+    return PriceCatalogue(storage, snapshot)
+
+
+def load_price_list() -> Optional[PriceCatalogue]:
+    """Прайс, актуальный по ревизии хранилища; None - прайс недоступен"""
+    catalogue = get_price_catalogue()
+    if not catalogue:
+        return None
+    try:
+        return catalogue.refresh()
+    except ValueError as e:
+        st.error(str(e))
     except Exception as e:
         st.error(f"Ошибка загрузки прайса: {e}")
-        return pd.DataFrame()
+    # Ошибка проверки - работаем с последним загруженным прайсом, если он есть
+    return catalogue if catalogue.loaded else None
 
 
 def is_valid_phone(phone: str) -> str:
@@ -132,121 +3695,404 @@ def get_default_delivery_time():
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ (Логика приложения)
 # ================================================================
 def generate_next_order_number():
-    """Генерирует следующий номер заявки"""
+    """Номер новой заявки, закреплённый за сессией до сохранения"""
+    if st.session_state.get('reserved_order_number'):
+        return st.session_state.reserved_order_number
+    allocator = get_order_number_allocator()
+    if not allocator:
+        return str(ORDER_NUMBER_START)
+    try:
+        st.session_state.reserved_order_number = allocator.reserve()
+    except Exception as e:
+        st.error(f"Ошибка резервирования номера заявки: {e}")
+        return ""
+    return st.session_state.reserved_order_number
+
+
+def commit_order_number(order_number: str):
+    """Отмечает зарезервированный сессией номер использованным"""
+    allocator = get_order_number_allocator()
+    if allocator and st.session_state.get('reserved_order_number') == order_number:
+        allocator.commit(order_number)
+    st.session_state.reserved_order_number = None
+
+
+def release_order_number():
+    """Возвращает неиспользованный номер сессии для повторной выдачи"""
+    allocator = get_order_number_allocator()
+    if allocator and st.session_state.get('reserved_order_number'):
+        allocator.release(st.session_state.reserved_order_number)
+    st.session_state.reserved_order_number = None
+
+
+# Строка текста заказа: "Название - 2 шт. (по 1500.00 РУБ.) | комментарий"
+ORDER_ITEM_PATTERN = re.compile(r'(.+?)\s*-\s*(\d+)\s*шт\.\s*\(по\s*([\d\s,\.]+)\s*РУБ\.\)\s*(?:\|\s*(.+))?')
+# То же для разбора всех заявок сразу (str.extractall): совпадение не выходит за пределы строки
+ORDER_ITEM_LINE_PATTERN = (
+    r'(?m)^[ \t]*(?P<НАИМЕНОВАНИЕ>[^\n]+?)[ \t]*-[ \t]*(?P<КОЛИЧЕСТВО>\d+)[ \t]*шт\.[ \t]*'
+    r'\(по[ \t]*(?P<ЦЕНА_ЗА_ЕД>[\d \t,\.]+)[ \t]*РУБ\.\)[ \t]*(?:\|[ \t]*(?P<КОММЕНТАРИЙ_ПОЗИЦИИ>[^\n]+))?'
+)
+
+
+def parse_item_price(price_str: str) -> float:
+    # Убираем пробелы и заменяем запятую на точку
     try:
-        df = load_all_orders()
-        if not df.empty and 'НОМЕР_ЗАЯВКИ' in df.columns:
-            order_numbers = [int(n) for n in df['НОМЕР_ЗАЯВКИ'] if str(n).isdigit()]
-            return str(max(order_numbers) + 1) if order_numbers else "1001"
-        else:
-            return "1001"
-    except:
-        return "1001"
+        return float(price_str.replace(' ', '').replace('\t', '').replace(',', '.'))
+    except ValueError:
+        return 0.0
 
 
 def parse_order_text_to_items(order_text: str) -> List[Dict[str, Any]]:
-    """Исправленная функция разбора текста заказа - теперь корректно извлекает суммы"""
+    """Разбор текста заказа (столбец ЗАКАЗ) в позиции калькулятора - для заявок без сохранённых позиций"""
     items = []
-    
-    # Улучшенное регулярное выражение для разбора строк заказа
-    pattern = re.compile(r'(.+?)\s*-\s*(\d+)\s*шт\.\s*\(по\s*([\d\s,\.]+)\s*РУБ\.\)\s*(?:\|\s*(.+))?')
-    
     for line in order_text.split('\n'):
         line = line.strip()
         if not line:
             continue
-            
-        match = pattern.search(line)
+        match = ORDER_ITEM_PATTERN.search(line)
         if match:
-            name = match.group(1).strip()
             qty = int(match.group(2))
-            
-            # Обработка цены - убираем пробелы и заменяем запятую на точку
-            price_str = match.group(3).replace(' ', '').replace(',', '.')
-            comment = match.group(4).strip() if match.group(4) else ""
-
-
-            try:
-                price_per_unit = float(price_str)
-            except ValueError:
-                price_per_unit = 0.0
-
-
+            price_per_unit = parse_item_price(match.group(3))
             items.append({
-                'НАИМЕНОВАНИЕ': name,
+                'НАИМЕНОВАНИЕ': match.group(1).strip(),
                 'КОЛИЧЕСТВО': qty,
                 'ЦЕНА_ЗА_ЕД': price_per_unit,
-                'СУММА': price_per_unit * qty,  # Теперь сумма рассчитывается корректно
-                'КОММЕНТАРИЙ_ПОЗИЦИИ': comment
+                'СУММА': price_per_unit * qty,
+                'КОММЕНТАРИЙ_ПОЗИЦИИ': match.group(4).strip() if match.group(4) else ""
             })
-    
     return items
 
 
-def get_insert_index(new_delivery_date_str: str, orders_ws) -> int:
-    if not orders_ws:
-        return 2
-    try:
-        data_col = orders_ws.col_values(DELIVERY_DATE_COLUMN_INDEX)[1:]
-    except Exception:
-        return 2
-    if not data_col:
-        return 2
-    try:
-        new_date = datetime.strptime(new_delivery_date_str, PARSE_DATETIME_FORMAT)
-    except ValueError:
-        return 2
+def parse_order_items_frame(orders: pd.DataFrame) -> pd.DataFrame:
+    """Векторный разбор столбца ЗАКАЗ всех заявок в позиции (столбцы ORDER_ITEM_COLUMNS).
+
+    Индекс результата - позиция заявки в orders.
+    """
+    if orders.empty:
+        return pd.DataFrame(columns=ORDER_ITEM_COLUMNS)
+    texts = orders['ЗАКАЗ'].fillna('').astype(str).reset_index(drop=True)
+    found = texts.str.extractall(ORDER_ITEM_LINE_PATTERN)
+    if found.empty:
+        return pd.DataFrame(columns=ORDER_ITEM_COLUMNS)
+    numbers = orders['НОМЕР_ЗАЯВКИ'].astype(str).reset_index(drop=True)
+    prices = found['ЦЕНА_ЗА_ЕД'].str.replace(r'[ \t]', '', regex=True).str.replace(',', '.', regex=False)
+    return pd.DataFrame({
+        'НОМЕР_ЗАЯВКИ': numbers.to_numpy()[found.index.get_level_values(0)],
+        'НАИМЕНОВАНИЕ': found['НАИМЕНОВАНИЕ'].str.strip().to_numpy(),
+        'КОЛИЧЕСТВО': found['КОЛИЧЕСТВО'].astype(int).to_numpy(),
+        'ЦЕНА_ЗА_ЕД': pd.to_numeric(prices, errors='coerce').fillna(0.0).to_numpy(),
+        'КОММЕНТАРИЙ_ПОЗИЦИИ': found['КОММЕНТАРИЙ_ПОЗИЦИИ'].fillna('').str.strip().to_numpy(),
+    }, index=found.index.get_level_values(0))
+
+
+def order_item_rows(order_number: str, items: List[Dict[str, Any]]) -> List[List[Any]]:
+    """Строки позиций заказа для хранения (столбцы ORDER_ITEM_COLUMNS)"""
+    return [
+        [str(order_number), str(item['НАИМЕНОВАНИЕ']), int(item['КОЛИЧЕСТВО']),
+         float(item['ЦЕНА_ЗА_ЕД']), str(item.get('КОММЕНТАРИЙ_ПОЗИЦИИ') or "")]
+        for item in items
+    ]
+
+
+def calculator_items_from_rows(rows: List[List[Any]]) -> List[Dict[str, Any]]:
+    """Позиции калькулятора из сохранённых строк позиций"""
+    items = []
+    for _, name, qty, price, comment in (list(row)[:len(ORDER_ITEM_COLUMNS)] for row in rows):
+        qty = int(qty or 0)
+        price = parse_item_price(str(price)) if isinstance(price, str) else float(price or 0)
+        items.append({
+            'НАИМЕНОВАНИЕ': str(name),
+            'КОЛИЧЕСТВО': qty,
+            'ЦЕНА_ЗА_ЕД': price,
+            'СУММА': price * qty,
+            'КОММЕНТАРИЙ_ПОЗИЦИИ': str(comment or "")
+        })
+    return items
 
 
-    for i, date_str in enumerate(data_col):
-        try:
-            existing_date = datetime.strptime(date_str, PARSE_DATETIME_FORMAT)
-            if new_date <= existing_date:
-                return i + 2
-        except ValueError:
-            continue
+def format_order_item(item: Dict[str, Any]) -> str:
+    """Строка позиции для столбца ЗАКАЗ (с комментарием позиции)"""
+    base = f"{item['НАИМЕНОВАНИЕ']} - {item['КОЛИЧЕСТВО']} шт. (по {item['ЦЕНА_ЗА_ЕД']:.2f} РУБ.)"
+    if item.get('КОММЕНТАРИЙ_ПОЗИЦИИ'):
+        base += f" | {item['КОММЕНТАРИЙ_ПОЗИЦИИ']}"
+    return base
+
+
+def repeat_order_items(storage: OrderStorage, order: Dict[str, Any],
+                       catalogue: Optional[PriceCatalogue]) -> List[Dict[str, Any]]:
+    """Позиции заявки order для нового заказа; цена - по текущему прайсу, если позиция в нём есть"""
+    items = storage.load_order_items(order) or parse_order_text_to_items(str(order.get('ЗАКАЗ', "")))
+    repeated = []
+    for item in items:
+        price = catalogue.price_of(item['НАИМЕНОВАНИЕ']) if catalogue else None
+        price = item['ЦЕНА_ЗА_ЕД'] if price is None else price
+        repeated.append(dict(item, ЦЕНА_ЗА_ЕД=price, СУММА=price * item['КОЛИЧЕСТВО']))
+    return repeated
+
+
+def autofill_customer_address(state: MutableMapping, form_key: int, customer: CustomerProfile) -> bool:
+    """Адрес последней заявки клиента - в пустое поле адреса формы, один раз для телефона"""
+    address_key = f'address_{form_key}'
+    if state.get(address_key) or state.get('autofilled_phone') == (form_key, customer.phone):
+        return False
+    state[address_key] = str(customer.orders[0]['АДРЕС'])
+    state['autofilled_phone'] = (form_key, customer.phone)
+    return True
+
 
+def use_known_address(form_key: int):
+    """Колбэк выбора адреса из истории клиента: подставляет его в поле адреса формы"""
+    st.session_state[f'address_{form_key}'] = st.session_state[f'known_address_{form_key}']
 
-    return len(data_col) + 2
+
+def get_insert_index(new_delivery_date_str: str, date_index: Optional[DeliveryDateIndex]) -> int:
+    """Номер строки листа (с 2), перед которой вставляется заявка с указанной датой доставки"""
+    if not date_index:
+        return 2
+    new_date = parse_sheet_datetime(new_delivery_date_str)
+    if not new_date:
+        return 2
+    return date_index.insertion_position(new_date) + 2
 
 
-def save_order_data(data_row: List[Any], orders_ws) -> bool:
-    if not orders_ws:
+def save_order_data(data_row: List[Any], storage: Optional[OrderStorage],
+                    items: Optional[List[Dict[str, Any]]] = None) -> bool:
+    if not storage:
         return False
     try:
-        new_delivery_date_str = data_row[4]
-        insert_index = get_insert_index(new_delivery_date_str, orders_ws)
-        orders_ws.insert_row(data_row, index=insert_index)
-        load_all_orders.clear()
+        storage.append_order(data_row, items)
         return True
     except Exception as e:
         st.error(f"Ошибка сохранения заявки: {e}")
         return False
 
 
-def update_order_data(order_number: str, data_row: List[Any], orders_ws) -> bool:
-    if not orders_ws:
+def update_order_data(order_number: str, data_row: List[Any], storage: Optional[OrderStorage],
+                      items: Optional[List[Dict[str, Any]]] = None) -> bool:
+    if not storage:
         return False
     try:
-        col_values = orders_ws.col_values(2)
-        target_gspread_row_index = -1
-        for i in range(len(col_values) - 1, 0, -1):
-            if str(col_values[i]) == order_number:
-                target_gspread_row_index = i + 1
-                break
-        if target_gspread_row_index == -1:
+        if storage.update_order(order_number, data_row, items) == -1:
             st.error(f"Заявка с номером {order_number} не найдена в таблице.")
             return False
+        return True
+    except Exception as e:
+        st.error(f"Ошибка обновления заявки: {e}")
+        return False
 
 
-        orders_ws.update(f'A{target_gspread_row_index}:H{target_gspread_row_index}', [data_row])
-        load_all_orders.clear()
+def read_import_file(file_name: str, data: bytes) -> pd.DataFrame:
+    """Таблица импорта из CSV (разделитель определяется сам, UTF-8 или cp1251) или XLSX, значения - строками"""
+    if file_name.lower().endswith('.xlsx'):
+        frame = pd.read_excel(io.BytesIO(data), dtype=str, keep_default_na=False)
+    else:
+        try:
+            text = data.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            text = data.decode('cp1251')
+        frame = pd.read_csv(io.StringIO(text), sep=None, engine='python', dtype=str, keep_default_na=False)
+    if len(frame) > IMPORT_MAX_ROWS:
+        raise ValueError(f"В файле {len(frame)} строк, за один раз можно импортировать не больше {IMPORT_MAX_ROWS}.")
+    frame.columns = [str(column).strip().upper() for column in frame.columns]
+    return frame
+
+
+def validate_import_frame(frame: pd.DataFrame,
+                          catalogue: PriceCatalogue) -> Tuple[pd.DataFrame, List[Dict[str, Any]]]:
+    """Проверка файла импорта: отчёт по строкам и заявки, все строки которых прошли проверку"""
+    missing = [column for column in IMPORT_REQUIRED_COLUMNS if column not in frame.columns]
+    if 'НАИМЕНОВАНИЕ' not in frame.columns and PRICE_SKU_HEADER not in frame.columns:
+        missing.append(f"НАИМЕНОВАНИЕ или {PRICE_SKU_HEADER}")
+    if missing:
+        raise ValueError(f"В файле нет столбцов: {', '.join(missing)}")
+    frame = frame.reindex(columns=IMPORT_REQUIRED_COLUMNS + IMPORT_OPTIONAL_COLUMNS, fill_value="")
+    frame = frame.apply(lambda column: column.astype(str).str.strip())
+
+    delivery = parse_display_datetimes(frame['ДАТА_ДОСТАВКИ'])
+    # Даты из ячеек XLSX приходят строкой в ISO-формате
+    delivery = delivery.fillna(pd.to_datetime(frame['ДАТА_ДОСТАВКИ'], format='ISO8601', errors='coerce'))
+    quantities = pd.to_numeric(frame['КОЛИЧЕСТВО'].str.replace(',', '.'), errors='coerce')
+
+    report_rows, orders, order_of_key = [], [], {}
+    for i, row in enumerate(frame.itertuples(index=False)):
+        row = row._asdict() if hasattr(row, '_asdict') else dict(zip(frame.columns, row))
+        errors = []
+        phone = is_valid_phone(row['ТЕЛЕФОН'])
+        if not phone:
+            errors.append("телефон не в формате 7XXXXXXXXXX")
+        if not row['АДРЕС']:
+            errors.append("пустой адрес")
+        delivery_dt = delivery.iloc[i]
+        if pd.isna(delivery_dt):
+            errors.append("дата доставки не в формате ДД.ММ.ГГГГ ЧЧ:ММ")
+        qty = quantities.iloc[i]
+        if pd.isna(qty) or qty < 1 or qty != int(qty):
+            errors.append("количество должно быть целым числом от 1")
+        name = row['НАИМЕНОВАНИЕ'] or catalogue.by_sku.get(row[PRICE_SKU_HEADER], "")
+        price = catalogue.price_of(name) if name else None
+        if price is None:
+            errors.append(f"позиция «{name or row[PRICE_SKU_HEADER]}» не найдена в прайсе")
+
+        key = row['ЗАКАЗ_ID'] or (row['ТЕЛЕФОН'], row['АДРЕС'], row['ДАТА_ДОСТАВКИ'])
+        if key not in order_of_key:
+            order_of_key[key] = len(orders)
+            orders.append({
+                'phone': phone, 'address': row['АДРЕС'], 'comment': row['КОММЕНТАРИЙ'],
+                'delivery': None if pd.isna(delivery_dt) else delivery_dt.to_pydatetime(),
+                'items': [], 'rows': [], 'valid': True,
+            })
+        order = orders[order_of_key[key]]
+        if order['rows'] and (phone, row['АДРЕС']) != (order['phone'], order['address']):
+            errors.append("телефон или адрес отличаются от первой строки заявки")
+        if not errors:
+            order['items'].append({
+                'НАИМЕНОВАНИЕ': name,
+                'КОЛИЧЕСТВО': int(qty),
+                'ЦЕНА_ЗА_ЕД': price,
+                'СУММА': price * int(qty),
+                'КОММЕНТАРИЙ_ПОЗИЦИИ': row['КОММЕНТАРИЙ_ПОЗИЦИИ'],
+            })
+        order['valid'] = order['valid'] and not errors
+        order['rows'].append(len(report_rows))
+        report_rows.append({
+            'СТРОКА': i + 2, 'ЗАЯВКА': order_of_key[key] + 1, 'ТЕЛЕФОН': row['ТЕЛЕФОН'],
+            'НАИМЕНОВАНИЕ': name or row[PRICE_SKU_HEADER], 'СТАТУС': '✅' if not errors else '❌',
+            'ОШИБКА': "; ".join(errors),
+        })
+
+    # Заявка импортируется только целиком: ошибка в одной строке отклоняет и остальные её строки
+    for order in orders:
+        if not order['valid']:
+            for index in order['rows']:
+                if report_rows[index]['СТАТУС'] == '✅':
+                    report_rows[index]['СТАТУС'] = '⚠️'
+                    report_rows[index]['ОШИБКА'] = "заявка отклонена из-за ошибки в другой её строке"
+    report = pd.DataFrame(report_rows, columns=['СТРОКА', 'ЗАЯВКА', 'ТЕЛЕФОН', 'НАИМЕНОВАНИЕ', 'СТАТУС', 'ОШИБКА'])
+    return report, [order for order in orders if order['valid']]
+
+
+def import_order_rows(orders: List[Dict[str, Any]], order_numbers: List[str]) -> List[List[Any]]:
+    """Строки заявок (как из формы ввода) для проверенных заявок импорта"""
+    entry_datetime_str = datetime.now().strftime(SHEET_DATETIME_FORMAT)
+    data_rows = []
+    for order, order_number in zip(orders, order_numbers):
+        total_sum = float(sum(item['СУММА'] for item in order['items']))
+        data_rows.append([
+            entry_datetime_str, order_number, order['phone'], order['address'],
+            order['delivery'].strftime(SHEET_DATETIME_FORMAT), order['comment'],
+            "\n".join(format_order_item(item) for item in order['items']), total_sum,
+        ])
+    return data_rows
+
+
+def import_order_data(data_rows: List[List[Any]], storage: Optional[OrderStorage],
+                      items_list: List[List[Dict[str, Any]]]) -> bool:
+    if not storage:
+        return False
+    try:
+        storage.append_orders(data_rows, items_list)
         return True
     except Exception as e:
-        st.error(f"Ошибка обновления заявки: {e}")
+        st.error(f"Ошибка импорта заявок: {e}")
         return False
 
 
+def export_columns(expand_items: bool) -> List[str]:
+    """Столбцы выгрузки: как в листе ЗАЯВКИ или с позицией заказа вместо ЗАКАЗ"""
+    if not expand_items:
+        return list(EXPECTED_HEADERS)
+    return [h for h in EXPECTED_HEADERS if h != 'ЗАКАЗ'] + EXPORT_ITEM_COLUMNS
+
+
+def export_frame(chunk: pd.DataFrame, expand_items: bool) -> pd.DataFrame:
+    """Кусок заявок в столбцах и типах выгрузки; заявка без разобранных позиций - одной строкой"""
+    orders = chunk.reindex(columns=EXPECTED_HEADERS).reset_index(drop=True)
+    if expand_items:
+        items = parse_order_items_frame(orders).drop(columns='НОМЕР_ЗАЯВКИ')
+        items['СУММА_ПОЗИЦИИ'] = items['КОЛИЧЕСТВО'] * items['ЦЕНА_ЗА_ЕД']
+        orders = orders.drop(columns='ЗАКАЗ').join(items, how='left').reset_index(drop=True)
+    columns = export_columns(expand_items)
+    orders = orders.reindex(columns=columns)
+    for column in columns:
+        if column in EXPORT_FLOAT_COLUMNS:
+            orders[column] = pd.to_numeric(orders[column], errors='coerce').astype('float64')
+        elif column == 'КОЛИЧЕСТВО':
+            orders[column] = pd.to_numeric(orders[column], errors='coerce').astype('Int64')
+        else:
+            orders[column] = orders[column].fillna('').astype(str)
+    return orders
+
+
+def iter_export_frames(storage: OrderStorage, window: Optional[Tuple[datetime, datetime]],
+                       search_term: str, expand_items: bool, text_query: str = "",
+                       chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """Куски выгрузки с фильтрами списка заявок (период доставки, поиск и поиск по составу)"""
+    start, end = window or (None, None)
+    if text_query:
+        # Поиск по составу - по поддерживаемому индексу таблицы, в выгрузку идут только
+        # найденные строки; без него куски читаются из источника в обход таблицы
+        chunks = storage.iter_loaded_orders(start, end, chunk_rows, storage.search_order_text(text_query))
+    else:
+        chunks = storage.iter_orders(start, end, chunk_rows)
+    for chunk in chunks:
+        if search_term:
+            chunk = chunk[OrderSearchIndex.match_frame(chunk, search_term)]
+        if len(chunk):
+            yield export_frame(chunk, expand_items)
+
+
+def write_orders_export(frames: Iterable[pd.DataFrame], export_format: str,
+                        columns: List[str], handle: BinaryIO) -> int:
+    """Пишет куски в handle по мере чтения, возвращает число строк"""
+    rows = 0
+    if export_format == "CSV":
+        # utf-8-sig - чтобы Excel открыл кириллицу без выбора кодировки
+        text = io.TextIOWrapper(handle, encoding='utf-8-sig', newline='')
+        pd.DataFrame(columns=columns).to_csv(text, index=False)
+        for frame in frames:
+            frame.to_csv(text, header=False, index=False)
+            rows += len(frame)
+        text.flush()
+        text.detach()
+    elif export_format == "XLSX":
+        if openpyxl is None:
+            raise ImportError("Для выгрузки в XLSX нужен пакет openpyxl (pip install openpyxl).")
+        # write_only: строки уходят во временный файл openpyxl, а не держатся в памяти
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet(WORKSHEET_NAME_ORDERS)
+        sheet.append(columns)
+        for frame in frames:
+            rows += len(frame)
+            if rows >= XLSX_MAX_ROWS:
+                raise ValueError(f"В XLSX помещается не больше {XLSX_MAX_ROWS - 1} строк - выберите CSV или Parquet.")
+            for row in frame.astype(object).where(frame.notna(), None).itertuples(index=False, name=None):
+                sheet.append(row)
+        workbook.save(handle)
+    else:
+        schema = pa.schema([
+            (column, pa.float64() if column in EXPORT_FLOAT_COLUMNS
+             else pa.int64() if column == 'КОЛИЧЕСТВО' else pa.string())
+            for column in columns
+        ])
+        # Каждый кусок - отдельная группа строк Parquet
+        with pq.ParquetWriter(handle, schema) as writer:
+            for frame in frames:
+                writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+                rows += len(frame)
+    return rows
+
+
+def export_orders_file(storage: OrderStorage, export_format: str, window: Optional[Tuple[datetime, datetime]],
+                       search_term: str, expand_items: bool, text_query: str = "") -> BinaryIO:
+    """Файл выгрузки во временном файле на диске (вызывается при нажатии кнопки скачивания)"""
+    handle = tempfile.TemporaryFile()
+    with tracer.span("export.build"):
+        write_orders_export(iter_export_frames(storage, window, search_term, expand_items, text_query),
+                            export_format, export_columns(expand_items), handle)
+    handle.seek(0)
+    return handle
+
+
 def generate_whatsapp_url(target_phone: str, order_data: Dict[str, str], total_sum: float) -> str:
     text = "Здравствуйте! Пожалуйста, проверьте детали вашего заказа:\\n\\n"
     text += f"Номер Заявки: {order_data['НОМЕР_ЗАЯВКИ']}\\n"
@@ -271,555 +4117,650 @@ def generate_whatsapp_url(target_phone: str, order_data: Dict[str, str], total_s
     return f"https://wa.me/{target_phone_final}?text={encoded_text}"
 
 
-def format_datetime_for_display(dt_str):
-    """Форматирует дату-время для отображения"""
+def parse_display_datetimes(values: pd.Series) -> pd.Series:
+    """Векторный разбор дат: формат сохранения, затем альтернативный без секунд (NaT - не распознана)"""
+    text = values.astype(str)
+    parsed = pd.to_datetime(text, format=PARSE_DATETIME_FORMAT, errors='coerce')
+    missing = parsed.isna()
+    if missing.any():
+        parsed = parsed.where(~missing, pd.to_datetime(text.where(missing), format='%d.%m.%Y %H:%M', errors='coerce'))
+    return parsed
+
+
+def format_datetimes_for_display(values: pd.Series, parsed: Optional[pd.Series] = None) -> pd.Series:
+    """Форматирует столбец дат-времени для отображения; нераспознанные значения остаются как есть"""
+    if parsed is None:
+        parsed = parse_display_datetimes(values)
+    return parsed.dt.strftime(DISPLAY_DATE_FORMAT).where(parsed.notna(), values.fillna('').astype(str))
+
+
+def prepare_orders_display(_orders_df: pd.DataFrame) -> pd.DataFrame:
+    """Таблица для вкладки «Список Заявок», отсортированная по дате доставки"""
+    df = pd.DataFrame({
+        'НОМЕР_ЗАЯВКИ': _orders_df['НОМЕР_ЗАЯВКИ'].astype(str),
+        'ТЕЛЕФОН': _orders_df['ТЕЛЕФОН'].astype(str),
+        'АДРЕС': _orders_df['АДРЕС'].astype(str),
+        'КОММЕНТАРИЙ': _orders_df['КОММЕНТАРИЙ'],
+        'ЗАКАЗ': _orders_df['ЗАКАЗ'].fillna('').astype(str).str.replace('\n', '<br>', regex=False),
+        'СУММА': pd.to_numeric(_orders_df['СУММА'], errors='coerce').fillna(0),
+    })
+    delivery_dt = parse_display_datetimes(_orders_df['ДАТА_ДОСТАВКИ'])
+    df['ДАТА_ВВОДА_ОТОБРАЖЕНИЕ'] = format_datetimes_for_display(_orders_df['ДАТА_ВВОДА'])
+    df['ДАТА_ДОСТАВКИ_ОТОБРАЖЕНИЕ'] = format_datetimes_for_display(_orders_df['ДАТА_ДОСТАВКИ'], delivery_dt)
+    df['ДАТА_ДОСТАВКИ_DT'] = delivery_dt
+    return df.sort_values(by='ДАТА_ДОСТАВКИ_DT', ascending=True, kind='stable')
+
+
+@traced_cache(st.cache_resource, "build_orders_display", max_entries=4, show_spinner=False)
+def build_orders_display(cache_key: Tuple, _orders_df: pd.DataFrame) -> pd.DataFrame:
+    """prepare_orders_display с кэшем по ключу (версия данных, окно дат).
+
+    Результат общий для всех сессий и не должен изменяться на месте.
+    """
+    return prepare_orders_display(_orders_df)
+
+
+def delivery_period_bounds(period_days: int, today: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    """Интервал [начало сегодняшнего дня, начало дня через period_days)"""
+    start = datetime.combine((today or datetime.now()).date(), time(0, 0))
+    return start, start + timedelta(days=period_days)
+
+
+def traced_fragment(name: str):
+    """st.fragment с ключом name; перезапуск одного фрагмента замеряется как tracer.rerun().
+
+    В составе перезапуска страницы фрагмент замеряют участки main.tab_*.
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            if tracer.in_rerun():
+                return fn(*args, **kwargs)
+            with tracer.rerun(f"fragment.{name}"):
+                return fn(*args, **kwargs)
+        return st.fragment(run, key=name)
+    return decorate
+
+
+def rerun_fragment():
+    """Перезапуск текущего фрагмента; если он выполнялся в составе всей страницы - всей страницы"""
     try:
-        # Пробуем распарсить в формате сохранения
-        dt = datetime.strptime(dt_str, PARSE_DATETIME_FORMAT)
-        return dt.strftime(DISPLAY_DATE_FORMAT)
-    except ValueError:
-        try:
-            # Пробуем альтернативный формат, если основной не сработал
-            dt = datetime.strptime(dt_str, '%d.%m.%Y %H:%M')
-            return dt.strftime(DISPLAY_DATE_FORMAT)
-        except ValueError:
-            # Если не удалось распарсить, возвращаем исходную строку
-            return dt_str
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
 
 
-# ================================================================
-# ОСНОВНАЯ ЛОГИКА ПРИЛОЖЕНИЯ
-# ================================================================
+@traced_fragment("order_entry")
+def render_order_entry():
+    """Вкладка ввода/редактирования заявки: кнопки калькулятора и поиска перезапускают только её"""
+    storage = get_storage()
+    price_catalogue = load_price_list()
+    price_loaded = bool(price_catalogue and not price_catalogue.empty)
+    price_items = ["--- Выберите позицию ---"] + price_catalogue.names if price_loaded else ["--- Прайс не загружен ---"]
 
+    st.subheader("Выбор Режима Работы")
+    mode = st.radio(
+        "Выберите действие:",
+        ['Новая заявка', 'Редактировать существующую'],
+        horizontal=True,
+        key='mode_selector'
+    )
 
-def main():
-    # Инициализация основного состояния
-    if 'app_mode' not in st.session_state:
+
+    # Логика переключения режимов
+    if mode == 'Новая заявка' and st.session_state.app_mode != 'new':
         st.session_state.app_mode = 'new'
-    if 'calculator_items' not in st.session_state:
         st.session_state.calculator_items = []
-    if 'last_success_message' not in st.session_state:
-        st.session_state.last_success_message = None
-    if 'form_reset_trigger' not in st.session_state:
-        st.session_state.form_reset_trigger = False
-    if 'loaded_order_data' not in st.session_state:
         st.session_state.loaded_order_data = None
-    if 'form_key' not in st.session_state:
-        st.session_state.form_key = 0
-
-
-    # Обработка сброса формы
-    if st.session_state.form_reset_trigger:
-        st.session_state.form_reset_trigger = False
-        # Устанавливаем значения по умолчанию для новой формы
-        st.session_state.app_mode = 'new'
+        st.session_state.form_key += 1
+        rerun_fragment()
+    elif mode == 'Редактировать существующую' and st.session_state.app_mode != 'edit':
+        release_order_number()
+        st.session_state.app_mode = 'edit'
         st.session_state.calculator_items = []
-        st.session_state.last_success_message = None
         st.session_state.loaded_order_data = None
-        st.session_state.form_key += 1  # Изменяем ключ формы для принудительного сброса
-        st.rerun()
-
-
-    # Загрузка данных
-    price_df = load_price_list()
-    orders_ws = get_orders_worksheet()
-
-
-    price_items = ["--- Выберите позицию ---"] + price_df['НАИМЕНОВАНИЕ'].tolist() if not price_df.empty else ["--- Прайс не загружен ---"]
-    
-    st.title("CRM: Управление Заявками ▼")
+        st.session_state.form_key += 1
+        rerun_fragment()
 
 
-    # Обработка успешного сообщения
-    if st.session_state.last_success_message:
-        st.success(st.session_state.last_success_message)
-        st.session_state.last_success_message = None
-
-
-    # ---
-    # ГЛАВНОЕ РАЗДЕЛЕНИЕ НА ВКЛАДКИ
-    # ---
-    tab_order_entry, tab_order_list = st.tabs(['📝 Ввод/Редактирование Заявки', '📋 Список Заявок'])
+    st.info("--- **Режим Создания Новой Заявки** ---" if st.session_state.app_mode == 'new' else "▶ **Режим Редактирования/Перезаписи** ---")
 
 
     # ---
-    # ВКЛАДКА 1: ВВОД/РЕДАКТИРОВАНИЕ ЗАЯВКИ
+    # ПОИСК СУЩЕСТВУЮЩЕЙ ЗАЯВКИ
     # ---
-    with tab_order_entry:
-        st.subheader("Выбор Режима Работы")
-        mode = st.radio(
-            "Выберите действие:",
-            ['Новая заявка', 'Редактировать существующую'],
-            horizontal=True,
-            key='mode_selector'
-        )
-
-
-        # Логика переключения режимов
-        if mode == 'Новая заявка' and st.session_state.app_mode != 'new':
-            st.session_state.app_mode = 'new'
-            st.session_state.calculator_items = []
-            st.session_state.loaded_order_data = None
-            st.session_state.form_key += 1
-            st.rerun()
-        elif mode == 'Редактировать существующую' and st.session_state.app_mode != 'edit':
-            st.session_state.app_mode = 'edit'
-            st.session_state.calculator_items = []
-            st.session_state.loaded_order_data = None
-            st.session_state.form_key += 1
-            st.rerun()
-
-
-        st.info("--- **Режим Создания Новой Заявки** ---" if st.session_state.app_mode == 'new' else "▶ **Режим Редактирования/Перезаписи** ---")
-
-
-        # ---
-        # ПОИСК СУЩЕСТВУЮЩЕЙ ЗАЯВКИ
-        # ---
-        if st.session_state.app_mode == 'edit':
-            st.subheader("Поиск заявки для редактирования")
-            search_number = st.text_input("Введите номер заявки для поиска:", key='search_input')
-            if st.button("🔍 Найти и загрузить заявку", use_container_width=True):
-                if search_number and orders_ws:
-                    try:
-                        df = load_all_orders()
-                        target_rows = df[df['НОМЕР_ЗАЯВКИ'].astype(str) == search_number]
-                        if not target_rows.empty:
-                            row = target_rows.iloc[-1].to_dict()
-
-
-                            # Сохраняем данные найденной заявки в session_state
-                            st.session_state.loaded_order_data = {
-                                'order_number': str(row.get('НОМЕР_ЗАЯВКИ', "")),
-                                'client_phone': str(row.get('ТЕЛЕФОН', "")),
-                                'address': str(row.get('АДРЕС', "")),
-                                'comment': str(row.get('КОММЕНТАРИЙ', "")),
-                                'calculator_items': parse_order_text_to_items(str(row.get('ЗАКАЗ', "")))
-                            }
-
-
-                            # Обработка даты доставки
-                            delivery_dt_str = str(row.get('ДАТА_ДОСТАВКИ', ""))
-                            try:
-                                dt_obj = datetime.strptime(delivery_dt_str, PARSE_DATETIME_FORMAT)
-                                st.session_state.loaded_order_data['delivery_date'] = dt_obj.date()
-                                st.session_state.loaded_order_data['delivery_time'] = dt_obj.time()
-                            except (ValueError, TypeError):
-                                st.session_state.loaded_order_data['delivery_date'] = get_default_delivery_date()
-                                st.session_state.loaded_order_data['delivery_time'] = get_default_delivery_time()
-
-
-                            # Загружаем товары в калькулятор
-                            st.session_state.calculator_items = st.session_state.loaded_order_data['calculator_items']
-                            st.session_state.form_key += 1  # Изменяем ключ формы для принудительного обновления
-
-
-                            st.success(f"✔️ Заявка №{search_number} загружена для редактирования.")
-                            st.rerun()
-                        else:
-                            st.error(f"❌ Заявка с номером {search_number} не найдена")
-                    except Exception as e:
-                        st.error(f"Ошибка при загрузке заявки: {e}")
-                else:
-                    st.error("Введите номер заявки")
-            st.markdown("---")
+    if st.session_state.app_mode == 'edit':
+        st.subheader("Поиск заявки для редактирования")
+        search_number = st.text_input("Введите номер заявки для поиска:", key='search_input')
+        if st.button("🔍 Найти и загрузить заявку", use_container_width=True):
+            if search_number and storage:
+                try:
+                    row = storage.find_order(search_number)
+                    if row is not None:
+                        # Сохраняем данные найденной заявки в session_state
+                        st.session_state.loaded_order_data = {
+                            'order_number': str(row.get('НОМЕР_ЗАЯВКИ', "")),
+                            'client_phone': str(row.get('ТЕЛЕФОН', "")),
+                            'address': str(row.get('АДРЕС', "")),
+                            'comment': str(row.get('КОММЕНТАРИЙ', "")),
+                            'calculator_items': (storage.load_order_items(row)
+                                                 or parse_order_text_to_items(str(row.get('ЗАКАЗ', ""))))
+                        }
+
+
+                        # Обработка даты доставки
+                        delivery_dt_str = str(row.get('ДАТА_ДОСТАВКИ', ""))
+                        try:
+                            dt_obj = datetime.strptime(delivery_dt_str, PARSE_DATETIME_FORMAT)
+                            st.session_state.loaded_order_data['delivery_date'] = dt_obj.date()
+                            st.session_state.loaded_order_data['delivery_time'] = dt_obj.time()
+                        except (ValueError, TypeError):
+                            st.session_state.loaded_order_data['delivery_date'] = get_default_delivery_date()
+                            st.session_state.loaded_order_data['delivery_time'] = get_default_delivery_time()
+
+
+                        # Загружаем товары в калькулятор
+                        st.session_state.calculator_items = st.session_state.loaded_order_data['calculator_items']
+                        st.session_state.form_key += 1  # Изменяем ключ формы для принудительного обновления
+
+
+                        st.success(f"✔️ Заявка №{search_number} загружена для редактирования.")
+                        rerun_fragment()
+                    else:
+                        st.error(f"❌ Заявка с номером {search_number} не найдена")
+                except Exception as e:
+                    st.error(f"Ошибка при загрузке заявки: {e}")
+            else:
+                st.error("Введите номер заявки")
+        st.markdown("---")
 
 
-        # ================================================================
-        # ОСНОВНАЯ ФОРМА (ИСПРАВЛЕННАЯ ВЕРСИЯ)
-        # ================================================================
-        st.subheader("Основные Данные Заявки")
+    # ================================================================
+    # ОСНОВНАЯ ФОРМА (ИСПРАВЛЕННАЯ ВЕРСИЯ)
+    # ================================================================
+    st.subheader("Основные Данные Заявки")
 
 
-        # Используем ключ формы для принудительного обновления виджетов
-        form_key = st.session_state.form_key
+    # Используем ключ формы для принудительного обновления виджетов
+    form_key = st.session_state.form_key
 
 
-        # Определяем начальные значения для полей формы
-        if st.session_state.app_mode == 'new':
-            default_order_number = generate_next_order_number()
+    # Определяем начальные значения для полей формы
+    if st.session_state.app_mode == 'new':
+        default_order_number = generate_next_order_number()
+        default_client_phone = ""
+        default_address = ""
+        default_comment = ""
+        default_delivery_date = get_default_delivery_date()
+        default_delivery_time = get_default_delivery_time()
+    else:
+        # В режиме редактирования используем данные из загруженной заявки или пустые значения
+        if st.session_state.loaded_order_data:
+            default_order_number = st.session_state.loaded_order_data.get('order_number', "")
+            default_client_phone = st.session_state.loaded_order_data.get('client_phone', "")
+            default_address = st.session_state.loaded_order_data.get('address', "")
+            default_comment = st.session_state.loaded_order_data.get('comment', "")
+            default_delivery_date = st.session_state.loaded_order_data.get('delivery_date', get_default_delivery_date())
+            default_delivery_time = st.session_state.loaded_order_data.get('delivery_time', get_default_delivery_time())
+        else:
+            default_order_number = ""
             default_client_phone = ""
             default_address = ""
             default_comment = ""
             default_delivery_date = get_default_delivery_date()
             default_delivery_time = get_default_delivery_time()
-        else:
-            # В режиме редактирования используем данные из загруженной заявки или пустые значения
-            if st.session_state.loaded_order_data:
-                default_order_number = st.session_state.loaded_order_data.get('order_number', "")
-                default_client_phone = st.session_state.loaded_order_data.get('client_phone', "")
-                default_address = st.session_state.loaded_order_data.get('address', "")
-                default_comment = st.session_state.loaded_order_data.get('comment', "")
-                default_delivery_date = st.session_state.loaded_order_data.get('delivery_date', get_default_delivery_date())
-                default_delivery_time = st.session_state.loaded_order_data.get('delivery_time', get_default_delivery_time())
-            else:
-                default_order_number = ""
-                default_client_phone = ""
-                default_address = ""
-                default_comment = ""
-                default_delivery_date = get_default_delivery_date()
-                default_delivery_time = get_default_delivery_time()
-
-
-        col1, col2 = st.columns(2)
-        col3, col4 = st.columns(2)
 
 
-        with col1:
-            if st.session_state.app_mode == 'new':
-                order_number = st.text_input(
-                    "Номер Заявки",
-                    value=default_order_number,
-                    disabled=True,
-                    key=f'display_order_number_{form_key}'
-                )
-            else:
-                order_number = st.text_input(
-                    "Номер Заявки",
-                    value=default_order_number,
-                    key=f'order_number_edit_{form_key}'
-                )
+    col1, col2 = st.columns(2)
+    col3, col4 = st.columns(2)
 
 
-        with col2:
-            client_phone = st.text_input(
-                "Телефон Клиента (с 7)",
-                value=default_client_phone,
-                key=f'client_phone_{form_key}'
+    with col1:
+        if st.session_state.app_mode == 'new':
+            order_number = st.text_input(
+                "Номер Заявки",
+                value=default_order_number,
+                disabled=True,
+                key=f'display_order_number_{form_key}'
             )
-
-
-        # -- Поля для даты и времени --
-        with col3:
-            delivery_date = st.date_input(
-                "Дата Доставки",
-                value=default_delivery_date,
-                min_value=datetime.today().date(),
-                key=f'delivery_date_{form_key}',
-                format="DD.MM.YYYY"
+        else:
+            order_number = st.text_input(
+                "Номер Заявки",
+                value=default_order_number,
+                key=f'order_number_edit_{form_key}'
             )
 
 
-        with col4:
-            delivery_time = st.time_input(
-                "Время Доставки (интервал 30 мин)",
-                value=default_delivery_time,
-                step=TIME_STEP_SECONDS,
-                key=f'delivery_time_{form_key}'
-            )
+    with col2:
+        client_phone = st.text_input(
+            "Телефон Клиента (с 7)",
+            value=default_client_phone,
+            key=f'client_phone_{form_key}'
+        )
 
 
-        # -- Поле адреса и комментария --
-        address = st.text_input(
-            "Адрес Доставки",
-            value=default_address,
-            key=f'address_{form_key}'
+    # -- Поля для даты и времени --
+    with col3:
+        delivery_date = st.date_input(
+            "Дата Доставки",
+            value=default_delivery_date,
+            min_value=datetime.today().date(),
+            key=f'delivery_date_{form_key}',
+            format="DD.MM.YYYY"
         )
 
 
-        comment = st.text_area(
-            "Комментарий / Примечание к заказу (общий)",
-            value=default_comment,
-            height=50,
-            key=f'comment_{form_key}'
+    with col4:
+        delivery_time = st.time_input(
+            "Время Доставки (интервал 30 мин)",
+            value=default_delivery_time,
+            step=TIME_STEP_SECONDS,
+            key=f'delivery_time_{form_key}'
         )
 
 
-        st.markdown("---")
-
+    # -- Загрузка выбранного слота доставки --
+    delivery_datetime = datetime.combine(delivery_date, delivery_time)
+    slot_refused = False
+    occupancy = load_slot_occupancy() if SLOT_CAPACITY else None
+    if occupancy:
+        loaded = st.session_state.loaded_order_data if st.session_state.app_mode == 'edit' else None
+        edited_datetime = datetime.combine(loaded['delivery_date'], loaded['delivery_time']) \
+            if loaded and loaded.get('delivery_date') else None
+        taken, slot_full, slot_refused = check_delivery_slot(occupancy, delivery_datetime, edited_datetime)
+        full_slots = [slot_label(slot) for slot in occupancy.full_slots(delivery_date, SLOT_CAPACITY)]
+        if slot_full:
+            message = f"Слот {slot_label(delivery_slot(delivery_datetime))} заполнен: {taken} заявок при лимите {SLOT_CAPACITY}."
+            if slot_refused:
+                st.error(f"⛔ {message} Выберите другое время.")
+            else:
+                st.warning(f"⚠️ {message}")
+        else:
+            st.caption(f"🚚 В слоте {slot_label(delivery_slot(delivery_datetime))}: {taken} из {SLOT_CAPACITY}, "
+                       f"свободно {SLOT_CAPACITY - taken}.")
+        if full_slots:
+            st.caption(f"Заполненные слоты на {delivery_date.strftime('%d.%m.%Y')}: {', '.join(full_slots)}")
+
+
+    # -- Постоянный клиент: история по телефону --
+    # Значение поля адреса живёт только в session_state: автоподстановка и выбор
+    # адреса из истории пишут туда же, поэтому value= у виджета не передаётся
+    address_key = f'address_{form_key}'
+    if address_key not in st.session_state:
+        st.session_state[address_key] = default_address
+    customer = None
+    if st.session_state.app_mode == 'new' and is_valid_phone(client_phone):
+        customer = load_customer_profile(is_valid_phone(client_phone))
+    if customer:
+        autofill_customer_address(st.session_state, form_key, customer)
+        with st.expander(f"👤 Постоянный клиент: заявок {customer.order_count}", expanded=True):
+            if len(customer.addresses) > 1:
+                st.selectbox(
+                    "Адрес из истории:", customer.addresses, index=None, placeholder="Выберите адрес",
+                    key=f'known_address_{form_key}', on_change=use_known_address, args=(form_key,)
+                )
+            if customer.items:
+                st.caption("Часто заказывает: " + ", ".join(f"{name} ({count})" for name, count in customer.items))
+            st.dataframe(
+                pd.DataFrame(customer.orders, columns=['НОМЕР_ЗАЯВКИ', 'ДАТА_ДОСТАВКИ', 'АДРЕС', 'ЗАКАЗ', 'СУММА']),
+                column_config={
+                    "НОМЕР_ЗАЯВКИ": "№ Заявки",
+                    "ДАТА_ДОСТАВКИ": st.column_config.TextColumn("🚚 Доставка"),
+                    "АДРЕС": st.column_config.TextColumn("📍 Адрес"),
+                    "ЗАКАЗ": st.column_config.TextColumn("📦 Состав Заказа", width="large"),
+                    "СУММА": st.column_config.NumberColumn("💰 Сумма", format="%.2f РУБ."),
+                },
+                hide_index=True,
+                use_container_width=True,
+            )
+            if st.button("🔁 Повторить последний заказ", use_container_width=True, key=f'repeat_order_{form_key}',
+                         help="Позиции последней заявки по текущему прайсу"):
+                st.session_state.calculator_items = repeat_order_items(storage, customer.orders[0], price_catalogue)
+                rerun_fragment()
 
-        # ================================================================
-        # КАЛЬКУЛЯТОР ЗАКАЗА
-        # ================================================================
-        st.subheader("Состав Заказа (Калькулятор)")
 
+    # -- Поле адреса и комментария --
+    address = st.text_input(
+        "Адрес Доставки",
+        key=address_key
+    )
 
-        # Используем временные переменные вместо прямого изменения session_state
-        current_qty = 1
-        current_comment = ""
-        
-        col_item, col_qty = st.columns([5, 1])
-        with col_item:
-            selected_item = st.selectbox(
-                "Выбор позиции",
-                price_items,
-                disabled=price_df.empty,
-                key=f'item_selector_{form_key}'
-            )
-        with col_qty:
-            current_qty = st.number_input(
-                "Кол-во",
-                min_value=1,
-                step=1,
-                value=1,
-                key=f'item_qty_{form_key}'
-            )
 
+    comment = st.text_area(
+        "Комментарий / Примечание к заказу (общий)",
+        value=default_comment,
+        height=50,
+        key=f'comment_{form_key}'
+    )
 
-        # ПОЛЕ КОММЕНТАРИЯ К ПОЗИЦИИ
-        col_comment, col_add = st.columns([5, 1])
-        with col_comment:
-            current_comment = st.text_input(
-                "Комментарий к позиции",
-                value="",
-                key=f'item_comment_{form_key}'
-            )
 
+    st.markdown("---")
 
-        with col_add:
-            st.markdown(" ")
-            if st.button(
-                "➕ Добавить",
-                use_container_width=True,
-                disabled=selected_item == price_items[0],
-                key=f'add_item_button_{form_key}'
-            ):
-                if selected_item != price_items[0]:
-                    price_row = price_df[price_df['НАИМЕНОВАНИЕ'] == selected_item]
-                    if not price_row.empty:
-                        price = float(price_row.iloc[0]['ЦЕНА'])
-                        
-                        st.session_state.calculator_items.append({
-                            'НАИМЕНОВАНИЕ': selected_item,
-                            'КОЛИЧЕСТВО': current_qty,
-                            'ЦЕНА_ЗА_ЕД': price,
-                            'СУММА': price * current_qty,
-                            'КОММЕНТАРИЙ_ПОЗИЦИИ': current_comment
-                        })
-                        st.rerun()
 
+    # ================================================================
+    # КАЛЬКУЛЯТОР ЗАКАЗА
+    # ================================================================
+    st.subheader("Состав Заказа (Калькулятор)")
 
-        # Отображение товаров
-        total_sum = 0
-        if st.session_state.calculator_items:
-            df_items = pd.DataFrame(st.session_state.calculator_items)
-            total_sum = df_items['СУММА'].sum()
 
+    # Используем временные переменные вместо прямого изменения session_state
+    current_qty = 1
+    current_comment = ""
 
-            st.dataframe(
-                df_items[['НАИМЕНОВАНИЕ', 'КОЛИЧЕСТВО', 'ЦЕНА_ЗА_ЕД', 'КОММЕНТАРИЙ_ПОЗИЦИИ', 'СУММА']],
-                column_config={
-                    'НАИМЕНОВАНИЕ': 'Товар',
-                    'КОЛИЧЕСТВО': 'Кол-во',
-                    'ЦЕНА_ЗА_ЕД': st.column_config.NumberColumn("Цена за ед.", format="%.2f РУБ."),
-                    'КОММЕНТАРИЙ_ПОЗИЦИИ': 'Комментарий',
-                    'СУММА': st.column_config.NumberColumn("Сумма", format="%.2f РУБ."),
-                },
-                hide_index=True,
-                use_container_width=True
-            )
+    col_item, col_qty = st.columns([5, 1])
+    with col_item:
+        selected_item = st.selectbox(
+            "Выбор позиции",
+            price_items,
+            disabled=not price_loaded,
+            key=f'item_selector_{form_key}'
+        )
+    with col_qty:
+        current_qty = st.number_input(
+            "Кол-во",
+            min_value=1,
+            step=1,
+            value=1,
+            key=f'item_qty_{form_key}'
+        )
 
 
-        # Удаление позиций
-        st.markdown("#### Удаление позиций:")
-        for i in range(len(st.session_state.calculator_items) - 1, -1, -1):
-            item = st.session_state.calculator_items[i]
-            col_name, col_comment_text, col_sum, col_del = st.columns([4, 2, 1.5, 0.5])
-            with col_name:
-                st.write(f"**{item['НАИМЕНОВАНИЕ']}** ({item['КОЛИЧЕСТВО']} шт.)")
-            with col_comment_text:
-                if item['КОММЕНТАРИЙ_ПОЗИЦИИ']:
-                    st.markdown(f"*{item['КОММЕНТАРИЙ_ПОЗИЦИИ']}*")
-                else:
-                    st.write("-")
-            with col_sum:
-                st.write(f"**{item['СУММА']:.2f} РУБ.**")
-            with col_del:
-                if st.button("✗", key=f"del_{i}_{form_key}"):
-                    st.session_state.calculator_items.pop(i)
-                    st.rerun()
+    # ПОЛЕ КОММЕНТАРИЯ К ПОЗИЦИИ
+    col_comment, col_add = st.columns([5, 1])
+    with col_comment:
+        current_comment = st.text_input(
+            "Комментарий к позиции",
+            value="",
+            key=f'item_comment_{form_key}'
+        )
 
 
-        st.markdown(f"### 💰 **ИТОГО: {total_sum:.2f} РУБ.**")
-        
-        if not st.session_state.calculator_items:
-            st.info("В заказе пока нет позиций. Добавьте товар.")
-        st.markdown("---")
+    with col_add:
+        st.markdown(" ")
+        if st.button(
+            "➕ Добавить",
+            use_container_width=True,
+            disabled=selected_item == price_items[0],
+            key=f'add_item_button_{form_key}'
+        ):
+            if selected_item != price_items[0]:
+                price = price_catalogue.price_of(selected_item)
+                if price is not None:
+
+                    st.session_state.calculator_items.append({
+                        'НАИМЕНОВАНИЕ': selected_item,
+                        'КОЛИЧЕСТВО': current_qty,
+                        'ЦЕНА_ЗА_ЕД': price,
+                        'СУММА': price * current_qty,
+                        'КОММЕНТАРИЙ_ПОЗИЦИИ': current_comment
+                    })
+                    rerun_fragment()
+
+
+    # Отображение товаров
+    total_sum = 0
+    if st.session_state.calculator_items:
+        df_items = pd.DataFrame(st.session_state.calculator_items)
+        total_sum = df_items['СУММА'].sum()
+
+
+        st.dataframe(
+            df_items[['НАИМЕНОВАНИЕ', 'КОЛИЧЕСТВО', 'ЦЕНА_ЗА_ЕД', 'КОММЕНТАРИЙ_ПОЗИЦИИ', 'СУММА']],
+            column_config={
+                'НАИМЕНОВАНИЕ': 'Товар',
+                'КОЛИЧЕСТВО': 'Кол-во',
+                'ЦЕНА_ЗА_ЕД': st.column_config.NumberColumn("Цена за ед.", format="%.2f РУБ."),
+                'КОММЕНТАРИЙ_ПОЗИЦИИ': 'Комментарий',
+                'СУММА': st.column_config.NumberColumn("Сумма", format="%.2f РУБ."),
+            },
+            hide_index=True,
+            use_container_width=True
+        )
 
 
-        # ================================================================
-        # СОХРАНЕНИЕ ДАННЫХ
-        # ================================================================
-        st.subheader("Завершение Заявки")
+    # Удаление позиций
+    st.markdown("#### Удаление позиций:")
+    for i in range(len(st.session_state.calculator_items) - 1, -1, -1):
+        item = st.session_state.calculator_items[i]
+        col_name, col_comment_text, col_sum, col_del = st.columns([4, 2, 1.5, 0.5])
+        with col_name:
+            st.write(f"**{item['НАИМЕНОВАНИЕ']}** ({item['КОЛИЧЕСТВО']} шт.)")
+        with col_comment_text:
+            if item['КОММЕНТАРИЙ_ПОЗИЦИИ']:
+                st.markdown(f"*{item['КОММЕНТАРИЙ_ПОЗИЦИИ']}*")
+            else:
+                st.write("-")
+        with col_sum:
+            st.write(f"**{item['СУММА']:.2f} РУБ.**")
+        with col_del:
+            if st.button("✗", key=f"del_{i}_{form_key}"):
+                st.session_state.calculator_items.pop(i)
+                rerun_fragment()
 
 
-        # Проверяем валидность телефона
-        valid_phone = is_valid_phone(client_phone)
+    st.markdown(f"### 💰 **ИТОГО: {total_sum:.2f} РУБ.**")
 
+    if not st.session_state.calculator_items:
+        st.info("В заказе пока нет позиций. Добавьте товар.")
+    st.markdown("---")
 
-        # Проверяем готовность к отправке
-        is_ready_to_send = (
-            order_number and
-            valid_phone and
-            address and
-            st.session_state.calculator_items
-        )
-        
-        if not is_ready_to_send:
-            missing_fields = []
-            if not order_number:
-                missing_fields.append("Номер Заявки")
-            if not client_phone:
-                missing_fields.append("Телефон Клиента")
-            elif not valid_phone:
-                missing_fields.append("Телефон (неверный формат 7XXXXXXXXXX)")
-            if not address:
-                missing_fields.append("Адрес Доставки")
-            if not st.session_state.calculator_items:
-                missing_fields.append("Состав Заказа")
 
+    # ================================================================
+    # СОХРАНЕНИЕ ДАННЫХ
+    # ================================================================
+    st.subheader("Завершение Заявки")
+
+
+    # Проверяем валидность телефона
+    valid_phone = is_valid_phone(client_phone)
+
+
+    # Проверяем готовность к отправке
+    is_ready_to_send = (
+        order_number and
+        valid_phone and
+        address and
+        st.session_state.calculator_items and
+        not slot_refused
+    )
+
+    if not is_ready_to_send:
+        missing_fields = []
+        if not order_number:
+            missing_fields.append("Номер Заявки")
+        if not client_phone:
+            missing_fields.append("Телефон Клиента")
+        elif not valid_phone:
+            missing_fields.append("Телефон (неверный формат 7XXXXXXXXXX)")
+        if not address:
+            missing_fields.append("Адрес Доставки")
+        if not st.session_state.calculator_items:
+            missing_fields.append("Состав Заказа")
+        if slot_refused:
+            missing_fields.append("Время Доставки (слот заполнен)")
 
-            if missing_fields:
-                st.error(f"❌ Заявка не готова к сохранению! Необходимо заполнить: {', '.join(missing_fields)}")
 
+        if missing_fields:
+            st.error(f"❌ Заявка не готова к сохранению! Необходимо заполнить: {', '.join(missing_fields)}")
 
-        # Подготовка данных (Форматирование заказа с комментарием позиции)
-        def format_order_item(item):
-            base = f"{item['НАИМЕНОВАНИЕ']} - {item['КОЛИЧЕСТВО']} шт. (по {item['ЦЕНА_ЗА_ЕД']:.2f} РУБ.)"
-            if item.get('КОММЕНТАРИЙ_ПОЗИЦИИ'):
-                base += f" | {item['КОММЕНТАРИЙ_ПОЗИЦИИ']}"
-            return base
 
+    # Подготовка данных (Форматирование заказа с комментарием позиции)
+    order_details = "\n".join([format_order_item(item) for item in st.session_state.calculator_items])
 
-        order_details = "\n".join([format_order_item(item) for item in st.session_state.calculator_items])
 
+    entry_datetime = datetime.now()
+    entry_datetime_str = entry_datetime.strftime(SHEET_DATETIME_FORMAT)
 
-        entry_datetime = datetime.now()
-        entry_datetime_str = entry_datetime.strftime(SHEET_DATETIME_FORMAT)
 
+    delivery_datetime_str = delivery_datetime.strftime(SHEET_DATETIME_FORMAT)
 
-        delivery_datetime = datetime.combine(delivery_date, delivery_time)
-        delivery_datetime_str = delivery_datetime.strftime(SHEET_DATETIME_FORMAT)
 
+    data_to_save = [
+        entry_datetime_str,  # 0. ДАТА_ВВОДА
+        order_number,  # 1. НОМЕР_ЗАЯВКИ
+        valid_phone,  # 2. ТЕЛЕФОН
+        address,  # 3. АДРЕС
+        delivery_datetime_str,  # 4. ДАТА_ДОСТАВКИ (используется для сортировки)
+        comment,  # 5. КОММЕНТАРИЙ (Общий к заказу)
+        order_details,  # 6. ЗАКАЗ (Включает комментарии позиций)
+        float(total_sum) if not math.isnan(total_sum) else 0.0  # 7. СУММА
+    ]
 
-        data_to_save = [
-            entry_datetime_str,  # 0. ДАТА_ВВОДА
-            order_number,  # 1. НОМЕР_ЗАЯВКИ
-            valid_phone,  # 2. ТЕЛЕФОН
-            address,  # 3. АДРЕС
-            delivery_datetime_str,  # 4. ДАТА_ДОСТАВКИ (используется для сортировки)
-            comment,  # 5. КОММЕНТАРИЙ (Общий к заказу)
-            order_details,  # 6. ЗАКАЗ (Включает комментарии позиций)
-            float(total_sum) if not math.isnan(total_sum) else 0.0  # 7. СУММА
-        ]
 
+    # Кнопка сохранения
+    col_save1, col_save2 = st.columns(2)
+    with col_save1:
+        if st.session_state.app_mode == 'new':
+            if st.button("💾 Сохранить Новую Заявку", disabled=not is_ready_to_send,
+                         type="primary", use_container_width=True, key=f'save_new_order_{form_key}'):
+                if save_order_data(data_to_save, storage, st.session_state.calculator_items):
+                    commit_order_number(order_number)
+                    st.session_state.last_success_message = f"🎉 Заявка №{order_number} успешно сохранена!"
+                    if getattr(storage, 'write_queue', None):
+                        st.session_state.last_success_message += " Запись в Google Sheets поставлена в очередь."
+                    st.session_state.form_reset_trigger = True
+                    # Сброс формы и сообщение об успехе обрабатывает main() - перезапуск всей страницы
+                    st.rerun()
+        else:
+            if st.button("💾 Перезаписать Заявку", disabled=not is_ready_to_send,
+                         type="primary", use_container_width=True, key=f'update_order_{form_key}'):
+                if update_order_data(order_number, data_to_save, storage, st.session_state.calculator_items):
+                    st.session_state.last_success_message = f"🎉 Заявка №{order_number} успешно перезаписана!"
+                    st.session_state.loaded_order_data = None
+                    st.rerun()
 
-        # Кнопка сохранения
-        col_save1, col_save2 = st.columns(2)
-        with col_save1:
-            if st.session_state.app_mode == 'new':
-                if st.button("💾 Сохранить Новую Заявку", disabled=not is_ready_to_send,
-                             type="primary", use_container_width=True, key=f'save_new_order_{form_key}'):
-                    if save_order_data(data_to_save, orders_ws):
-                        st.session_state.last_success_message = f"🎉 Заявка №{order_number} успешно сохранена!"
-                        st.session_state.form_reset_trigger = True
-            else:
-                if st.button("💾 Перезаписать Заявку", disabled=not is_ready_to_send,
-                             type="primary", use_container_width=True, key=f'update_order_{form_key}'):
-                    if update_order_data(order_number, data_to_save, orders_ws):
-                        st.session_state.last_success_message = f"🎉 Заявка №{order_number} успешно перезаписана!"
-                        st.session_state.loaded_order_data = None
-                        st.rerun()
 
+    with col_save2:
+        if st.button("🔄 Очистить форму", use_container_width=True, key=f'clear_form_{form_key}'):
+            st.session_state.form_reset_trigger = True
+            st.rerun()
 
-        with col_save2:
-            if st.button("🔄 Очистить форму", use_container_width=True, key=f'clear_form_{form_key}'):
-                st.session_state.form_reset_trigger = True
-                st.rerun()
 
+    # Ссылка WhatsApp
+    if is_ready_to_send:
+        whatsapp_data = {
+            'НОМЕР_ЗАЯВКИ': order_number,
+            'ТЕЛЕФОН': client_phone,
+            'АДРЕС': address,
+            'ДАТА_ДОСТАВКИ': delivery_datetime.strftime('%d.%m.%Y %H:%M'),
+            'КОММЕНТАРИЙ': comment,
+            'ЗАКАЗ': order_details
+        }
 
-        # Ссылка WhatsApp
-        if is_ready_to_send:
-            whatsapp_data = {
-                'НОМЕР_ЗАЯВКИ': order_number,
-                'ТЕЛЕФОН': client_phone,
-                'АДРЕС': address,
-                'ДАТА_ДОСТАВКИ': delivery_datetime.strftime('%d.%m.%Y %H:%M'),
-                'КОММЕНТАРИЙ': comment,
-                'ЗАКАЗ': order_details
-            }
 
+        final_total_sum = float(total_sum) if not math.isnan(total_sum) else 0.0
+        whatsapp_url = generate_whatsapp_url(valid_phone, whatsapp_data, final_total_sum)
+        st.markdown("---")
+        st.markdown(f"**Ссылка для подтверждения клиенту ({valid_phone}):**")
+        st.markdown(
+            f'<a href="{whatsapp_url}" target="_blank">'
+            f'<button style="background-color:#25D366;color:white;padding:10px 20px;border:none;border-radius:5px;cursor:pointer;width:100%;">'
+            f'    📱 Открыть WhatsApp с Заказом'
+            f'</button></a>',
+            unsafe_allow_html=True
+        )
 
-            final_total_sum = float(total_sum) if not math.isnan(total_sum) else 0.0
-            whatsapp_url = generate_whatsapp_url(valid_phone, whatsapp_data, final_total_sum)
-            st.markdown("---")
-            st.markdown(f"**Ссылка для подтверждения клиенту ({valid_phone}):**")
-            st.markdown(
-                f'<a href="{whatsapp_url}" target="_blank">'
-                f'<button style="background-color:#25D366;color:white;padding:10px 20px;border:none;border-radius:5px;cursor:pointer;width:100%;">'
-                f'    📱 Открыть WhatsApp с Заказом'
-                f'</button></a>',
-                unsafe_allow_html=True
-            )
 
+@traced_fragment("order_list")
+def render_order_list():
+    """Вкладка списка заявок: период, поиск и страницы перезапускают только её"""
+    storage = get_storage()
 
-    # ================================================================
-    # ВКЛАДКА 2: СПИСОК ЗАЯВОК (ИСПРАВЛЕННАЯ ВЕРСИЯ)
-    # ================================================================
-    with tab_order_list:
-        st.header("📋 Просмотр и Поиск Заявок")
+    st.header("📋 Просмотр и Поиск Заявок")
 
 
-        # 1. Загрузка данных
+    # 1. Загрузка данных: окно по дате доставки или все заявки
+    period_label = st.radio(
+        "🚚 Дата доставки:", list(LIST_PERIOD_OPTIONS), horizontal=True, key='order_list_period'
+    )
+    period_days = LIST_PERIOD_OPTIONS[period_label]
+    orders_window = None
+    if period_days is None:
         all_orders_df = load_all_orders()
-        if all_orders_df.empty:
-            st.warning("Лист 'ЗАЯВКИ' пуст или произошла ошибка при загрузке.")
+    else:
+        orders_window = delivery_period_bounds(period_days)
+        all_orders_df, window_version = load_orders_window(*orders_window)
+    if all_orders_df.empty:
+        if orders_window:
+            st.info(f"Нет заявок с доставкой в период «{period_label}».")
         else:
-            df_display = all_orders_df.copy()
-
-
-            # Преобразуем номера заявок в строки
-            df_display['НОМЕР_ЗАЯВКИ'] = df_display['НОМЕР_ЗАЯВКИ'].astype(str)
+            st.warning("Лист 'ЗАЯВКИ' пуст или произошла ошибка при загрузке.")
+    else:
+        # Заявки с нераспознанной датой доставки не участвуют в сортировке листа
+        unparsed_positions = storage.delivery_index().unparsed_positions if storage and not orders_window else []
+        if len(unparsed_positions):
+            unparsed_numbers = all_orders_df['НОМЕР_ЗАЯВКИ'].iloc[unparsed_positions].astype(str).tolist()
+            st.warning(
+                f"⚠️ Не распознана дата доставки у {len(unparsed_numbers)} заявок "
+                f"(формат ДД.ММ.ГГГГ ЧЧ:ММ:СС), они не участвуют в сортировке: "
+                f"№{', №'.join(unparsed_numbers[:20])}"
+            )
 
+        # Подготовка (форматирование дат, сортировка) кэшируется по версии данных и окну;
+        # окно, прочитанное из источника до загрузки таблицы, готовится без кэша
+        with tracer.span("list.prepare"):
+            if not orders_window:
+                df_display = build_orders_display((storage.table.version, None), all_orders_df)
+            elif window_version is not None:
+                df_display = build_orders_display((window_version, orders_window), all_orders_df)
+            else:
+                df_display = prepare_orders_display(all_orders_df)
 
-            # Обрабатываем суммы
-            df_display['СУММА'] = pd.to_numeric(df_display['СУММА'], errors='coerce').fillna(0)
 
+        # 2. Поиск и фильтрация
+        st.subheader("Поиск")
+        search_term = st.text_input("🔍 Введите № заявки, телефон или часть адреса:", key='order_search_list')
+        if search_term and storage:
+            # Триграммный индекс хранилища возвращает идентификаторы строк (индекс таблицы)
+            with tracer.span("list.search"):
+                if orders_window and window_version is None:
+                    matched_ids = OrderSearchIndex.from_frame(all_orders_df).search(search_term)
+                else:
+                    matched_ids = storage.search_orders(search_term)
+                df_display = df_display[df_display.index.isin(matched_ids)]
+        text_query = st.text_input("📝 Поиск по составу заказа и комментариям (все слова):", key='order_text_search')
+        if text_query and storage:
+            with tracer.span("list.text_search"):
+                if orders_window and window_version is None:
+                    matched_ids = OrderTextIndex.from_frame(all_orders_df).search(text_query)
+                else:
+                    matched_ids = storage.search_order_text(text_query)
+                df_display = df_display[df_display.index.isin(matched_ids)]
+
+        # Постраничный вывод: в браузер уходит только текущая страница
+        total_pages = max(1, math.ceil(len(df_display) / LIST_PAGE_SIZE))
+        page = 1
+        if total_pages > 1:
+            page = int(st.number_input(
+                f"Страница (из {total_pages}):", min_value=1, max_value=total_pages, value=1, step=1
+            ))
+        st.info(f"Найдено заявок: **{len(df_display)}**, страница {page} из {total_pages}")
+        df_display = df_display.iloc[(page - 1) * LIST_PAGE_SIZE:page * LIST_PAGE_SIZE]
+
+
+        # 3. Визуально красивый вывод с исправленными датами и переносами строк
+        display_columns = [
+            'ДАТА_ВВОДА_ОТОБРАЖЕНИЕ', 'НОМЕР_ЗАЯВКИ', 'ТЕЛЕФОН', 'АДРЕС',
+            'ДАТА_ДОСТАВКИ_ОТОБРАЖЕНИЕ', 'КОММЕНТАРИЙ', 'ЗАКАЗ', 'СУММА'
+        ]
 
-            # Форматируем даты для отображения
-            df_display['ДАТА_ВВОДА_ОТОБРАЖЕНИЕ'] = df_display['ДАТА_ВВОДА'].apply(format_datetime_for_display)
-            df_display['ДАТА_ДОСТАВКИ_ОТОБРАЖЕНИЕ'] = df_display['ДАТА_ДОСТАВКИ'].apply(format_datetime_for_display)
+        # Статус записи в Google Sheets для заявок, прошедших через очередь
+        write_queue = getattr(storage, 'write_queue', None)
+        if write_queue:
+            sync_labels = {number: WRITE_QUEUE_STATUS_LABELS.get(status, status)
+                           for number, status in write_queue.status_by_order().items()}
+            df_display = df_display.assign(
+                СИНХРОНИЗАЦИЯ=df_display['НОМЕР_ЗАЯВКИ'].map(sync_labels).fillna('')
+            )
+            display_columns.append('СИНХРОНИЗАЦИЯ')
 
 
-            # Создаем datetime столбцы для сортировки
-            try:
-                df_display['ДАТА_ДОСТАВКИ_DT'] = pd.to_datetime(df_display['ДАТА_ДОСТАВКИ'], format=PARSE_DATETIME_FORMAT, errors='coerce')
-            except:
-                df_display['ДАТА_ДОСТАВКИ_DT'] = pd.to_datetime(df_display['ДАТА_ДОСТАВКИ'], errors='coerce')
-
-
-            # 2. Поиск и фильтрация
-            st.subheader("Поиск")
-            search_term = st.text_input("🔍 Введите № заявки, телефон или часть адреса:", key='order_search_list')
-            if search_term:
-                search_lower = search_term.lower()
-                df_display = df_display[
-                    df_display['НОМЕР_ЗАЯВКИ'].str.contains(search_lower, na=False) |
-                    df_display['ТЕЛЕФОН'].astype(str).str.contains(search_lower, na=False) |
-                    df_display['АДРЕС'].astype(str).str.contains(search_lower, case=False, na=False)
-                ]
-            st.info(f"Отображается заявок: **{len(df_display)}**")
-
-
-            # 3. Визуально красивый вывод с исправленными датами и переносами строк
-            display_columns = [
-                'ДАТА_ВВОДА_ОТОБРАЖЕНИЕ', 'НОМЕР_ЗАЯВКИ', 'ТЕЛЕФОН', 'АДРЕС',
-                'ДАТА_ДОСТАВКИ_ОТОБРАЖЕНИЕ', 'КОММЕНТАРИЙ', 'ЗАКАЗ', 'СУММА'
-            ]
-
-
-            # ИСПРАВЛЕНИЕ: Сначала сортируем, затем создаем df_for_display
-            df_display_sorted = df_display.sort_values(by='ДАТА_ДОСТАВКИ_DT', ascending=True)
-            
-            # Создаем копию DataFrame для отображения с улучшенным форматированием
-            df_for_display = df_display_sorted[display_columns].copy()
-            
-            # Улучшаем отображение столбца "ЗАКАЗ" - добавляем HTML переносы строк
-            df_for_display['ЗАКАЗ'] = df_for_display['ЗАКАЗ'].apply(
-                lambda x: '<br>'.join(str(x).split('\n')) if pd.notna(x) else ''
-            )
+        # Таблица уже отсортирована по дате доставки, ЗАКАЗ - с HTML переносами строк
+        df_for_display = df_display[display_columns]
 
 
+        # Время вывода - сериализация страницы таблицы на сервере
+        with tracer.span("list.render"):
             st.dataframe(
                 df_for_display,
                 column_config={
@@ -833,6 +4774,7 @@ def main():
                                                          help="Детали заказа и комментарии позиций",
                                                          width="large"),
                     "СУММА": st.column_config.NumberColumn("💰 Сумма", format="%.2f РУБ.", help="Общая сумма заказа"),
+                    "СИНХРОНИЗАЦИЯ": st.column_config.TextColumn("☁️ Google Sheets"),
                 },
                 hide_index=True,
                 use_container_width=True,
@@ -840,7 +4782,303 @@ def main():
             )
 
 
+        # 4. Выгрузка с теми же фильтрами: файл собирается только при нажатии кнопки
+        with st.expander("⬇️ Выгрузка заявок"):
+            st.caption(f"Период «{period_label}»" + (f", поиск «{search_term}»" if search_term else "")
+                       + (f", по составу «{text_query}»" if text_query else "")
+                       + ". Выгружаются все найденные заявки, а не только текущая страница.")
+            export_formats = [f for f in EXPORT_FORMATS if f != "XLSX" or openpyxl is not None]
+            col_format, col_items = st.columns(2)
+            export_format = col_format.radio("Формат:", export_formats, horizontal=True, key='export_format')
+            expand_items = col_items.checkbox("Каждая позиция заказа - отдельной строкой", key='export_items')
+            if openpyxl is None:
+                st.caption("Выгрузка в XLSX недоступна: не установлен пакет openpyxl.")
+            extension, mime = EXPORT_FORMATS[export_format]
+            st.download_button(
+                "⬇️ Скачать",
+                data=functools.partial(export_orders_file, storage, export_format, orders_window,
+                                       search_term, expand_items, text_query),
+                file_name=f"crm_orders_{datetime.now():%Y%m%d_%H%M}.{extension}",
+                mime=mime,
+                on_click="ignore",
+                disabled=not storage,
+            )
+
+
+@traced_fragment("analytics")
+def render_analytics():
+    """Вкладка аналитики: графики по готовым сводкам хранилища, без пересчёта по всем заявкам"""
+    storage = get_storage()
+    st.header("📊 Аналитика Продаж")
+    if not storage:
+        st.warning("Хранилище заявок недоступно.")
+        return
+    try:
+        with tracer.span("analytics.rollups"):
+            rollups = storage.order_rollups()
+            daily = rollups.daily_frame()
+            slots = rollups.slot_frame()
+            top_items = rollups.top_items(ANALYTICS_TOP_ITEMS)
+    except Exception as e:
+        st.error(f"Ошибка расчёта сводок: {e}")
+        return
+    if daily.empty and top_items.empty:
+        st.info("Заявок пока нет.")
+        return
+    st.caption("По заявкам в работе (без архива); дата - дата доставки.")
+
+    revenue, orders = float(daily['ВЫРУЧКА'].sum()), int(daily['ЗАЯВОК'].sum())
+    col_revenue, col_orders, col_average = st.columns(3)
+    col_revenue.metric("💰 Выручка", f"{revenue:,.2f} РУБ.".replace(",", " "))
+    col_orders.metric("📦 Заявок", orders)
+    col_average.metric("🧾 Средний чек", f"{revenue / orders:,.2f} РУБ.".replace(",", " ") if orders else "—")
+
+    st.subheader("Выручка по дням доставки")
+    st.bar_chart(daily['ВЫРУЧКА'])
+    st.subheader("Выручка по неделям доставки")
+    st.bar_chart(rollups.weekly_frame()['ВЫРУЧКА'])
+    st.subheader("Заявки по слотам доставки")
+    st.bar_chart(slots['ЗАЯВОК'])
+    st.subheader(f"Топ-{ANALYTICS_TOP_ITEMS} позиций по количеству")
+    st.dataframe(
+        top_items,
+        column_config={
+            "НАИМЕНОВАНИЕ": st.column_config.TextColumn("Позиция"),
+            "КОЛИЧЕСТВО": st.column_config.NumberColumn("Количество, шт."),
+            "ВЫРУЧКА": st.column_config.NumberColumn("💰 Выручка", format="%.2f РУБ."),
+        },
+        hide_index=True,
+        use_container_width=True,
+    )
+
+
+@traced_fragment("order_import")
+def render_order_import():
+    """Вкладка импорта заявок из CSV/XLSX: отчёт проверки по строкам и запись одной пачкой"""
+    storage = get_storage()
+    st.header("📥 Импорт Заявок из CSV/XLSX")
+    st.caption(
+        f"Строка файла - позиция заказа. Обязательные столбцы: {', '.join(IMPORT_REQUIRED_COLUMNS)} "
+        f"и НАИМЕНОВАНИЕ или {PRICE_SKU_HEADER}; необязательные: ЗАКАЗ_ID, КОММЕНТАРИЙ, КОММЕНТАРИЙ_ПОЗИЦИИ. "
+        f"Строки с одним ЗАКАЗ_ID (без него - с одинаковыми телефоном, адресом и датой) - одна заявка."
+    )
+    uploaded = st.file_uploader("Файл заявок", type=['csv', 'xlsx'], key='import_file')
+    if not uploaded:
+        return
+    price_catalogue = load_price_list()
+    if not price_catalogue or price_catalogue.empty:
+        st.error("Прайс не загружен - позиции нечем оценить.")
+        return
+    data = uploaded.getvalue()
+    try:
+        report, orders = validate_import_frame(read_import_file(uploaded.name, data), price_catalogue)
+    except ImportError:
+        st.error("Для чтения XLSX нужен пакет openpyxl (pip install openpyxl).")
+        return
+    except (ValueError, pd.errors.ParserError) as e:
+        st.error(f"Не удалось прочитать файл: {e}")
+        return
+
+    rejected = int((report['СТАТУС'] != '✅').sum())
+    st.info(f"Строк в файле: **{len(report)}**, с ошибками или отклонённых: **{rejected}**. "
+            f"Готово к импорту заявок: **{len(orders)}**")
+    st.dataframe(
+        report,
+        column_config={
+            "СТРОКА": "Строка файла",
+            "ЗАЯВКА": "Заявка",
+            "ТЕЛЕФОН": st.column_config.TextColumn("📞 Телефон"),
+            "НАИМЕНОВАНИЕ": st.column_config.TextColumn("Позиция"),
+            "СТАТУС": "Статус",
+            "ОШИБКА": st.column_config.TextColumn("Ошибка", width="large"),
+        },
+        hide_index=True,
+        use_container_width=True,
+    )
+
+    # Повторное нажатие или перезапуск после импорта не должны задвоить заявки
+    file_key = (uploaded.name, len(data), hash(data))
+    if st.session_state.get('imported_file') == file_key:
+        st.success("Этот файл уже импортирован.")
+        return
+    if not orders or not st.button(f"📥 Импортировать заявок: {len(orders)}", type="primary",
+                                   disabled=not storage, use_container_width=True):
+        return
+    allocator = get_order_number_allocator()
+    try:
+        order_numbers = allocator.reserve_many(len(orders))
+    except Exception as e:
+        st.error(f"Ошибка резервирования номеров заявок: {e}")
+        return
+    items_list = [order['items'] for order in orders]
+    if import_order_data(import_order_rows(orders, order_numbers), storage, items_list):
+        for order_number in order_numbers:
+            allocator.commit(order_number)
+        st.session_state.imported_file = file_key
+        message = f"🎉 Импортировано заявок: {len(orders)} (№{order_numbers[0]}–№{order_numbers[-1]})."
+        if getattr(storage, 'write_queue', None):
+            message += " Запись в Google Sheets поставлена в очередь."
+        st.success(message)
+    else:
+        for order_number in order_numbers:
+            allocator.release(order_number)
+
+
+# ================================================================
+# ОСНОВНАЯ ЛОГИКА ПРИЛОЖЕНИЯ
+# ================================================================
+
+
+def main():
+    # Инициализация основного состояния
+    if 'app_mode' not in st.session_state:
+        st.session_state.app_mode = 'new'
+    if 'calculator_items' not in st.session_state:
+        st.session_state.calculator_items = []
+    if 'last_success_message' not in st.session_state:
+        st.session_state.last_success_message = None
+    if 'form_reset_trigger' not in st.session_state:
+        st.session_state.form_reset_trigger = False
+    if 'loaded_order_data' not in st.session_state:
+        st.session_state.loaded_order_data = None
+    if 'form_key' not in st.session_state:
+        st.session_state.form_key = 0
+
+
+    # Виджеты списка не создаются, пока его вкладка закрыта: сохраняем выбранный период и поиск
+    for key in ('order_list_period', 'order_search_list', 'order_text_search'):
+        if key in st.session_state:
+            st.session_state[key] = st.session_state[key]
+
+
+    # Обработка сброса формы
+    if st.session_state.form_reset_trigger:
+        st.session_state.form_reset_trigger = False
+        # Устанавливаем значения по умолчанию для новой формы
+        st.session_state.app_mode = 'new'
+        st.session_state.calculator_items = []
+        st.session_state.last_success_message = None
+        st.session_state.loaded_order_data = None
+        st.session_state.form_key += 1  # Изменяем ключ формы для принудительного сброса
+        st.rerun()
+
+
+    # Загрузка данных (прайс и заявки загружают вкладки)
+    start_metrics_server()
+    storage = get_storage()
+
+
+    # Боковая панель: ручная полная синхронизация с хранилищем
+    with st.sidebar, tracer.span("main.sidebar"):
+        st.subheader("Синхронизация")
+        if getattr(getattr(storage, 'sync', None), 'reconciling', False):
+            st.caption("⏳ Заявки показаны из сохранённого снимка, идёт сверка с Google Sheets")
+        if st.button("🔄 Перечитать заявки полностью", use_container_width=True, disabled=not storage):
+            try:
+                storage.resync()
+                st.rerun()
+            except Exception as e:
+                st.error(f"Ошибка синхронизации: {e}")
+
+        # Перенос старых заявок в помесячный архив (поиск и редактирование их находят)
+        if st.button(f"🗄 Архивировать заявки старше {ARCHIVE_HORIZON_DAYS} дн.", use_container_width=True,
+                     disabled=not storage):
+            try:
+                cutoff = datetime.combine(datetime.today().date() - timedelta(days=ARCHIVE_HORIZON_DAYS), time(0, 0))
+                archived = storage.archive_orders(cutoff)
+                st.success(f"Перенесено в архив заявок: {archived}")
+            except Exception as e:
+                st.error(f"Ошибка архивации: {e}")
+
+        # Однократный перенос состава старых заявок из текста ЗАКАЗ в построчные позиции
+        if st.button("📦 Заполнить позиции из истории", use_container_width=True, disabled=not storage,
+                     help="Разбирает столбец ЗАКАЗ заявок без сохранённых позиций"):
+            try:
+                backfilled = storage.backfill_order_items()
+                st.success(f"Позиции сохранены для заявок: {backfilled}")
+            except Exception as e:
+                st.error(f"Ошибка заполнения позиций: {e}")
+
+        # Расход квоты Google Sheets API в этом процессе
+        if STORAGE_BACKEND == "gsheets" or SHEETS_MIRROR_ENABLED:
+            api_stats = get_request_governor().stats()
+            st.caption(
+                f"Google Sheets API: запросов {api_stats['requests']}, повторов {api_stats['retries']}, "
+                f"ожидание квоты {api_stats['rate_limit_wait_seconds']:.1f} с, "
+                f"объединено чтений {api_stats['deduplicated']}"
+            )
+
+        # Состояние фоновой очереди записи в Google Sheets
+        write_queue = getattr(storage, 'write_queue', None)
+        if write_queue:
+            queue_counts = write_queue.counts()
+            st.caption(
+                f"Запись в Google Sheets: в очереди {queue_counts.get('queued', 0)}, "
+                f"ошибок {queue_counts.get('failed', 0)}"
+            )
+            if queue_counts.get('failed'):
+                with st.expander("❌ Ошибки записи"):
+                    for failed_number, failed_error in write_queue.failed_items():
+                        st.write(f"№{failed_number}: {failed_error}")
+                    if st.button("Повторить отправку", use_container_width=True):
+                        write_queue.retry_failed()
+                        st.rerun()
+
+    st.title("CRM: Управление Заявками ▼")
+
+
+    # Обработка успешного сообщения
+    if st.session_state.last_success_message:
+        st.success(st.session_state.last_success_message)
+        st.session_state.last_success_message = None
+
+
+    # ---
+    # ГЛАВНОЕ РАЗДЕЛЕНИЕ НА ВКЛАДКИ
+    # ---
+    # Нажатия внутри вкладки перезапускают только её фрагмент, не затрагивая боковую
+    # панель и другую вкладку. Список строится, только когда его вкладка открыта
+    # (on_change="rerun"); ввод заявки выполняется всегда, чтобы не терять значения формы
+    tab_order_entry, tab_order_list, tab_analytics, tab_order_import = st.tabs(
+        ['📝 Ввод/Редактирование Заявки', '📋 Список Заявок', '📊 Аналитика', '📥 Импорт'],
+        key='main_tab', on_change="rerun"
+    )
+    with tab_order_entry, tracer.span("main.tab_entry"):
+        render_order_entry()
+    if tab_order_list.open:
+        with tab_order_list, tracer.span("main.tab_list"):
+            render_order_list()
+    if tab_analytics.open:
+        with tab_analytics, tracer.span("main.tab_analytics"):
+            render_analytics()
+    if tab_order_import.open:
+        with tab_order_import, tracer.span("main.tab_import"):
+            render_order_import()
+
+
+    # Панель отладки: разбивка текущего перезапуска по участкам и попадания в кэши
+    if TRACE_ENABLED:
+        with st.sidebar:
+            if st.checkbox("🐞 Отладка производительности", key='trace_panel'):
+                spans = [span for span in tracer.current_rerun() if span.depth > 0]
+                total = sum(span.seconds for span in spans if span.depth == 1) or 1.0
+                st.dataframe(
+                    pd.DataFrame({
+                        'Участок': ["  " * (span.depth - 1) + span.name for span in spans],
+                        'мс': [round(span.seconds * 1000, 1) for span in spans],
+                        'Доля': [f"{span.seconds / total:.0%}" for span in spans],
+                    }),
+                    hide_index=True,
+                    use_container_width=True,
+                )
+                cache_counts = tracer.snapshot()['caches']
+                st.caption("Кэши (попадания / промахи): " + ", ".join(
+                    f"{name} {counts['hits']}/{counts['misses']}" for name, counts in cache_counts.items()
+                ))
+
+
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    with tracer.rerun():
+        main()
\ No newline at end of file
@@ -0,0 +1,452 @@
+"""Замеры производительности CRM на синтетических данных без доступа к Google Sheets.
+
+Лист ЗАЯВКИ подменяется FakeWorksheet в памяти (с настраиваемой задержкой на
+каждый запрос к API), заявки генерируются generate_orders. Для каждого размера
+листа замеряются загрузка заявок, поиск места вставки, перезапись и добавление
+заявки, выдача номера и подготовка вкладки «Список Заявок»: время (медиана,
+минимум, максимум), пиковая память и число запросов к API. Каждый замер идёт в
+двух конфигурациях хранилища: default - как в приложении по умолчанию (общий
+снимок Arrow и очередь записи, отправка очереди замеряется отдельно) и bare -
+GSheetStorage без них. Результаты сохраняются в JSON, два файла можно сравнить
+между версиями:
+
+    python benchmark.py --sizes 1000 10000 100000 --output bench_new.json
+    python benchmark.py --configs default --output bench_default.json
+    python benchmark.py --sizes 1000000 --latency-ms 150 --output bench_1m.json
+    python benchmark.py --compare bench_old.json bench_new.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Optional, Callable
+
+# Импорт app.py вне `streamlit run`: приглушаем предупреждения об отсутствии сессии
+os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+
+import gspread
+import numpy as np
+import pandas as pd
+from gspread.utils import a1_range_to_grid_range, a1_to_rowcol, numericise_all
+
+import app
+
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+DEFAULT_OUTPUT = "benchmark_results.json"
+# default - снимок Arrow и очередь записи, как get_storage() по умолчанию; bare - только лист
+CONFIGS = ["default", "bare"]
+# Во сколько раз медиана может вырасти, прежде чем --compare отметит регрессию
+REGRESSION_THRESHOLD = 1.2
+
+
+# ================================================================
+# ИМИТАЦИЯ GOOGLE SHEETS
+# ================================================================
+class FakeSpreadsheet:
+    """Таблица в памяти с интерфейсом gspread.Spreadsheet, нужным приложению"""
+
+    def __init__(self, latency_seconds: float = 0.0):
+        self.latency_seconds = latency_seconds
+        self.api_calls = 0
+        self.sheets: Dict[str, 'FakeWorksheet'] = {}
+        self._by_id: Dict[int, 'FakeWorksheet'] = {}
+
+    def api_call(self):
+        """Каждый метод, который в gspread ходит в API, учитывается и ждёт задержку"""
+        self.api_calls += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    def worksheet(self, title: str) -> 'FakeWorksheet':
+        self.api_call()
+        if title not in self.sheets:
+            raise gspread.WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def add_worksheet(self, title: str, rows: int = 1000, cols: int = 26) -> 'FakeWorksheet':
+        self.api_call()
+        return FakeWorksheet(self, title, [])
+
+    def batch_update(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        self.api_call()
+        for request in body['requests']:
+            if 'insertDimension' in request:
+                grid = request['insertDimension']['range']
+                worksheet = self._by_id[grid['sheetId']]
+                worksheet.rows[grid['startIndex']:grid['startIndex']] = [
+                    [] for _ in range(grid['endIndex'] - grid['startIndex'])
+                ]
+            elif 'deleteDimension' in request:
+                grid = request['deleteDimension']['range']
+                del self._by_id[grid['sheetId']].rows[grid['startIndex']:grid['endIndex']]
+            elif 'updateCells' in request:
+                update = request['updateCells']
+                worksheet = self._by_id[update['start']['sheetId']]
+                for offset, row in enumerate(update['rows']):
+                    worksheet.set_row(update['start']['rowIndex'] + offset, self._cell_values(row))
+            elif 'appendCells' in request:
+                append = request['appendCells']
+                worksheet = self._by_id[append['sheetId']]
+                worksheet.rows.extend(self._cell_values(row) for row in append['rows'])
+        return {}
+
+    @staticmethod
+    def _cell_values(row: Dict[str, Any]) -> List[Any]:
+        return [next(iter(cell['userEnteredValue'].values())) for cell in row['values']]
+
+
+class FakeWorksheet:
+    """Лист в памяти с интерфейсом gspread.Worksheet, нужным приложению.
+
+    Значения хранятся как есть; чтение по умолчанию возвращает строки (как
+    FORMATTED_VALUE), с value_render_option='UNFORMATTED_VALUE' - исходные значения.
+    """
+
+    def __init__(self, spreadsheet: FakeSpreadsheet, title: str, rows: List[List[Any]]):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.rows = rows
+        self.id = len(spreadsheet._by_id)
+        spreadsheet.sheets[title] = self
+        spreadsheet._by_id[self.id] = self
+
+    def set_row(self, index: int, values: List[Any]):
+        while len(self.rows) <= index:
+            self.rows.append([])
+        self.rows[index] = list(values)
+
+    def _block(self, a1: str, formatted: bool = True) -> List[List[Any]]:
+        grid = a1_range_to_grid_range(a1)
+        r0, r1 = grid.get('startRowIndex', 0), grid.get('endRowIndex', len(self.rows))
+        c0, c1 = grid.get('startColumnIndex', 0), grid.get('endColumnIndex', 26)
+        block = [
+            [str(v) if formatted else v for v in row[c0:c1]]
+            for row in self.rows[r0:r1]
+        ]
+        # Как API: хвостовые пустые строки и ячейки не возвращаются
+        block = [row[:max((i + 1 for i, v in enumerate(row) if v != ""), default=0)] for row in block]
+        while block and not block[-1]:
+            block.pop()
+        return block
+
+    def get_all_values(self, **kwargs) -> List[List[str]]:
+        self.spreadsheet.api_call()
+        return [[str(v) for v in row] for row in self.rows]
+
+    def get_all_records(self, **kwargs) -> List[Dict[str, Any]]:
+        self.spreadsheet.api_call()
+        headers = [str(h) for h in self.rows[0]] if self.rows else []
+        return [
+            dict(zip(headers, numericise_all([str(v) for v in row] + [""] * (len(headers) - len(row)))))
+            for row in self.rows[1:]
+        ]
+
+    def get(self, range_name: str, **kwargs) -> List[List[Any]]:
+        self.spreadsheet.api_call()
+        return self._block(range_name, kwargs.get('value_render_option') != 'UNFORMATTED_VALUE')
+
+    def batch_get(self, ranges: List[str], **kwargs) -> List[List[List[Any]]]:
+        self.spreadsheet.api_call()
+        formatted = kwargs.get('value_render_option') != 'UNFORMATTED_VALUE'
+        return [self._block(a1, formatted) for a1 in ranges]
+
+    def row_values(self, row: int, **kwargs) -> List[str]:
+        self.spreadsheet.api_call()
+        return [str(v) for v in self.rows[row - 1]] if row <= len(self.rows) else []
+
+    def col_values(self, col: int, **kwargs) -> List[str]:
+        self.spreadsheet.api_call()
+        return [str(row[col - 1]) if len(row) >= col else "" for row in self.rows]
+
+    def acell(self, label: str, **kwargs):
+        self.spreadsheet.api_call()
+        row, col = a1_to_rowcol(label)
+        values = self.rows[row - 1] if row <= len(self.rows) else []
+        value = values[col - 1] if col <= len(values) else ""
+        return gspread.Cell(row, col, str(value) if value != "" else None)
+
+    def insert_row(self, values: List[Any], index: int = 1, **kwargs):
+        self.insert_rows([values], row=index)
+
+    def insert_rows(self, values: List[List[Any]], row: int = 1, **kwargs):
+        self.spreadsheet.api_call()
+        self.rows[row - 1:row - 1] = [list(v) for v in values]
+
+    def append_row(self, values: List[Any], **kwargs) -> Dict[str, Any]:
+        return self.append_rows([values])
+
+    def append_rows(self, values: List[List[Any]], **kwargs) -> Dict[str, Any]:
+        self.spreadsheet.api_call()
+        start = len(self.rows) + 1
+        self.rows.extend(list(v) for v in values)
+        return {'updates': {'updatedRange': f"'{self.title}'!A{start}:I{len(self.rows)}"}}
+
+    def update(self, values: Optional[List[List[Any]]] = None, range_name: Optional[str] = None, **kwargs):
+        self.spreadsheet.api_call()
+        grid = a1_range_to_grid_range(range_name)
+        r0, c0 = grid.get('startRowIndex', 0), grid.get('startColumnIndex', 0)
+        for offset, row in enumerate(values):
+            while len(self.rows) <= r0 + offset:
+                self.rows.append([])
+            current = self.rows[r0 + offset]
+            current.extend([""] * (c0 + len(row) - len(current)))
+            current[c0:c0 + len(row)] = list(row)
+        return {}
+
+
+# ================================================================
+# СИНТЕТИЧЕСКИЕ ДАННЫЕ
+# ================================================================
+PRICE_LIST = [
+    ("Вода питьевая 19 л", 350.0), ("Вода питьевая 5 л", 120.0), ("Вода минеральная 1,5 л", 85.0),
+    ("Помпа механическая", 450.0), ("Помпа электрическая", 1290.0), ("Кулер напольный", 8900.0),
+    ("Кулер настольный", 5600.0), ("Стаканчики 100 шт.", 190.0), ("Держатель стаканчиков", 650.0),
+    ("Подставка под бутыль", 990.0), ("Санитарная обработка кулера", 1500.0), ("Залог за бутыль", 400.0),
+    ("Фильтр - угольный картридж", 780.0), ("Чай чёрный 100 пак.", 320.0), ("Кофе молотый 250 г", 540.0),
+]
+STREETS = ["Ленина", "Мира", "Садовая", "Гагарина", "Советская", "Центральная", "Школьная", "Лесная",
+           "Молодёжная", "Набережная", "Пушкина", "Первомайская", "Зелёная", "Новая", "Октябрьская"]
+ITEM_COMMENTS = ["", "", "", "позвонить за час", "оставить у двери", "без сдачи", "этаж 5, без лифта"]
+
+
+def format_order_item(name: str, qty: int, price: float, comment: str) -> str:
+    """Строка ЗАКАЗ в том же формате, что сохраняет форма заявки"""
+    text = f"{name} - {qty} шт. (по {price:.2f} РУБ.)"
+    return f"{text} | {comment}" if comment else text
+
+
+def generate_orders(n: int, seed: int = 42, orders_per_day: int = 40,
+                    end_date: Optional[datetime] = None) -> List[List[Any]]:
+    """Строки листа ЗАЯВКИ (A:I), отсортированные по дате доставки, как их держит приложение"""
+    rng = random.Random(seed)
+    end_date = end_date or datetime(2026, 10, 1)
+    days = max(1, n // orders_per_day)
+    first_day = end_date - timedelta(days=days)
+    records = []
+    for i in range(n):
+        delivery = first_day + timedelta(days=rng.randrange(days), minutes=30 * rng.randrange(9 * 2, 20 * 2))
+        entered = delivery - timedelta(days=rng.randint(0, 3), minutes=rng.randrange(600))
+        items = rng.sample(PRICE_LIST, rng.randint(1, 4))
+        lines, total = [], 0.0
+        for name, price in items:
+            qty = rng.choice([1, 1, 1, 2, 2, 3, 5, 10])
+            lines.append(format_order_item(name, qty, price, rng.choice(ITEM_COMMENTS)))
+            total += qty * price
+        records.append((delivery, [
+            entered.strftime(app.SHEET_DATETIME_FORMAT),
+            str(app.ORDER_NUMBER_START + i),
+            "79" + "".join(rng.choice("0123456789") for _ in range(9)),
+            f"г. Москва, ул. {rng.choice(STREETS)}, д. {rng.randint(1, 150)}, кв. {rng.randint(1, 300)}",
+            delivery.strftime(app.SHEET_DATETIME_FORMAT),
+            rng.choice(["", "", "Код домофона 45", "Позвонить заранее"]),
+            "\n".join(lines),
+            total,
+            str(int(entered.timestamp() * 1000)),
+        ]))
+    records.sort(key=lambda r: r[0])
+    return [row for _, row in records]
+
+
+def build_spreadsheet(n: int, latency_seconds: float, seed: int) -> FakeSpreadsheet:
+    spreadsheet = FakeSpreadsheet(latency_seconds)
+    FakeWorksheet(spreadsheet, app.WORKSHEET_NAME_ORDERS, [list(app.SHEET_HEADERS)] + generate_orders(n, seed))
+    FakeWorksheet(spreadsheet, app.WORKSHEET_NAME_PRICE, [["НАИМЕНОВАНИЕ", "ЦЕНА"]] + [list(p) for p in PRICE_LIST])
+    return spreadsheet
+
+
+# ================================================================
+# ЗАМЕРЫ
+# ================================================================
+def measure(fn: Callable[[int], Any], spreadsheet: FakeSpreadsheet, repeat: int) -> Dict[str, Any]:
+    """Время каждого вызова fn(i), затем отдельный прогон под tracemalloc для пиковой памяти"""
+    timings = []
+    calls_before = spreadsheet.api_calls
+    for i in range(repeat):
+        started = time.perf_counter()
+        fn(i)
+        timings.append(time.perf_counter() - started)
+    api_calls = (spreadsheet.api_calls - calls_before) / repeat
+    tracemalloc.start()
+    fn(repeat)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'repeat': repeat,
+        'median_ms': statistics.median(timings) * 1000,
+        'min_ms': min(timings) * 1000,
+        'max_ms': max(timings) * 1000,
+        'peak_mb': peak / 2 ** 20,
+        'api_calls': api_calls,
+    }
+
+
+def run_size(n: int, config: str, latency_seconds: float, seed: int, repeat: int,
+             workdir: str) -> Dict[str, Dict[str, Any]]:
+    spreadsheet = build_spreadsheet(n, latency_seconds, seed)
+    orders_ws = spreadsheet.sheets[app.WORKSHEET_NAME_ORDERS]
+    rng = random.Random(seed + 1)
+    queue, worker, snapshot_path = None, None, None
+    if config == "default":
+        # Поток очереди не запускается: отправка замеряется отдельно и не мешает остальным замерам
+        queue = app.SheetWriteQueue(os.path.join(workdir, "outbox.db"))
+        worker = app.SheetWriteWorker(queue, orders_ws)
+        snapshot_path = os.path.join(workdir, "orders.arrow")
+
+    def make_storage() -> app.GSheetStorage:
+        shared = app.ArrowSnapshot(snapshot_path) if snapshot_path else None
+        return app.GSheetStorage(orders_ws, write_queue=queue, shared=shared)
+
+    storage = make_storage()
+    results = {}
+
+    # load_all_orders: холодный старт процесса (в default - со снимком на диске после
+    # первого запуска) и проверка изменений при уже загруженной копии
+    def load_cold(_):
+        make_storage().load_orders()
+    results['load_all_orders_cold'] = measure(load_cold, spreadsheet, max(1, repeat // 4))
+    storage.load_orders()
+
+    def load_warm(_):
+        storage.sync.mark_stale()
+        storage.load_orders()
+    results['load_all_orders_delta'] = measure(load_warm, spreadsheet, repeat)
+
+    sample_rows = [orders_ws.rows[rng.randrange(1, len(orders_ws.rows))] for _ in range(repeat + 1)]
+
+    def insert_index(i):
+        app.get_insert_index(sample_rows[i][4], storage.delivery_index())
+    results['get_insert_index'] = measure(insert_index, spreadsheet, repeat)
+
+    def update_order(i):
+        row = list(sample_rows[i][:len(app.EXPECTED_HEADERS)])
+        row[5] = f"Изменено {i}"
+        app.update_order_data(str(row[1]), row, storage)
+    results['update_order_data'] = measure(update_order, spreadsheet, repeat)
+
+    def append_order(i):
+        row = generate_orders(1, seed + 1000 + i)[0][:len(app.EXPECTED_HEADERS)]
+        row[1] = str(app.ORDER_NUMBER_START + n + i)
+        app.save_order_data(row, storage)
+    results['save_order_data'] = measure(append_order, spreadsheet, repeat)
+
+    if worker:
+        worker.flush_once()
+
+        # Пачка из 10 заявок до появления в листе: постановка в очередь и одна отправка
+        def save_and_flush(i):
+            for k in range(10):
+                row = generate_orders(1, seed + 5000 + i * 10 + k)[0][:len(app.EXPECTED_HEADERS)]
+                row[1] = str(app.ORDER_NUMBER_START + 2 * n + i * 10 + k)
+                app.save_order_data(row, storage)
+            worker.flush_once()
+        results['save_10_orders_and_flush'] = measure(save_and_flush, spreadsheet, max(1, repeat // 4))
+
+    # generate_next_order_number без сессии Streamlit: тот же распределитель номеров
+    allocator = app.OrderNumberAllocator(storage)
+
+    def next_number(_):
+        allocator.commit(allocator.reserve())
+    results['generate_next_order_number'] = measure(next_number, spreadsheet, repeat)
+
+    # Вкладка «Список Заявок»: подготовка таблицы, поиск, страница
+    def list_tab(i):
+        df_display = app.prepare_orders_display(storage.load_orders())
+        matched_ids = storage.search_orders(STREETS[i % len(STREETS)][:5])
+        df_display = df_display[df_display.index.isin(matched_ids)]
+        df_display.iloc[:app.LIST_PAGE_SIZE]
+    results['list_tab_pipeline'] = measure(list_tab, spreadsheet, max(1, repeat // 4))
+
+    def list_window(_):
+        start, end = app.delivery_period_bounds(2, datetime(2026, 9, 29))
+        storage.load_orders_window(start, end)
+    results['list_tab_window'] = measure(list_window, spreadsheet, repeat)
+    return results
+
+
+def environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+def compare(old_path: str, new_path: str) -> int:
+    """Печатает изменение медиан; код возврата 1, если есть регрессии"""
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+    regressions = 0
+    print(f"{'строк':>8}  {'замер':<36} {'было, мс':>10} {'стало, мс':>10} {'x':>6}")
+    for size, benchmarks in new['results'].items():
+        for name, stats in benchmarks.items():
+            before = old['results'].get(size, {}).get(name)
+            if not before:
+                continue
+            ratio = stats['median_ms'] / before['median_ms'] if before['median_ms'] else float('inf')
+            mark = "  <-- регрессия" if ratio > REGRESSION_THRESHOLD else ""
+            regressions += bool(mark)
+            print(f"{size:>8}  {name:<36} {before['median_ms']:>10.2f} {stats['median_ms']:>10.2f} {ratio:>6.2f}{mark}")
+    return 1 if regressions else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Замеры производительности CRM на синтетическом листе")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="размеры листа ЗАЯВКИ (например 1000 10000 100000 1000000)")
+    parser.add_argument("--configs", nargs="+", choices=CONFIGS, default=CONFIGS,
+                        help="конфигурации хранилища: default (снимок и очередь записи), bare (только лист)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="задержка на каждый запрос к API, мс")
+    parser.add_argument("--repeat", type=int, default=20, help="повторов каждого замера")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="файл JSON с результатами")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="сравнить два файла результатов")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return compare(*args.compare)
+
+    report = {
+        'environment': environment(),
+        'settings': {'latency_ms': args.latency_ms, 'repeat': args.repeat, 'seed': args.seed,
+                     'configs': args.configs},
+        'results': {},
+    }
+    for n in args.sizes:
+        report['results'][str(n)] = {}
+        for config in args.configs:
+            print(f"Лист на {n} заявок, конфигурация {config}...", file=sys.stderr)
+            with tempfile.TemporaryDirectory(prefix="crm-bench-") as workdir:
+                results = run_size(n, config, args.latency_ms / 1000, args.seed, args.repeat, workdir)
+            for name, stats in results.items():
+                report['results'][str(n)][f"{config}.{name}"] = stats
+                print(f"  {config + '.' + name:<36} {stats['median_ms']:>10.2f} мс  {stats['peak_mb']:>8.1f} МБ  "
+                      f"API {stats['api_calls']:.1f}", file=sys.stderr)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
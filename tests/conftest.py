@@ -0,0 +1,240 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+import gspread
+import pytest
+from gspread.utils import a1_range_to_grid_range, numericise_all
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+BASE_DATE = datetime(2026, 3, 2, 9, 0)
+
+
+def order_row(number, hours=0, phone="+79990000001", address="ул. Ленина, 1",
+              order="Розы - 3 шт. (по 100.00 РУБ.)", total=300, revision="1", comment=""):
+    """Строка листа ЗАЯВКИ (SHEET_HEADERS) с доставкой через hours часов после BASE_DATE"""
+    delivery = (BASE_DATE + timedelta(hours=hours)).strftime(app.SHEET_DATETIME_FORMAT)
+    return [BASE_DATE.strftime(app.SHEET_DATETIME_FORMAT), str(number), phone, address, delivery,
+            comment, order, total, revision]
+
+
+class FakeSpreadsheet:
+    def __init__(self):
+        self.sheets = {}
+        self.calls = []
+
+    def worksheet(self, title):
+        if title not in self.sheets:
+            raise gspread.WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def worksheets(self):
+        return list(self.sheets.values())
+
+    def add_worksheet(self, title, rows=1, cols=1, **kwargs):
+        return FakeWorksheet([], title=title, spreadsheet=self)
+
+    def batch_update(self, body):
+        self.calls.append(('batch_update', len(body['requests'])))
+        by_id = {ws.id: ws for ws in self.sheets.values()}
+        for request in body['requests']:
+            if 'insertDimension' in request:
+                grid = request['insertDimension']['range']
+                ws = by_id[grid['sheetId']]
+                for _ in range(grid['endIndex'] - grid['startIndex']):
+                    ws.rows.insert(grid['startIndex'], [])
+            elif 'deleteDimension' in request:
+                grid = request['deleteDimension']['range']
+                del by_id[grid['sheetId']].rows[grid['startIndex']:grid['endIndex']]
+            elif 'updateCells' in request:
+                update = request['updateCells']
+                ws, start = by_id[update['start']['sheetId']], update['start']['rowIndex']
+                for i, row in enumerate(update['rows']):
+                    values = [str(next(iter(cell['userEnteredValue'].values()))) for cell in row['values']]
+                    while len(ws.rows) <= start + i:
+                        ws.rows.append([])
+                    ws.rows[start + i] = values
+            elif 'appendCells' in request:
+                append = request['appendCells']
+                by_id[append['sheetId']].rows.extend(
+                    [str(next(iter(cell['userEnteredValue'].values()))) for cell in row['values']]
+                    for row in append['rows'])
+
+
+class FakeWorksheet:
+    """Лист в памяти с подмножеством API gspread; calls - журнал обращений к API"""
+
+    def __init__(self, rows, title="ЗАЯВКИ", spreadsheet=None):
+        self.rows = [[str(value) for value in row] for row in rows]
+        self.title = title
+        self.spreadsheet = spreadsheet or FakeSpreadsheet()
+        self.id = len(self.spreadsheet.sheets)
+        self.spreadsheet.sheets[title] = self
+        self.calls = []
+        self.grid_rows = None
+
+    @property
+    def row_count(self):
+        """Размер сетки, как в свойствах листа: с пустыми строками под данными"""
+        return self.grid_rows if self.grid_rows is not None else len(self.rows) + 100
+
+    def _range(self, a1):
+        grid = a1_range_to_grid_range(a1)
+        r0, r1 = grid.get('startRowIndex', 0), grid.get('endRowIndex', len(self.rows))
+        c0, c1 = grid.get('startColumnIndex', 0), grid.get('endColumnIndex', 26)
+        block = [row[c0:c1] for row in self.rows[r0:r1]]
+        while block and not any(block[-1]):
+            block.pop()
+        return block
+
+    def get_all_values(self, **kwargs):
+        self.calls.append('get_all_values')
+        return [list(row) for row in self.rows]
+
+    def get_all_records(self, **kwargs):
+        self.calls.append('get_all_records')
+        header = self.rows[0]
+        return [dict(zip(header, numericise_all(row + [""] * (len(header) - len(row))))) for row in self.rows[1:]]
+
+    def row_values(self, index, **kwargs):
+        self.calls.append('row_values')
+        return list(self.rows[index - 1]) if index <= len(self.rows) else []
+
+    def col_values(self, col, **kwargs):
+        self.calls.append('col_values')
+        return [row[col - 1] if len(row) >= col else "" for row in self.rows]
+
+    def get(self, a1, **kwargs):
+        self.calls.append(('get', a1))
+        return self._range(a1)
+
+    def batch_get(self, ranges, **kwargs):
+        self.calls.append(('batch_get', len(ranges)))
+        return [self._range(a1) for a1 in ranges]
+
+    def insert_rows(self, values, row=1, **kwargs):
+        self.calls.append(('insert_rows', len(values)))
+        for value in reversed(values):
+            self.rows.insert(row - 1, [str(v) for v in value])
+
+    def insert_row(self, values, index=1, **kwargs):
+        self.insert_rows([values], index)
+
+    def append_rows(self, values, **kwargs):
+        self.calls.append(('append_rows', len(values)))
+        start = len(self.rows) + 1
+        self.rows.extend([str(v) for v in value] for value in values)
+        return {'updates': {'updatedRange': f"{self.title}!A{start}:Z{len(self.rows)}"}}
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values])
+
+    def update(self, values=None, range_name=None, **kwargs):
+        if isinstance(values, str):
+            values, range_name = range_name, values
+        self.calls.append('update')
+        grid = a1_range_to_grid_range(range_name)
+        r0, c0 = grid.get('startRowIndex', 0), grid.get('startColumnIndex', 0)
+        for i, row in enumerate(values):
+            while len(self.rows) <= r0 + i:
+                self.rows.append([])
+            current = self.rows[r0 + i]
+            current += [""] * (c0 + len(row) - len(current))
+            current[c0:c0 + len(row)] = [str(v) for v in row]
+
+    def batch_update(self, data, **kwargs):
+        self.calls.append(('batch_update', len(data)))
+        for entry in data:
+            self.update(entry['values'], entry['range'])
+            self.calls.pop()
+
+    def api_calls(self):
+        return len(self.calls) + len(self.spreadsheet.calls)
+
+
+@pytest.fixture
+def orders_ws():
+    """Лист ЗАЯВКИ с заголовком и пятью заявками по возрастанию даты доставки"""
+    rows = [app.SHEET_HEADERS] + [order_row(1000 + i, hours=i, phone=f"+7999000000{i % 3}") for i in range(5)]
+    return FakeWorksheet(rows)
+
+
+def index_state(storage):
+    """Содержимое всех производных индексов хранилища, синхронизированных с его таблицей"""
+    table = storage.table
+    date_index = storage.date_index.sync(table)
+    numbers = storage.number_index.sync(table)
+    search = storage.search_index.sync(table)
+    rollups = storage.rollups.sync(table)
+    slots = storage.slot_index.sync(table)
+    customers = storage.customer_index.sync(table)
+    text = storage.text_index.sync(table)
+    return {
+        'dates': (date_index._ts.tolist(), date_index._valid_pos.tolist(), date_index._valid_ts.tolist()),
+        'numbers': {number: sorted(ids) for number, ids in numbers._rows.items() if ids},
+        'search': (search._fields, search._postings),
+        'rollups': (rollups.by_day, rollups.by_slot, rollups.by_item),
+        'slots': slots._days,
+        'customers': (customers._row_phone, customers._customers),
+        'text': (text._row_tokens, text._postings, text._vocabulary),
+    }
+
+
+def rebuilt_state(storage):
+    """То же содержимое индексов, построенных заново по текущей таблице"""
+    fresh = app.OrderStorage()
+    fresh.table = _ResetView(storage.table)
+    return index_state(fresh)
+
+
+class _ResetView:
+    """Таблица, у которой журнал всегда требует перестроения"""
+
+    def __init__(self, table):
+        self.df = table.df
+        self.version = table.version
+
+    def changes_since(self, version):
+        return None
+
+
+INDEX_ATTRIBUTES = ('date_index', 'number_index', 'search_index', 'rollups', 'slot_index',
+                    'customer_index', 'text_index')
+
+
+def sheet_storage(count=12):
+    """Лист с count заявками и загруженное по нему GSheetStorage с построенными индексами"""
+    orders_ws = FakeWorksheet([app.SHEET_HEADERS] + [order_row(1000 + i, hours=i, phone=f"+7999000000{i % 3}")
+                                                     for i in range(count)])
+    storage = app.GSheetStorage(orders_ws)
+    storage.load_orders()
+    index_state(storage)
+    return orders_ws, storage
+
+
+@pytest.fixture
+def synced_sheet(monkeypatch):
+    """(лист, хранилище), у индексов которого запрещено перестроение с нуля"""
+    orders_ws, storage = sheet_storage()
+
+    def no_rebuild(*args, **kwargs):
+        raise AssertionError("индекс перестроен с нуля вместо дозагрузки по журналу")
+
+    for name in INDEX_ATTRIBUTES:
+        if name == 'number_index':
+            # Перестраивается без отдельного метода; её дозагрузку проверяет index_state
+            continue
+        monkeypatch.setattr(getattr(storage, name), '_rebuild', no_rebuild)
+    return orders_ws, storage
+
+
+def sync_remote(orders_ws, storage):
+    """Дозагрузка изменений листа, внесённых другим клиентом"""
+    orders_ws.calls.clear()
+    storage.sync.mark_stale()
+    storage.load_orders()
+    assert storage.sync.stats['full_reloads'] == 1
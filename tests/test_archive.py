@@ -0,0 +1,109 @@
+from datetime import timedelta
+
+import app
+from conftest import BASE_DATE, FakeWorksheet, order_row
+
+DAY = 24
+
+
+def archived_storage():
+    """Лист с заявками за январь, февраль и март; заявки раньше BASE_DATE перенесены в архив"""
+    hours = [-DAY * 31, -DAY * 3, -DAY * 25, -DAY * 2, 0, 1, 2]
+    rows = sorted((order_row(1000 + i, hours=h) for i, h in enumerate(hours)),
+                  key=lambda row: app.parse_sheet_datetime(row[4]))
+    orders_ws = FakeWorksheet([app.SHEET_HEADERS] + rows)
+    storage = app.GSheetStorage(orders_ws)
+    storage.load_orders()
+    assert storage.archive_orders(BASE_DATE) == 4
+    return orders_ws, storage
+
+
+def archive_calls(spreadsheet):
+    """Обращения к листам архива (месячным и индексу)"""
+    return [call for ws in spreadsheet.sheets.values() if ws.title.startswith(app.ARCHIVE_SHEET_PREFIX)
+            for call in ws.calls]
+
+
+def clear_calls(spreadsheet):
+    for ws in spreadsheet.sheets.values():
+        ws.calls.clear()
+
+
+def test_archive_moves_rows_to_monthly_sheets_with_row_index():
+    orders_ws, storage = archived_storage()
+    spreadsheet = orders_ws.spreadsheet
+
+    assert [row[1] for row in orders_ws.rows[1:]] == ["1004", "1005", "1006"]
+    assert list(storage.load_orders()['НОМЕР_ЗАЯВКИ'].astype(str)) == ["1004", "1005", "1006"]
+    january = spreadsheet.worksheet("АРХИВ_2026-01")
+    february = spreadsheet.worksheet("АРХИВ_2026-02")
+    assert january.rows[0] == app.SHEET_HEADERS and [row[1] for row in january.rows[1:]] == ["1000"]
+    assert [row[1] for row in february.rows[1:]] == ["1002", "1001", "1003"]
+    assert spreadsheet.worksheet(app.WORKSHEET_NAME_ARCHIVE_INDEX).rows == [
+        app.ARCHIVE_INDEX_HEADERS,
+        ["1000", "АРХИВ_2026-01", "2"],
+        ["1002", "АРХИВ_2026-02", "2"], ["1001", "АРХИВ_2026-02", "3"], ["1003", "АРХИВ_2026-02", "4"]]
+
+    # Повторная архивация дописывает строки ниже, индекс хранит их номера
+    orders_ws.rows[1][4] = (BASE_DATE - timedelta(days=20)).strftime(app.SHEET_DATETIME_FORMAT)
+    orders_ws.rows[1][8] = "2"
+    assert storage.archive_orders(BASE_DATE) == 1
+    assert storage.archive.find("1004")[1] == 5
+
+
+def test_archived_order_lookup_reads_one_row():
+    orders_ws, storage = archived_storage()
+    spreadsheet = orders_ws.spreadsheet
+    clear_calls(spreadsheet)
+
+    worksheet, row_number, record = storage.archive.find("1001")
+    assert (worksheet.title, row_number, record['НОМЕР_ЗАЯВКИ']) == ("АРХИВ_2026-02", 3, 1001)
+    assert archive_calls(spreadsheet) == [('get', 'A3:I3')]
+
+    # Новый процесс читает индекс один раз, затем - по одной строке на заявку
+    fresh = app.GSheetStorage(orders_ws)
+    clear_calls(spreadsheet)
+    assert fresh.find_order("1003")['НОМЕР_ЗАЯВКИ'] == 1003
+    assert fresh.find_order("1000")['НОМЕР_ЗАЯВКИ'] == 1000
+    assert fresh.find_order("9999") is None
+    assert sorted(map(str, archive_calls(spreadsheet))) == sorted(
+        map(str, ['get_all_values', ('get', 'A4:I4'), ('get', 'A2:I2')]))
+
+
+def test_update_of_archived_order_rewrites_its_row():
+    orders_ws, storage = archived_storage()
+    february = orders_ws.spreadsheet.worksheet("АРХИВ_2026-02")
+    data_row = order_row(1001, hours=-DAY * 3, comment="возврат")[:len(app.EXPECTED_HEADERS)]
+
+    assert storage.update_order("1001", data_row) == app.ARCHIVED_ORDER_POSITION
+
+    assert [row[1] for row in february.rows[1:]] == ["1002", "1001", "1003"]
+    assert february.rows[2][5] == "возврат"
+    assert "get_all_values" not in february.calls
+    assert [row[1] for row in orders_ws.rows[1:]] == ["1004", "1005", "1006"]
+
+
+def test_lookup_rechecks_the_row_after_manual_edits():
+    orders_ws, storage = archived_storage()
+    february = orders_ws.spreadsheet.worksheet("АРХИВ_2026-02")
+    # Строку вставили вручную: записанный в индексе номер строки устарел
+    february.rows.insert(1, order_row(999, hours=-DAY * 5))
+
+    worksheet, row_number, record = storage.archive.find("1001")
+    assert (row_number, record['НОМЕР_ЗАЯВКИ']) == (4, 1001)
+    assert february.calls.count('get_all_values') == 1
+
+    february.calls.clear()
+    assert storage.archive.find("1001")[1] == 4
+    assert february.calls == [('get', 'A4:I4')]
+
+
+def test_index_rows_without_row_number_fall_back_to_scan():
+    orders_ws, storage = archived_storage()
+    index_ws = orders_ws.spreadsheet.worksheet(app.WORKSHEET_NAME_ARCHIVE_INDEX)
+    index_ws.rows = [row[:2] for row in index_ws.rows]
+
+    fresh = app.GSheetStorage(orders_ws)
+    assert fresh.find_order("1003")['НОМЕР_ЗАЯВКИ'] == 1003
+    assert fresh.archive.max_number() == 1003
+    assert fresh.initial_order_number() == 1007
@@ -0,0 +1,110 @@
+from datetime import timedelta
+
+import pytest
+
+import app
+from conftest import index_state, order_row, rebuilt_state, sync_remote
+
+PHONE = "+79990000001"
+
+
+def data_row(number, hours, **kwargs):
+    return order_row(number, hours=hours, phone=PHONE, **kwargs)[:len(app.EXPECTED_HEADERS)]
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = app.SQLiteStorage(str(tmp_path / "crm.db"))
+    storage.append_order(data_row(1000, 0, address="ул. Ленина, 1"))
+    storage.append_order(data_row(1001, 24, address="ул. Садовая, 7", order="Пионы - 2 шт. (по 450.00 РУБ.)"),
+                         [{'НАИМЕНОВАНИЕ': "Пионы", 'КОЛИЧЕСТВО': 2, 'ЦЕНА_ЗА_ЕД': 450.0, 'СУММА': 900.0,
+                           'КОММЕНТАРИЙ_ПОЗИЦИИ': "без упаковки"}])
+    return storage
+
+
+class Prices:
+    """Текущий прайс: только price_of()"""
+
+    def __init__(self, prices):
+        self.prices = prices
+
+    def price_of(self, name):
+        return self.prices.get(name)
+
+
+def test_last_address_is_filled_once_into_an_empty_field(storage):
+    customer = storage.customer_profile(app.is_valid_phone(PHONE))
+    state = {}
+    assert app.autofill_customer_address(state, 0, customer)
+    assert state['address_0'] == "ул. Садовая, 7"
+
+    # Оператор стёр адрес - для того же телефона он больше не подставляется
+    state['address_0'] = ""
+    assert not app.autofill_customer_address(state, 0, customer)
+    assert state['address_0'] == ""
+    # Введённый вручную адрес не перезаписывается, новая форма заполняется снова
+    state['address_1'] = "пр. Мира, 5"
+    assert not app.autofill_customer_address(state, 1, customer)
+    assert app.autofill_customer_address(state, 2, customer) and state['address_2'] == "ул. Садовая, 7"
+
+
+def test_known_address_replaces_the_field(storage, monkeypatch):
+    customer = storage.customer_profile(app.is_valid_phone(PHONE))
+    assert sorted(customer.addresses) == ["ул. Ленина, 1", "ул. Садовая, 7"]
+    state = {'address_0': "ул. Садовая, 7", 'known_address_0': "ул. Ленина, 1"}
+    monkeypatch.setattr(app.st, 'session_state', state)
+    app.use_known_address(0)
+    assert state['address_0'] == "ул. Ленина, 1"
+
+
+def test_repeat_last_order_uses_saved_items_and_current_prices(storage):
+    customer = storage.customer_profile(app.is_valid_phone(PHONE))
+    last = customer.orders[0]
+    assert str(last['НОМЕР_ЗАЯВКИ']) == "1001"
+
+    items = app.repeat_order_items(storage, last, Prices({"Пионы": 500.0}))
+    assert items == [{'НАИМЕНОВАНИЕ': "Пионы", 'КОЛИЧЕСТВО': 2, 'ЦЕНА_ЗА_ЕД': 500.0, 'СУММА': 1000.0,
+                      'КОММЕНТАРИЙ_ПОЗИЦИИ': "без упаковки"}]
+    # Позиции нет в прайсе - остаётся прежняя цена
+    assert app.repeat_order_items(storage, last, Prices({}))[0]['СУММА'] == 900.0
+
+
+def test_repeat_order_without_saved_items_parses_order_text(storage):
+    first = storage.customer_profile(app.is_valid_phone(PHONE)).orders[1]
+    items = app.repeat_order_items(storage, first, Prices({"Розы": 120.0}))
+    assert [(item['НАИМЕНОВАНИЕ'], item['КОЛИЧЕСТВО'], item['СУММА']) for item in items] == [("Розы", 3, 360.0)]
+
+
+def test_item_counters_match_rebuild_for_unusual_order_texts(synced_sheet):
+    orders_ws, storage = synced_sheet
+    texts = [" - 2 шт. (по 5.00 РУБ.)\nРозы - 1 шт. (по 100.00 РУБ.)",
+             "Розы - 1 шт. (по 1 000,00 РУБ.) | в коробке - 2 шт.",
+             "Тюльпаны-5шт.(по 50 РУБ.)\n\nне позиция"]
+    for i, text in enumerate(texts):
+        orders_ws.rows[i + 1] = order_row(1000 + i, hours=i, phone="+79990000000", order=text, revision="2")
+    sync_remote(orders_ws, storage)
+    assert index_state(storage)['customers'] == rebuilt_state(storage)['customers']
+
+    del orders_ws.rows[1:3]
+    orders_ws.calls.clear()
+    storage.sync.mark_stale()
+    storage.load_orders()
+    assert index_state(storage)['customers'] == rebuilt_state(storage)['customers']
+    assert "" not in dict(storage.customer_profile(app.is_valid_phone("+79990000000")).items)
+
+
+def test_remote_delta_updates_customer_profiles_incrementally(synced_sheet):
+    orders_ws, storage = synced_sheet
+    phone, other = app.is_valid_phone("+79990000001"), app.is_valid_phone("+79990000009")
+    assert storage.customer_profile(phone).order_count == 4
+
+    orders_ws.rows.append(order_row(2000, hours=20, phone="+79990000001", address="ул. Садовая, 7"))
+    orders_ws.rows[5] = order_row(1004, hours=4, phone="+79990000009", revision="2")
+    del orders_ws.rows[2]
+    sync_remote(orders_ws, storage)
+
+    profile = storage.customer_profile(phone)
+    assert profile.order_count == 3
+    assert profile.orders[0]['НОМЕР_ЗАЯВКИ'] in ('2000', 2000)
+    assert "ул. Садовая, 7" in profile.addresses
+    assert storage.customer_profile(other).order_count == 1
@@ -0,0 +1,119 @@
+import io
+from datetime import timedelta
+
+import pandas as pd
+import pytest
+
+import app
+from conftest import BASE_DATE, order_row, sheet_storage
+
+ROSES = "Розы - 3 шт. (по 100.00 РУБ.) | без упаковки\nЛента - 1 шт. (по 20.50 РУБ.)"
+
+
+def data_row(number, hours, **kwargs):
+    return order_row(number, hours=hours, **kwargs)[:len(app.EXPECTED_HEADERS)]
+
+
+def exported_numbers(storage, window=None, search_term="", text_query="", chunk_rows=2):
+    frames = app.iter_export_frames(storage, window, search_term, False, text_query, chunk_rows)
+    return [number for frame in frames for number in frame['НОМЕР_ЗАЯВКИ']]
+
+
+@pytest.fixture
+def no_chunk_index(monkeypatch):
+    """Выгрузка не строит индекс по кускам - только поддерживаемый индекс хранилища"""
+    def forbidden(df):
+        raise AssertionError("OrderTextIndex.from_frame() в выгрузке")
+    monkeypatch.setattr(app.OrderTextIndex, 'from_frame', forbidden)
+
+
+@pytest.fixture
+def sqlite_storage(tmp_path):
+    storage = app.SQLiteStorage(str(tmp_path / "crm.db"))
+    storage.append_orders([data_row(1000 + i, hours=i, comment="домофон" if i % 3 == 0 else "")
+                           for i in range(8)])
+    return storage
+
+
+def test_sqlite_text_query_exports_index_rows_by_id(sqlite_storage, monkeypatch, no_chunk_index):
+    # Одинаковые состав и комментарий у разных заявок: в выгрузку идут строки, найденные индексом
+    monkeypatch.setattr(sqlite_storage, 'iter_orders', lambda *args: pytest.fail("курсор SQLite при поиске по составу"))
+    assert exported_numbers(sqlite_storage, text_query="Домофона") == []
+    assert exported_numbers(sqlite_storage, text_query="домофон") == ["1000", "1003", "1006"]
+    window = (BASE_DATE + timedelta(hours=1), BASE_DATE + timedelta(hours=5))
+    assert exported_numbers(sqlite_storage, window, text_query="домоф") == ["1003"]
+    assert exported_numbers(sqlite_storage, window, search_term="1004", text_query="домоф") == []
+
+
+def test_sqlite_export_without_text_query_streams_from_cursor(sqlite_storage):
+    window = (BASE_DATE + timedelta(hours=2), BASE_DATE + timedelta(hours=6))
+    assert exported_numbers(sqlite_storage, window) == ["1002", "1003", "1004", "1005"]
+    assert exported_numbers(sqlite_storage, search_term="1007") == ["1007"]
+    assert not sqlite_storage.table.loaded
+
+
+def test_sheet_export_streams_ranges_without_loading_the_table():
+    orders_ws, _ = sheet_storage(10)
+    storage = app.GSheetStorage(orders_ws)
+    orders_ws.calls.clear()
+    window = (BASE_DATE + timedelta(hours=2), BASE_DATE + timedelta(hours=7))
+
+    assert exported_numbers(storage, window, chunk_rows=2) == ["1002", "1003", "1004", "1005", "1006"]
+
+    assert not storage.table.loaded
+    assert [call for call in orders_ws.calls if call[0] == 'get'] == [
+        ('get', 'A4:I5'), ('get', 'A6:I7'), ('get', 'A8:I8')]
+    assert exported_numbers(storage, chunk_rows=4) == [str(1000 + i) for i in range(10)]
+
+
+def test_sheet_text_query_uses_maintained_index(no_chunk_index):
+    orders_ws, storage = sheet_storage(6)
+    orders_ws.rows[3] = order_row(1002, hours=2, order="Пионы - 2 шт. (по 450.00 РУБ.)", total=900,
+                                  revision="2")
+    storage.resync()
+    assert exported_numbers(storage, text_query="пион") == ["1002"]
+    assert exported_numbers(storage, text_query="розы") == ["1000", "1001", "1003", "1004", "1005"]
+
+
+def normalised(frame):
+    """Значения выгрузки без различий форматов: числа - float/int, пустое - None"""
+    result = {}
+    for column in frame.columns:
+        if column in app.EXPORT_FLOAT_COLUMNS or column == 'КОЛИЧЕСТВО':
+            values = pd.to_numeric(frame[column], errors='coerce')
+            result[column] = [None if pd.isna(v) else float(v) for v in values]
+        else:
+            result[column] = ["" if pd.isna(v) else str(v) for v in frame[column]]
+    return result
+
+
+def read_back(export_format, data, columns):
+    handle = io.BytesIO(data)
+    text_columns = {column: str for column in columns
+                    if column not in app.EXPORT_FLOAT_COLUMNS and column != 'КОЛИЧЕСТВО'}
+    if export_format == "CSV":
+        return pd.read_csv(handle, encoding='utf-8-sig', dtype=text_columns, keep_default_na=False,
+                           na_values={c: [""] for c in columns if c not in text_columns})
+    if export_format == "XLSX":
+        return pd.read_excel(handle, dtype=text_columns, engine='openpyxl')
+    return pd.read_parquet(handle)
+
+
+@pytest.mark.parametrize('expand_items', [False, True])
+@pytest.mark.parametrize('export_format', ["CSV", "XLSX", "Parquet"])
+def test_export_round_trip(sqlite_storage, export_format, expand_items):
+    if export_format == "XLSX":
+        pytest.importorskip("openpyxl")
+    sqlite_storage.update_order("1002", data_row(1002, hours=2, order=ROSES, total=320.5, comment="позвонить"))
+    sqlite_storage.update_order("1005", data_row(1005, hours=5, order="свободный текст", total=0))
+    frames = list(app.iter_export_frames(sqlite_storage, None, "", expand_items, chunk_rows=3))
+    columns = app.export_columns(expand_items)
+    handle = io.BytesIO()
+
+    rows = app.write_orders_export(iter(frames), export_format, columns, handle)
+
+    expected = pd.concat(frames, ignore_index=True)
+    assert rows == len(expected) == 8 + (1 if expand_items else 0)
+    result = read_back(export_format, handle.getvalue(), columns)
+    assert list(result.columns) == columns
+    assert normalised(result) == normalised(expected)
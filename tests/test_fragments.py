@@ -0,0 +1,103 @@
+import pytest
+from streamlit.testing.v1 import AppTest
+
+import app
+
+LIST_TAB = '📋 Список Заявок'
+
+
+def fragment_script():
+    import streamlit as st
+
+    import app
+
+    st.session_state.app_runs = st.session_state.get('app_runs', 0) + 1
+
+    @st.fragment(key="part")
+    def part():
+        st.session_state.part_runs = st.session_state.get('part_runs', 0) + 1
+        if st.session_state.get('request_rerun'):
+            st.session_state.request_rerun = False
+            app.rerun_fragment()
+
+    part()
+    st.button("Обновить часть", on_click=lambda: st.rerun("part"))
+
+
+@pytest.fixture
+def fragment_app():
+    at = AppTest.from_function(fragment_script)
+    at.run()
+    assert (at.session_state.app_runs, at.session_state.part_runs) == (1, 1)
+    return at
+
+
+def test_rerun_fragment_during_full_run_reruns_the_page(fragment_app):
+    fragment_app.session_state.request_rerun = True
+    fragment_app.run()
+    assert not fragment_app.exception
+    assert (fragment_app.session_state.app_runs, fragment_app.session_state.part_runs) == (3, 3)
+
+
+def test_rerun_fragment_during_fragment_run_stays_in_fragment(fragment_app):
+    fragment_app.session_state.request_rerun = True
+    fragment_app.button[0].click().run()
+    assert not fragment_app.exception
+    # Нажатие перезапускает только фрагмент, rerun_fragment() внутри него - снова только его
+    assert (fragment_app.session_state.app_runs, fragment_app.session_state.part_runs) == (1, 3)
+
+
+@pytest.fixture(scope="module")
+def sqlite_path(tmp_path_factory):
+    # get_storage() кэшируется на процесс: у всех запусков страницы одна и та же база
+    return str(tmp_path_factory.mktemp("fragments") / "crm.db")
+
+
+@pytest.fixture
+def page(sqlite_path, monkeypatch):
+    monkeypatch.setenv("CRM_STORAGE_BACKEND", "sqlite")
+    monkeypatch.setenv("CRM_SQLITE_PATH", sqlite_path)
+    monkeypatch.setenv("CRM_SHEETS_MIRROR", "0")
+    at = AppTest.from_file(app.__file__, default_timeout=60)
+    at.run()
+    assert not at.exception
+    return at
+
+
+def tab_sizes(at):
+    return {tab.label: len(tab.children) for tab in at.tabs}
+
+
+def test_closed_tabs_are_not_rendered(page):
+    assert [size for size in tab_sizes(page).values()] == [1, 0, 0, 0]
+    assert 'order_list_period' not in [radio.key for radio in page.radio]
+
+    page.session_state['main_tab'] = LIST_TAB
+    page.run()
+
+    assert tab_sizes(page)[LIST_TAB] == 1
+    assert 'order_list_period' in [radio.key for radio in page.radio]
+
+
+def test_list_filters_survive_closing_the_tab(page):
+    page.session_state['main_tab'] = LIST_TAB
+    page.run()
+    page.radio(key='order_list_period').set_value(list(app.LIST_PERIOD_OPTIONS)[-1]).run()
+
+    page.session_state['main_tab'] = '📊 Аналитика'
+    page.run()
+    assert 'order_list_period' not in [radio.key for radio in page.radio]
+    page.session_state['main_tab'] = LIST_TAB
+    page.run()
+
+    assert page.radio(key='order_list_period').value == list(app.LIST_PERIOD_OPTIONS)[-1]
+
+
+def test_mode_switch_in_entry_fragment_rerenders_the_form(page):
+    form_key = page.session_state.form_key
+    page.radio(key='mode_selector').set_value('Редактировать существующую').run()
+
+    assert not page.exception
+    assert page.session_state.app_mode == 'edit'
+    assert page.session_state.form_key == form_key + 1
+    assert "Режим Редактирования" in page.info[0].value
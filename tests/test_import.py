@@ -0,0 +1,29 @@
+import pytest
+
+import app
+from conftest import order_row, sheet_storage
+
+
+def import_calls(count):
+    orders_ws, storage = sheet_storage(10)
+    allocator = app.OrderNumberAllocator(storage)
+    allocator.reserve()
+    spreadsheet = orders_ws.spreadsheet
+    for ws in spreadsheet.worksheets():
+        ws.calls.clear()
+    spreadsheet.calls.clear()
+    numbers = allocator.reserve_many(count)
+    items = [{'НАИМЕНОВАНИЕ': "Розы", 'КОЛИЧЕСТВО': 3, 'ЦЕНА_ЗА_ЕД': 100.0, 'СУММА': 300.0,
+              'КОММЕНТАРИЙ_ПОЗИЦИИ': ""}]
+    rows = [order_row(number, hours=i % 24)[:len(app.EXPECTED_HEADERS)] for i, number in enumerate(numbers)]
+    assert app.import_order_data(rows, storage, [items] * count)
+    assert list(storage.table.df['НОМЕР_ЗАЯВКИ'].astype(str)).count(numbers[-1]) == 1
+    return sum(len(ws.calls) for ws in spreadsheet.worksheets()) + len(spreadsheet.calls)
+
+
+@pytest.mark.parametrize('count', [30, 120])
+def test_import_costs_constant_number_of_sheet_calls(count):
+    calls = import_calls(count)
+    assert calls == import_calls(5)
+    # Резерв номеров, сверка столбцов B и I перед записью, batchUpdate и дозапись позиций
+    assert calls <= 5
@@ -0,0 +1,37 @@
+import time
+
+import app
+from conftest import sheet_storage
+
+ITEMS = [{'НАИМЕНОВАНИЕ': "Розы", 'КОЛИЧЕСТВО': 3, 'ЦЕНА_ЗА_ЕД': 100.0, 'СУММА': 300.0, 'КОММЕНТАРИЙ_ПОЗИЦИИ': ""}]
+
+
+def test_items_sheet_is_read_incrementally(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    orders_ws, storage = sheet_storage(3)
+    items_ws = app.open_order_items_worksheet(orders_ws.spreadsheet)
+    items_ws.append_rows([["1000", "Розы", "3", "100", "", "1"], ["1000", "Лента", "1", "20", "", "1"],
+                          ["1001", "Тюльпаны", "5", "50", "", "1"]])
+    items_ws.calls.clear()
+
+    items = storage.load_order_items({'НОМЕР_ЗАЯВКИ': "1000", app.REVISION_HEADER: "1"})
+    assert [item['НАИМЕНОВАНИЕ'] for item in items] == ["Розы", "Лента"]
+    assert items_ws.calls == [('get', 'A2:F')]
+
+    # Своя запись и строки другого процесса; затем дочитываются только новые строки
+    storage._save_items("1002", "7", ITEMS)
+    items_ws.append_rows([["1001", "Пионы", "2", "450", "", "2"]])
+    items_ws.calls.clear()
+    now[0] += app.SHEETS_SYNC_INTERVAL_SECONDS + 1
+    items = storage.load_order_items({'НОМЕР_ЗАЯВКИ': "1001", app.REVISION_HEADER: "2"})
+    assert [item['НАИМЕНОВАНИЕ'] for item in items] == ["Пионы"]
+    assert items_ws.calls == [('get', 'A5:F')]
+    assert storage.load_order_items({'НОМЕР_ЗАЯВКИ': "1002", app.REVISION_HEADER: "7"})[0]['КОЛИЧЕСТВО'] == 3
+    assert storage.load_order_items({'НОМЕР_ЗАЯВКИ': "1001", app.REVISION_HEADER: "1"})[0]['КОЛИЧЕСТВО'] == 5
+
+    # Новых строк нет - читается пустой хвост
+    now[0] += app.SHEETS_SYNC_INTERVAL_SECONDS + 1
+    items_ws.calls.clear()
+    assert storage.load_order_items({'НОМЕР_ЗАЯВКИ': "9999", app.REVISION_HEADER: "1"}) is None
+    assert items_ws.calls == [('get', 'A7:F')]
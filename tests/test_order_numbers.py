@@ -0,0 +1,53 @@
+import threading
+
+import app
+from conftest import order_row, sheet_storage
+
+
+def test_reserve_many_checks_collisions_locally():
+    orders_ws, storage = sheet_storage(3)
+    block = storage.reserve_number_block(1)
+    counter_ws = orders_ws.spreadsheet.worksheet(app.WORKSHEET_NAME_COUNTER)
+    # Номер, введённый в лист вручную, попадает в следующий блок счётчика
+    manual = block + app.ORDER_NUMBER_BLOCK_SIZE + 2
+    orders_ws.rows.append(order_row(manual, hours=5))
+    storage.resync()
+    orders_ws.calls.clear()
+    counter_ws.calls.clear()
+
+    numbers = app.OrderNumberAllocator(storage).reserve_many(50)
+
+    assert len(numbers) == len(set(numbers)) == 50
+    assert str(manual) not in numbers
+    # Ни одного чтения листа ЗАЯВКИ; резервирование - одна запись плюс добор вместо занятого номера
+    assert orders_ws.calls == []
+    assert counter_ws.calls == [('append_rows', 10), ('append_rows', 1)]
+
+
+def test_sheet_blocks_do_not_overlap_between_replicas():
+    orders_ws, storage = sheet_storage(3)
+    replica = app.GSheetStorage(orders_ws)
+    first, second = app.OrderNumberAllocator(storage), app.OrderNumberAllocator(replica)
+    taken = first.reserve_many(12) + second.reserve_many(7) + [first.reserve() for _ in range(8)]
+    taken += [second.reserve() for _ in range(8)] + first.reserve_many(3)
+    assert len(taken) == len(set(taken))
+
+
+def test_concurrent_reserve_hands_out_unique_numbers(tmp_path):
+    storage = app.SQLiteStorage(str(tmp_path / "crm.db"))
+    storage.append_orders([order_row(app.ORDER_NUMBER_START + 1, hours=1)[:len(app.EXPECTED_HEADERS)]])
+    allocators = [app.OrderNumberAllocator(storage), app.OrderNumberAllocator(storage)]
+    taken, lock = [], threading.Lock()
+
+    def worker(allocator):
+        numbers = [allocator.reserve() for _ in range(20)] + allocator.reserve_many(15)
+        with lock:
+            taken.extend(numbers)
+
+    threads = [threading.Thread(target=worker, args=(allocators[i % 2],)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(taken) == len(set(taken)) == 6 * 35
+    assert str(app.ORDER_NUMBER_START + 1) not in taken
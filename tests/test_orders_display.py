@@ -0,0 +1,44 @@
+import pandas as pd
+
+import app
+from conftest import order_row
+
+
+def orders_frame(rows):
+    return pd.DataFrame(rows, columns=app.SHEET_HEADERS, index=[10 + i for i in range(len(rows))])
+
+
+def test_display_is_sorted_by_delivery_and_formatted():
+    rows = [order_row(1000, hours=5, order="Розы - 3 шт.\nЛента - 1 шт.", total="320,5"),
+            order_row(1001, hours=1, comment="позвонить"),
+            order_row(1002, hours=3, total=""),
+            order_row(1003, hours=1),
+            order_row(1004, hours=2)]
+    rows[2][4] = "02.03.2026 10:30"       # без секунд
+    rows[4][4] = "уточнить"               # не распознана
+    rows[4][0] = ""
+
+    df = app.prepare_orders_display(orders_frame(rows))
+
+    assert list(df['НОМЕР_ЗАЯВКИ']) == ["1001", "1003", "1002", "1000", "1004"]
+    # Индекс - идентификаторы строк таблицы: по ним фильтрует поиск
+    assert list(df.index) == [11, 13, 12, 10, 14]
+    assert list(df['ДАТА_ДОСТАВКИ_ОТОБРАЖЕНИЕ']) == [
+        "02.03.2026 10:00", "02.03.2026 10:00", "02.03.2026 10:30", "02.03.2026 14:00", "уточнить"]
+    assert list(df['ДАТА_ВВОДА_ОТОБРАЖЕНИЕ']) == ["02.03.2026 09:00"] * 4 + [""]
+    assert df['ДАТА_ДОСТАВКИ_DT'].iloc[:4].tolist() == [
+        pd.Timestamp(2026, 3, 2, 10), pd.Timestamp(2026, 3, 2, 10), pd.Timestamp(2026, 3, 2, 10, 30),
+        pd.Timestamp(2026, 3, 2, 14)]
+    assert pd.isna(df['ДАТА_ДОСТАВКИ_DT'].iloc[4])
+    assert df.loc[10, 'ЗАКАЗ'] == "Розы - 3 шт.<br>Лента - 1 шт."
+    assert df.loc[11, 'КОММЕНТАРИЙ'] == "позвонить"
+    # Нечисловая и пустая сумма - 0
+    assert df['СУММА'].tolist() == [300, 300, 0, 0, 300]
+
+
+def test_display_cache_is_keyed_by_version():
+    frame = orders_frame([order_row(1000 + i, hours=i) for i in range(3)])
+    first = app.build_orders_display(("display-test", 1), frame)
+    assert app.build_orders_display(("display-test", 1), frame) is first
+    changed = orders_frame([order_row(1000 + i, hours=-i) for i in range(3)])
+    assert list(app.build_orders_display(("display-test", 2), changed)['НОМЕР_ЗАЯВКИ']) == ["1002", "1001", "1000"]
@@ -0,0 +1,74 @@
+import pandas as pd
+
+import app
+from conftest import index_state, order_row, rebuilt_state
+
+
+def make_storage(rows):
+    storage = app.OrderStorage()
+    storage.table = app.OrdersTable(app.SHEET_HEADERS)
+    storage.table.replace(pd.DataFrame(rows, columns=app.SHEET_HEADERS))
+    return storage
+
+
+def frame(rows):
+    return pd.DataFrame(rows, columns=app.SHEET_HEADERS)
+
+
+KEY = ['НОМЕР_ЗАЯВКИ', app.REVISION_HEADER]
+
+
+def test_merge_without_changes_keeps_version():
+    rows = [order_row(1000 + i, hours=i) for i in range(4)]
+    storage = make_storage(rows)
+    version = storage.table.version
+    assert storage.table.merge(frame(rows), KEY) == 0
+    assert storage.table.version == version
+
+
+def test_merge_logs_only_changed_rows_and_indexes_follow():
+    rows = [order_row(1000 + i, hours=i, phone=f"+7999000000{i % 3}") for i in range(6)]
+    storage = make_storage(rows)
+    index_state(storage)
+    old_ids = list(storage.table.df.index)
+    version = storage.table.version
+
+    updated = order_row(1002, hours=10, phone="+79990000009", order="Тюльпаны - 5 шт. (по 50.00 РУБ.)",
+                        total=250, revision="2", comment="позвонить")
+    new_rows = [rows[0], rows[1], updated, rows[4], order_row(1006, hours=4), rows[5],
+                order_row(1007, hours=20, order="Пионы - 1 шт. (по 900.00 РУБ.)", total=900)]
+    logged = storage.table.merge(frame(new_rows), KEY)
+
+    changes = storage.table.changes_since(version)
+    assert changes is not None
+    assert len(changes) == logged
+    assert sorted(change.kind for change in changes) == ['delete', 'insert', 'insert', 'update']
+    assert storage.table.df[app.SHEET_HEADERS].astype(str).values.tolist() == \
+        [[str(v) for v in row] for row in new_rows]
+    # Неизменённые строки сохранили идентификаторы
+    kept = dict(zip(storage.table.df['НОМЕР_ЗАЯВКИ'], storage.table.df.index))
+    for position in (0, 1, 4, 5):
+        assert kept[rows[position][1]] == old_ids[position]
+    assert index_state(storage) == rebuilt_state(storage)
+
+
+def test_merge_handles_reordered_rows():
+    rows = [order_row(1000 + i, hours=i) for i in range(6)]
+    storage = make_storage(rows)
+    index_state(storage)
+    version = storage.table.version
+    new_rows = [rows[0], rows[4], rows[1], rows[2], rows[3], rows[5]]
+    storage.table.merge(frame(new_rows), KEY)
+    assert storage.table.changes_since(version) is not None
+    assert list(storage.table.df['НОМЕР_ЗАЯВКИ']) == [row[1] for row in new_rows]
+    assert index_state(storage) == rebuilt_state(storage)
+
+
+def test_merge_falls_back_to_replace_for_large_delta():
+    rows = [order_row(1000 + i, hours=i) for i in range(3)]
+    storage = make_storage(rows)
+    version = storage.table.version
+    many = [order_row(5000 + i, hours=i) for i in range(app.OrdersTable.CHANGE_LOG_LIMIT + 5)]
+    assert storage.table.merge(frame(many), KEY) == -1
+    assert storage.table.changes_since(version) is None
+    assert len(storage.table.df) == len(many)
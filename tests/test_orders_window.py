@@ -0,0 +1,61 @@
+from datetime import timedelta
+
+import pytest
+
+import app
+from conftest import BASE_DATE, FakeWorksheet, order_row
+
+
+def sheet(count, minutes=6):
+    """count заявок, по одной каждые minutes минут; у соседних строк бывает одна дата"""
+    return FakeWorksheet([app.SHEET_HEADERS] + [order_row(1000 + i, hours=(i // 2) * minutes / 60)
+                                                for i in range(count)])
+
+
+def expected_numbers(orders_ws, start, end):
+    full = app.GSheetStorage(FakeWorksheet([list(row) for row in orders_ws.rows]))
+    window = full.load_orders()
+    dates = app.parse_sheet_datetimes(window['ДАТА_ДОСТАВКИ'])
+    mask = (dates >= app.np.datetime64(start)) & (dates < app.np.datetime64(end))
+    return list(window.loc[mask, 'НОМЕР_ЗАЯВКИ'].astype(str))
+
+
+@pytest.mark.parametrize('hours', [(0, 1), (100, 110.5), (299.4, 400), (-5, 0), (500, 600)])
+def test_window_reads_only_its_rows(hours):
+    orders_ws = sheet(6000)
+    storage = app.GSheetStorage(orders_ws)
+    start, end = (BASE_DATE + timedelta(hours=h) for h in hours)
+
+    frame, version = storage.load_orders_window(start, end)
+
+    assert version is None and not storage.table.loaded
+    numbers = list(frame['НОМЕР_ЗАЯВКИ'].astype(str))
+    assert numbers == expected_numbers(orders_ws, start, end)
+    probes = [call for call in orders_ws.calls if call[0] == 'batch_get']
+    reads = [call for call in orders_ws.calls if call[0] == 'get']
+    # Ни одного чтения столбца целиком: несколько раундов по ячейке и один диапазон строк окна
+    assert len(probes) <= 5
+    assert sum(n for _, n in probes) <= 4 * 2 * (app.SHEETS_WINDOW_PROBES + 1) + 1
+    if numbers:
+        first = int(numbers[0]) - 1000 + 2
+        assert reads == [('get', f'A{first}:I{first + len(numbers) - 1}')]
+    else:
+        assert reads == []
+
+
+def test_grid_size_smaller_than_data_is_extended():
+    orders_ws = sheet(500)
+    orders_ws.grid_rows = 20
+    storage = app.GSheetStorage(orders_ws)
+    start, end = BASE_DATE + timedelta(hours=20), BASE_DATE + timedelta(hours=30)
+    frame, _ = storage.load_orders_window(start, end)
+    assert list(frame['НОМЕР_ЗАЯВКИ'].astype(str)) == expected_numbers(orders_ws, start, end)
+
+
+def test_unparsable_date_falls_back_to_the_table():
+    orders_ws = sheet(200)
+    for row in orders_ws.rows[101:]:
+        row[4] = "не дата"
+    storage = app.GSheetStorage(orders_ws)
+    frame, version = storage.load_orders_window(BASE_DATE, BASE_DATE + timedelta(hours=30))
+    assert version is not None and storage.table.loaded
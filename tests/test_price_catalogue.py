@@ -0,0 +1,52 @@
+import time
+
+import pandas as pd
+
+import app
+
+
+class PriceStorage(app.OrderStorage):
+    """Хранилище с прайсом, ревизия которого не замечает обмен ценами"""
+
+    def __init__(self):
+        super().__init__()
+        self.prices = pd.DataFrame({'НАИМЕНОВАНИЕ': ["Розы", "Тюльпаны"], 'ЦЕНА': [100.0, 50.0]})
+        self.loads = 0
+
+    def load_prices(self):
+        self.loads += 1
+        return self.prices.copy()
+
+    def price_revision(self):
+        return f"{len(self.prices)}-{self.prices['ЦЕНА'].sum()}"
+
+
+def test_unchanged_revision_still_reloads_after_max_age(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    storage = PriceStorage()
+    catalogue = app.PriceCatalogue(storage).refresh()
+    assert catalogue.prices["Розы"] == 100.0
+
+    storage.prices['ЦЕНА'] = [50.0, 100.0]
+    now[0] += app.PRICE_REVISION_CHECK_SECONDS + 1
+    catalogue.refresh()
+    assert storage.loads == 1
+    assert catalogue.prices["Розы"] == 100.0
+
+    now[0] += app.PRICE_RELOAD_FALLBACK_SECONDS
+    catalogue.refresh()
+    assert storage.loads == 2
+    assert catalogue.prices["Розы"] == 50.0
+
+
+def test_changed_revision_reloads_immediately(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    storage = PriceStorage()
+    catalogue = app.PriceCatalogue(storage).refresh()
+    storage.prices.loc[0, 'ЦЕНА'] = 120.0
+    now[0] += app.PRICE_REVISION_CHECK_SECONDS + 1
+    catalogue.refresh()
+    assert storage.loads == 2
+    assert catalogue.prices["Розы"] == 120.0
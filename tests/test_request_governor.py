@@ -0,0 +1,119 @@
+import pytest
+import requests
+
+import app
+
+
+class FakeClock:
+    """Время и сон для SheetsRequestGovernor: sleep() только сдвигает часы"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def http_error(status, retry_after=None):
+    response = requests.Response()
+    response.status_code = status
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return requests.exceptions.HTTPError(response=response)
+
+
+class Script:
+    """Заглушка запроса: по очереди бросает исключения из сценария или возвращает значение"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def governor(clock, **kwargs):
+    kwargs.setdefault('requests_per_minute', 6000)
+    kwargs.setdefault('burst', 100)
+    return app.SheetsRequestGovernor(clock=clock, sleep=clock.sleep, **kwargs)
+
+
+def test_read_retries_transient_errors_and_honours_retry_after():
+    clock = FakeClock()
+    gov = governor(clock)
+    script = Script(http_error(503), requests.exceptions.ConnectionError(), http_error(429, retry_after=40), "ok")
+    assert gov.call(script) == "ok"
+    assert script.calls == 4
+    assert len(clock.sleeps) == 3
+    assert clock.sleeps[0] <= app.SHEETS_BACKOFF_BASE_SECONDS
+    assert clock.sleeps[1] <= app.SHEETS_BACKOFF_BASE_SECONDS * 2
+    assert clock.sleeps[2] == 40
+    stats = gov.stats()
+    assert (stats['requests'], stats['retries'], stats['failures']) == (4, 3, 0)
+
+
+@pytest.mark.parametrize('error', [http_error(500), http_error(503), http_error(408),
+                                   requests.exceptions.ConnectionError(), requests.exceptions.Timeout()])
+def test_write_is_not_retried_after_it_may_have_been_applied(error):
+    clock = FakeClock()
+    gov = governor(clock)
+    script = Script(error, "duplicated")
+    with pytest.raises(type(error)):
+        gov.call(script, idempotent=False)
+    assert script.calls == 1
+    assert clock.sleeps == []
+    assert gov.stats()['failures'] == 1
+
+
+def test_write_is_retried_on_rate_limit():
+    clock = FakeClock()
+    gov = governor(clock)
+    script = Script(http_error(429), http_error(429, retry_after=3), "ok")
+    assert gov.call(script, idempotent=False) == "ok"
+    assert script.calls == 3
+    assert clock.sleeps[1] == 3
+
+
+def test_retries_stop_after_max_retries():
+    clock = FakeClock()
+    gov = governor(clock, max_retries=2)
+    script = Script(*[http_error(502)] * 5)
+    with pytest.raises(requests.exceptions.HTTPError):
+        gov.call(script)
+    assert script.calls == 3
+    assert gov.stats()['failures'] == 1
+
+
+def test_token_bucket_spaces_requests_beyond_burst():
+    clock = FakeClock()
+    gov = governor(clock, requests_per_minute=60, burst=2)
+    for _ in range(4):
+        gov.call(lambda: None)
+    assert clock.sleeps == [pytest.approx(1.0), pytest.approx(1.0)]
+    assert gov.stats()['rate_limit_wait_seconds'] == pytest.approx(2.0)
+
+
+@pytest.mark.parametrize('method, idempotent', [('GET', True), ('PUT', True), ('POST', False)])
+def test_http_client_marks_non_idempotent_methods(monkeypatch, method, idempotent):
+    recorded = {}
+
+    class RecordingGovernor:
+        def call(self, fn, dedupe_key=None, idempotent=True):
+            recorded['idempotent'] = idempotent
+            return fn()
+
+    monkeypatch.setattr(app.HTTPClient, 'request', lambda self, *args, **kwargs: "response")
+    client = app.QuotaAwareHTTPClient.__new__(app.QuotaAwareHTTPClient)
+    client.governor = RecordingGovernor()
+    assert client.request(method, "https://sheets.googleapis.com/v4/spreadsheets/x/values:append") == "response"
+    assert recorded['idempotent'] is idempotent
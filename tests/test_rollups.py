@@ -0,0 +1,97 @@
+from datetime import timedelta
+
+import pytest
+
+import app
+from conftest import BASE_DATE, order_row, sync_remote
+
+ROSES = "Розы - {0} шт. (по 100.00 РУБ.)"
+PEONIES = "Пионы - {0} шт. (по 450.00 РУБ.)"
+
+
+def data_row(number, hours, order, total, **kwargs):
+    return order_row(number, hours=hours, order=order, total=total, **kwargs)[:len(app.EXPECTED_HEADERS)]
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """SQLite: три заявки в понедельник, одна во вторник и одна на следующей неделе;
+    сводки построены, дальше - только по журналу изменений"""
+    storage = app.SQLiteStorage(str(tmp_path / "crm.db"))
+    storage.append_orders([
+        data_row(1000, 0, ROSES.format(3), 300),
+        data_row(1001, 0.5, ROSES.format(2) + "\n" + PEONIES.format(1), 650),
+        data_row(1002, 3, PEONIES.format(2), 900),
+        data_row(1003, 24, ROSES.format(5), 500),
+        data_row(1004, 24 * 7 + 2, ROSES.format(1), 100),
+    ])
+    storage.order_rollups()
+
+    def no_rebuild(df):
+        raise AssertionError("сводки пересчитаны по всей таблице")
+    monkeypatch.setattr(storage.rollups, '_rebuild', no_rebuild)
+    return storage
+
+
+def totals(frame):
+    return {key: (revenue, count) for key, revenue, count in frame.itertuples()}
+
+
+def test_daily_weekly_slot_and_item_totals(storage):
+    rollups = storage.order_rollups()
+    monday, next_monday = BASE_DATE.date(), BASE_DATE.date() + timedelta(days=7)
+    assert totals(rollups.daily_frame()) == {monday: (1850, 3), monday + timedelta(days=1): (500, 1),
+                                             next_monday: (100, 1)}
+    assert totals(rollups.weekly_frame()) == {monday: (2350, 4), next_monday: (100, 1)}
+    assert rollups.slot_frame()['ЗАЯВОК'].to_dict() == {"09:00": 2, "09:30": 1, "11:00": 1, "12:00": 1}
+    top = rollups.top_items(1)
+    assert top.values.tolist() == [["Розы", 11, 1100.0]]
+
+
+def test_overwrite_moves_contribution_between_days_and_items(storage):
+    storage.update_order("1003", data_row(1003, 2, PEONIES.format(1), 450))
+    rollups = storage.order_rollups()
+    monday = BASE_DATE.date()
+    assert totals(rollups.daily_frame()) == {monday: (2300, 4), monday + timedelta(days=7): (100, 1)}
+    assert totals(rollups.weekly_frame())[monday] == (2300, 4)
+    items = rollups.top_items(5).set_index('НАИМЕНОВАНИЕ')
+    assert items.loc['Розы'].tolist() == [6, 600.0]
+    assert items.loc['Пионы'].tolist() == [4, 1800.0]
+    assert rollups.slot_frame()['ЗАЯВОК'].to_dict() == {"09:00": 1, "09:30": 1, "11:00": 2, "12:00": 1}
+
+
+def test_delete_subtracts_contribution_and_drops_empty_keys(storage):
+    assert storage.archive_orders(BASE_DATE + timedelta(hours=1)) == 2
+    rollups = storage.order_rollups()
+    monday = BASE_DATE.date()
+    assert totals(rollups.daily_frame())[monday] == (900, 1)
+    assert rollups.slot_frame()['ЗАЯВОК'].to_dict() == {"09:00": 1, "11:00": 1, "12:00": 1}
+    assert rollups.top_items(5).set_index('НАИМЕНОВАНИЕ').loc['Пионы'].tolist() == [2, 900.0]
+    assert set(rollups.by_day) == {monday, monday + timedelta(days=1), monday + timedelta(days=7)}
+
+    assert storage.archive_orders(BASE_DATE + timedelta(days=10)) == 3
+    rollups = storage.order_rollups()
+    assert rollups.by_day == {} and rollups.by_slot == {} and rollups.by_item == {}
+    assert rollups.weekly_frame().empty
+
+
+def test_remote_delta_updates_rollups_incrementally(synced_sheet):
+    orders_ws, storage = synced_sheet
+    before = storage.order_rollups().daily_frame()
+    day = BASE_DATE.date()
+    assert before.loc[day, 'ЗАЯВОК'] == 12
+
+    orders_ws.rows.append(order_row(2000, hours=48, order="Пионы - 2 шт. (по 450.00 РУБ.)", total=900))
+    orders_ws.rows[4] = order_row(1003, hours=3, order="Розы - 5 шт. (по 100.00 РУБ.)", total=500, revision="2")
+    del orders_ws.rows[2]
+    sync_remote(orders_ws, storage)
+
+    rollups = storage.order_rollups()
+    daily = rollups.daily_frame()
+    assert daily.loc[day, 'ЗАЯВОК'] == 11
+    assert daily.loc[day, 'ВЫРУЧКА'] == 300 * 10 + 500
+    assert daily.loc[day + timedelta(days=2), 'ВЫРУЧКА'] == 900
+    top = rollups.top_items(5).set_index('НАИМЕНОВАНИЕ')
+    assert top.loc['Розы', 'КОЛИЧЕСТВО'] == 3 * 10 + 5
+    assert top.loc['Пионы', 'КОЛИЧЕСТВО'] == 2
+    assert rollups.slot_frame().loc[app.slot_label(9 * 3600), 'ЗАЯВОК'] == 2
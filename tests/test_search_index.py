@@ -0,0 +1,64 @@
+import pytest
+
+import app
+from conftest import FakeWorksheet, order_row, sync_remote
+
+
+def numbers(storage, ids):
+    return sorted(storage.table.df.loc[ids, 'НОМЕР_ЗАЯВКИ'].astype(str))
+
+
+@pytest.fixture
+def customers_sheet():
+    rows = [order_row(1000, hours=0, phone="8 (900) 123-45-67", address="ул. Садовая, 7"),
+            order_row(1001, hours=1, phone="+7 900 765-43-21", address="пр. МИРА, 5"),
+            order_row(1002, hours=2, phone="89001112233", address="Набережная ул., 12"),
+            order_row(1003, hours=3, phone="+79005550000", address="Садовая-Кудринская, 3")]
+    storage = app.GSheetStorage(FakeWorksheet([app.SHEET_HEADERS] + rows))
+    storage.load_orders()
+    return storage
+
+
+@pytest.mark.parametrize('query, expected', [
+    ("8 900 123", ['1000']),          # ведущая 8 запроса - как 7
+    ("7900123", ['1000']),            # и наоборот: сохранённый телефон с 8 нормализован
+    ("+7 (900) 765-43", ['1001']),
+    ("8900111", ['1002']),
+    ("900", ['1000', '1001', '1002', '1003']),
+    ("45-67", ['1000']),
+])
+def test_phone_queries_match_normalised_phones(customers_sheet, query, expected):
+    assert numbers(customers_sheet, customers_sheet.search_orders(query)) == expected
+
+
+@pytest.mark.parametrize('query, expected', [
+    ("САДОВАЯ", ['1000', '1003']),
+    ("мира", ['1001']),
+    ("  набережная  ", ['1002']),
+    ("кудринская", ['1003']),
+    ("ул", ['1000', '1002']),          # короче триграммы - перебором
+    ("Тверская", []),
+])
+def test_address_search_ignores_cyrillic_case(customers_sheet, query, expected):
+    assert numbers(customers_sheet, customers_sheet.search_orders(query)) == expected
+
+
+@pytest.mark.parametrize('query', ["8 900 123", "садовая", "ул", "10", "мира"])
+def test_match_frame_agrees_with_index(customers_sheet, query):
+    df = customers_sheet.table.df
+    mask = app.OrderSearchIndex.match_frame(df, query)
+    assert numbers(customers_sheet, list(df.index[mask])) == numbers(customers_sheet, customers_sheet.search_orders(query))
+
+
+def test_remote_delta_updates_search_index_incrementally(synced_sheet):
+    orders_ws, storage = synced_sheet
+    assert numbers(storage, storage.search_orders("1001")) == ['1001']
+
+    orders_ws.rows.append(order_row(2000, hours=20, address="ул. Садовая, 7"))
+    orders_ws.rows[4] = order_row(1003, hours=3, address="пр. Мира, 5", revision="2")
+    del orders_ws.rows[2]
+    sync_remote(orders_ws, storage)
+
+    assert numbers(storage, storage.search_orders("садовая")) == ['2000']
+    assert numbers(storage, storage.search_orders("мира")) == ['1003']
+    assert storage.search_orders("1001") == []
@@ -0,0 +1,122 @@
+import os
+import time
+
+import pandas as pd
+from gspread.utils import numericise_all
+
+import app
+from conftest import FakeWorksheet, order_row
+
+
+def make_sheet(count=6):
+    return FakeWorksheet([app.SHEET_HEADERS] + [order_row(1000 + i, hours=i) for i in range(count)])
+
+
+def shared_storage(orders_ws, path):
+    """Хранилище отдельного процесса: своя таблица, общий файл снимка"""
+    return app.GSheetStorage(orders_ws, shared=app.ArrowSnapshot(str(path)))
+
+
+def rows_of(frame):
+    return [[str(value) for value in row] for row in frame[app.SHEET_HEADERS].values.tolist()]
+
+
+def sheet_rows(orders_ws):
+    """Строки листа с типами, как их возвращает get_all_records()"""
+    return [[str(value) for value in numericise_all(row)] for row in orders_ws.rows[1:]]
+
+
+def finish_reconcile(storage):
+    """Сверка копии из снимка с листом (в приложении - в фоновом потоке)"""
+    storage.load_orders()
+    thread = storage.sync._reconcile_thread
+    assert thread is not None
+    thread.join(5)
+    assert storage.sync.reconciled
+
+
+def test_snapshot_round_trip_keeps_values_and_metadata(tmp_path):
+    snapshot = app.ArrowSnapshot(str(tmp_path / "orders.arrow"))
+    assert snapshot.stamp() is None
+    frame = pd.DataFrame({'НОМЕР_ЗАЯВКИ': [1000, 1001], 'СУММА': [300, ""], 'АДРЕС': ["ул. Ленина, 1", "пр. Мира, 5"]})
+
+    stamp = snapshot.write(frame, {'source': "тест"})
+
+    read, metadata, read_stamp = snapshot.read()
+    assert read_stamp == stamp == snapshot.stamp()
+    assert metadata == {'source': "тест"}
+    assert read['НОМЕР_ЗАЯВКИ'].tolist() == [1000, 1001]
+    # Числа и текст вперемешку возвращаются с теми же типами, что у get_all_records()
+    assert read['СУММА'].tolist() == [300, ""]
+    assert read['АДРЕС'].tolist() == ["ул. Ленина, 1", "пр. Мира, 5"]
+    assert snapshot.write(frame.iloc[:1]) != stamp
+
+
+def test_second_storage_starts_from_snapshot_and_sees_writes(tmp_path):
+    orders_ws = make_sheet()
+    first = shared_storage(orders_ws, tmp_path / "orders.arrow")
+    first.load_orders()
+    second = shared_storage(orders_ws, tmp_path / "orders.arrow")
+    second.sync._reconcile_thread = object()    # сверку с листом здесь не запускаем
+    orders_ws.calls.clear()
+
+    assert rows_of(second.load_orders()) == sheet_rows(orders_ws)
+    assert orders_ws.calls == []
+    assert not second.sync.reconciled
+
+    first.append_order(order_row(2000, hours=2.5)[:len(app.EXPECTED_HEADERS)])
+    first.update_order("1004", order_row(1004, hours=4, comment="позвонить")[:len(app.EXPECTED_HEADERS)])
+    orders_ws.calls.clear()
+
+    assert rows_of(second.load_orders()) == sheet_rows(orders_ws)
+    assert orders_ws.calls == []
+    assert second.sync.keys == first.sync.keys
+
+
+def test_reconcile_picks_up_remote_change_missing_from_snapshot(tmp_path):
+    orders_ws = make_sheet(20)
+    shared_storage(orders_ws, tmp_path / "orders.arrow").load_orders()
+    # Пока процессы не работали, лист поменяли: перезапись, новая строка и удаление
+    orders_ws.rows[2] = order_row(1001, hours=1, comment="перенос", revision="2")
+    orders_ws.rows.insert(4, order_row(2000, hours=2.5))
+    del orders_ws.rows[-1]
+    past = time.time() - 2 * app.SHEETS_SYNC_INTERVAL_SECONDS
+    os.utime(str(tmp_path / "orders.arrow.lock"), (past, past))
+
+    restarted = shared_storage(orders_ws, tmp_path / "orders.arrow")
+    stale = restarted.load_orders()
+    assert "2000" not in stale['НОМЕР_ЗАЯВКИ'].astype(str).tolist()
+    finish_reconcile(restarted)
+
+    assert rows_of(restarted.load_orders()) == sheet_rows(orders_ws)
+    assert restarted.sync.stats == {'full_reloads': 0, 'delta_checks': 1, 'rows_fetched': 2}
+    # Сверенная копия опубликована для остальных процессов
+    other = shared_storage(orders_ws, tmp_path / "orders.arrow")
+    other.sync._reconcile_thread = object()
+    assert rows_of(other.load_orders()) == sheet_rows(orders_ws)
+
+
+def test_corrupt_snapshot_is_replaced_from_sheet(tmp_path):
+    orders_ws = make_sheet()
+    path = tmp_path / "orders.arrow"
+    path.write_bytes(b"not an arrow file")
+
+    storage = shared_storage(orders_ws, path)
+
+    assert rows_of(storage.load_orders()) == sheet_rows(orders_ws)
+    assert storage.sync.stats['full_reloads'] == 1
+    frame, metadata, _ = app.ArrowSnapshot(str(path)).read()
+    assert rows_of(frame) == sheet_rows(orders_ws)
+
+
+def test_snapshot_of_another_sheet_is_ignored(tmp_path):
+    orders_ws = make_sheet()
+    path = tmp_path / "orders.arrow"
+    other_sheet = make_sheet(2)
+    app.ArrowSnapshot(str(path)).write(pd.DataFrame(other_sheet.get_all_records()), {'source': "другая/ЗАЯВКИ"})
+
+    storage = shared_storage(orders_ws, path)
+
+    assert rows_of(storage.load_orders()) == sheet_rows(orders_ws)
+    assert storage.sync.stats['full_reloads'] == 1
+    assert storage.sync.reconciled
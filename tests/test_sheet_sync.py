@@ -0,0 +1,47 @@
+import app
+from conftest import FakeWorksheet, index_state, order_row, rebuilt_state
+
+
+def sheet(count):
+    return FakeWorksheet([app.SHEET_HEADERS] + [order_row(1000 + i, hours=i, phone=f"+7999000000{i % 3}")
+                                                for i in range(count)])
+
+
+def test_delta_sync_updates_table_through_change_log():
+    orders_ws = sheet(12)
+    storage = app.GSheetStorage(orders_ws)
+    storage.load_orders()
+    index_state(storage)
+    version = storage.table.version
+    ids = list(storage.table.df.index)
+
+    # Другой клиент: новая заявка в середине, правка одной и удаление другой
+    orders_ws.rows.insert(3, order_row(2000, hours=1, phone="+79995550000"))
+    orders_ws.rows[5] = order_row(1003, hours=3, address="пр. Мира, 5", revision="2")
+    del orders_ws.rows[6]
+    orders_ws.calls.clear()
+    storage.sync.mark_stale()
+    storage.load_orders()
+
+    assert orders_ws.calls == [('batch_get', 2), ('batch_get', 2)]
+    assert storage.sync.stats['full_reloads'] == 1
+    assert storage.sync.stats['rows_fetched'] == 2
+    changes = storage.table.changes_since(version)
+    assert changes is not None
+    assert sorted(change.kind for change in changes) == ['delete', 'insert', 'update']
+    assert list(storage.table.df['НОМЕР_ЗАЯВКИ'].astype(str)[:6]) == ['1000', '1001', '2000', '1002', '1003', '1005']
+    assert list(storage.table.df.index[:2]) == ids[:2]
+    assert storage.sync.keys == [(row[1], row[8]) for row in orders_ws.rows[1:]]
+    assert index_state(storage) == rebuilt_state(storage)
+
+
+def test_full_reload_keeps_unchanged_rows():
+    orders_ws = sheet(5)
+    storage = app.GSheetStorage(orders_ws)
+    storage.load_orders()
+    version = storage.table.version
+    orders_ws.rows.append(order_row(1005, hours=9))
+    storage.resync()
+    changes = storage.table.changes_since(version)
+    assert [change.kind for change in changes] == ['insert']
+    assert changes[0].position == 5
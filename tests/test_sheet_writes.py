@@ -0,0 +1,60 @@
+import pytest
+
+import app
+from conftest import FakeWorksheet, order_row
+
+
+def data_row(number, hours, **kwargs):
+    return order_row(number, hours=hours, **kwargs)[:len(app.EXPECTED_HEADERS)]
+
+
+def sheet_numbers(orders_ws):
+    return [row[1] for row in orders_ws.rows[1:]]
+
+
+@pytest.fixture
+def replicas():
+    """Две копии без очереди записи над одним листом, обе загружены"""
+    orders_ws = FakeWorksheet([app.SHEET_HEADERS] + [order_row(1000 + i, hours=i) for i in range(6)])
+    first, second = app.GSheetStorage(orders_ws), app.GSheetStorage(orders_ws)
+    first.load_orders()
+    second.load_orders()
+    return orders_ws, first, second
+
+
+def test_update_by_stale_copy_overwrites_the_right_row(replicas):
+    orders_ws, first, second = replicas
+    second.append_order(data_row(2000, hours=-1))
+    assert sheet_numbers(orders_ws)[0] == "2000"
+
+    # Копия first ещё не видит 2000: позиция 1003 в ней на строку выше, чем в листе
+    position = first.update_order("1003", data_row(1003, hours=3, comment="позвонить"))
+
+    assert sheet_numbers(orders_ws) == ["2000", "1000", "1001", "1002", "1003", "1004", "1005"]
+    assert orders_ws.rows[5][5] == "позвонить"
+    assert position == 4
+    assert list(first.table.df['НОМЕР_ЗАЯВКИ'].astype(str)) == sheet_numbers(orders_ws)
+
+
+def test_insert_by_stale_copy_keeps_sheet_sorted(replicas):
+    orders_ws, first, second = replicas
+    second.append_order(data_row(2000, hours=2))
+    del orders_ws.rows[1]
+    first.append_order(data_row(3000, hours=4))
+    # Соседи 3000 в листе те же, что в копии, - лишнего чтения нет; остальное догонит синхронизация
+    assert sheet_numbers(orders_ws) == ["1001", "2000", "1002", "1003", "3000", "1004", "1005"]
+    first.sync.mark_stale()
+    assert list(first.load_orders()['НОМЕР_ЗАЯВКИ'].astype(str)) == sheet_numbers(orders_ws)
+
+    # Соседи изменились: копия догоняет лист до вставки
+    second.append_order(data_row(4000, hours=0))
+    first.append_order(data_row(5000, hours=0))
+    assert sheet_numbers(orders_ws) == ["5000", "4000", "1001", "2000", "1002", "1003", "3000", "1004", "1005"]
+
+
+def test_fresh_copy_writes_with_one_row_check(replicas):
+    orders_ws, first, _ = replicas
+    orders_ws.calls.clear()
+    first.update_order("1002", data_row(1002, hours=2, comment="позвонить"))
+    assert orders_ws.calls == [('get', 'B4:I4'), 'update']
+    assert orders_ws.rows[3][5] == "позвонить"
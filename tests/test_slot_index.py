@@ -0,0 +1,70 @@
+from datetime import timedelta
+
+import pytest
+
+import app
+from conftest import BASE_DATE, order_row, sync_remote
+
+
+def data_row(number, hours):
+    return order_row(number, hours=hours)[:len(app.EXPECTED_HEADERS)]
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """Лимит - две заявки на слот; слот 09:00 уже заполнен"""
+    monkeypatch.setattr(app, 'SLOT_CAPACITY', 2)
+    storage = app.SQLiteStorage(str(tmp_path / "crm.db"))
+    storage.append_orders([data_row(1000, 0), data_row(1001, 0.25), data_row(1002, 1)])
+    return storage
+
+
+@pytest.mark.parametrize('policy, refused', [("refuse", True), ("warn", False)])
+def test_full_slot_is_refused_or_warned(storage, monkeypatch, policy, refused):
+    monkeypatch.setattr(app, 'SLOT_OVERBOOKING', policy)
+    occupancy = storage.slot_occupancy()
+    assert app.check_delivery_slot(occupancy, BASE_DATE + timedelta(minutes=20)) == (2, True, refused)
+    assert app.check_delivery_slot(occupancy, BASE_DATE + timedelta(hours=1)) == (1, False, False)
+    assert occupancy.full_slots(BASE_DATE.date(), app.SLOT_CAPACITY) == [9 * 3600]
+
+
+def test_edited_order_does_not_take_a_place_in_its_own_slot(storage, monkeypatch):
+    monkeypatch.setattr(app, 'SLOT_OVERBOOKING', "refuse")
+    occupancy = storage.slot_occupancy()
+    assert app.check_delivery_slot(occupancy, BASE_DATE, BASE_DATE + timedelta(minutes=15)) == (1, False, False)
+    assert app.check_delivery_slot(occupancy, BASE_DATE, BASE_DATE + timedelta(hours=1)) == (2, True, True)
+
+
+def test_freed_slot_becomes_available_again(storage, monkeypatch):
+    monkeypatch.setattr(app, 'SLOT_OVERBOOKING', "refuse")
+    storage.update_order("1001", data_row(1001, 2))
+    occupancy = storage.slot_occupancy(fresh=False)
+    assert app.check_delivery_slot(occupancy, BASE_DATE) == (1, False, False)
+    assert occupancy.full_slots(BASE_DATE.date(), app.SLOT_CAPACITY) == []
+
+    storage.append_orders([data_row(1003, 0)])
+    assert app.check_delivery_slot(storage.slot_occupancy(), BASE_DATE)[2]
+    storage.archive_orders(BASE_DATE + timedelta(minutes=1))
+    assert app.check_delivery_slot(storage.slot_occupancy(), BASE_DATE) == (0, False, False)
+
+
+def test_form_reads_loaded_copy_without_checking_the_source(storage, monkeypatch):
+    storage.load_orders()
+    monkeypatch.setattr(storage, 'load_orders', lambda: pytest.fail("load_orders() на перезапуске формы"))
+    assert storage.slot_occupancy(fresh=False).count(BASE_DATE) == 2
+
+
+def test_remote_delta_updates_slot_occupancy_incrementally(synced_sheet):
+    orders_ws, storage = synced_sheet
+    assert storage.slot_occupancy().count(BASE_DATE) == 1
+
+    orders_ws.rows.append(order_row(2000, hours=0))
+    orders_ws.rows[4] = order_row(1003, hours=0, revision="2")
+    del orders_ws.rows[2]
+    sync_remote(orders_ws, storage)
+
+    slots = storage.slot_occupancy()
+    assert slots.count(BASE_DATE) == 3
+    assert slots.count(BASE_DATE + timedelta(hours=1)) == 0
+    assert slots.count(BASE_DATE + timedelta(hours=3)) == 0
+    assert slots.full_slots(BASE_DATE.date(), 3) == [9 * 3600]
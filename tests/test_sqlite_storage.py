@@ -0,0 +1,47 @@
+from datetime import timedelta
+
+import app
+from conftest import BASE_DATE, index_state, order_row, rebuilt_state
+
+
+def data_row(number, hours, **kwargs):
+    return order_row(number, hours=hours, **kwargs)[:len(app.EXPECTED_HEADERS)]
+
+
+def numbers(frame):
+    return list(frame['НОМЕР_ЗАЯВКИ'].astype(str))
+
+
+def test_update_order_moves_row_to_new_delivery_date(tmp_path):
+    storage = app.SQLiteStorage(str(tmp_path / "crm.db"))
+    storage.append_orders([data_row(1000 + i, hours=i) for i in range(4)])
+    storage.load_orders()
+    index_state(storage)
+    version = storage.table.version
+
+    position = storage.update_order("1000", data_row(1000, hours=10, address="пр. Мира, 5"))
+
+    assert position == 3
+    assert numbers(storage.table.df) == ['1001', '1002', '1003', '1000']
+    assert [change.kind for change in storage.table.changes_since(version)] == ['delete', 'insert']
+    assert index_state(storage) == rebuilt_state(storage)
+    # Порядок в таблице совпадает с порядком в файле
+    fresh = app.SQLiteStorage(str(tmp_path / "crm.db"))
+    assert numbers(fresh.load_orders()) == numbers(storage.table.df)
+
+    window, _ = fresh.load_orders_window(BASE_DATE, BASE_DATE + timedelta(hours=2))
+    assert numbers(window) == ['1001']
+    assert numbers(next(fresh.iter_orders(BASE_DATE + timedelta(hours=9), BASE_DATE + timedelta(hours=11)))) == ['1000']
+
+    assert storage.archive_orders(BASE_DATE + timedelta(hours=5)) == 3
+    assert numbers(storage.load_orders()) == ['1000']
+
+
+def test_update_order_with_same_date_updates_in_place(tmp_path):
+    storage = app.SQLiteStorage(str(tmp_path / "crm.db"))
+    storage.append_orders([data_row(1000 + i, hours=i) for i in range(3)])
+    storage.load_orders()
+    version = storage.table.version
+    assert storage.update_order("1001", data_row(1001, hours=1, comment="позвонить")) == 1
+    assert [change.kind for change in storage.table.changes_since(version)] == ['update']
+    assert storage.table.df.iloc[1]['КОММЕНТАРИЙ'] == "позвонить"
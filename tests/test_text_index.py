@@ -0,0 +1,72 @@
+from datetime import timedelta
+
+import pytest
+
+import app
+from conftest import BASE_DATE, order_row, sync_remote
+
+
+def numbers(storage, ids):
+    return sorted(storage.table.df.loc[ids, 'НОМЕР_ЗАЯВКИ'].astype(str))
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = app.SQLiteStorage(str(tmp_path / "crm.db"))
+    storage.append_orders([order_row(number, hours=hours, order=order, comment=comment)[:len(app.EXPECTED_HEADERS)]
+                           for number, hours, order, comment in [
+        (1000, 0, "Розы красные - 5 шт. (по 100.00 РУБ.) | без упаковки", "Домофон не работает"),
+        (1001, 2, "Пионы - 3 шт. (по 450.00 РУБ.)", "позвонить за час"),
+        (1002, 26, "Розы белые - 7 шт. (по 120.00 РУБ.)", "Ёлка у подъезда, домофон 12"),
+        (1003, 50, "Тюльпаны - 9 шт. (по 50.00 РУБ.)", "ДОМОФОНА нет"),
+    ]])
+    storage.load_orders()
+    return storage
+
+
+@pytest.mark.parametrize('query, expected', [
+    ("роз", ['1000', '1002']),
+    ("РОЗЫ бел", ['1002']),                   # все слова запроса, регистр не важен
+    ("домофон", ['1000', '1002', '1003']),    # префикс: и "домофона"
+    ("домофона", ['1003']),
+    ("елка", ['1002']),                      # ё = е
+    ("упаков", ['1000']),                    # комментарий позиции
+    ("шт", []),                              # количество и цена не индексируются
+    ("роз тюльп", []),
+])
+def test_prefix_queries(storage, query, expected):
+    assert numbers(storage, storage.search_order_text(query)) == expected
+
+
+@pytest.mark.parametrize('hours, query, expected', [
+    ((0, 24), "домофон", ['1000']),
+    ((0, 30), "домофон", ['1000', '1002']),
+    ((24, 72), "домоф", ['1002', '1003']),
+    ((1, 24), "роз", []),
+])
+def test_prefix_query_within_delivery_window(storage, hours, query, expected):
+    start, end = (BASE_DATE + timedelta(hours=h) for h in hours)
+    window, version = storage.load_orders_window(start, end)
+    assert version == storage.table.version
+    # Как в списке заявок: окно по дате и идентификаторы строк из индекса
+    matched = window[window.index.isin(storage.search_order_text(query))]
+    assert sorted(matched['НОМЕР_ЗАЯВКИ'].astype(str)) == expected
+
+
+def test_empty_query_returns_every_row(storage):
+    assert numbers(storage, storage.search_order_text("  ")) == ['1000', '1001', '1002', '1003']
+
+
+def test_remote_delta_updates_text_index_incrementally(synced_sheet):
+    orders_ws, storage = synced_sheet
+    assert storage.search_order_text("пионы") == []
+
+    orders_ws.rows.append(order_row(2000, hours=20, order="Пионы - 2 шт. (по 450.00 РУБ.)", total=900))
+    orders_ws.rows[4] = order_row(1003, hours=3, comment="Домофон не работает", revision="2")
+    sync_remote(orders_ws, storage)
+    assert numbers(storage, storage.search_order_text("пион")) == ['2000']
+    assert numbers(storage, storage.search_order_text("домофон")) == ['1003']
+
+    del orders_ws.rows[-1]
+    sync_remote(orders_ws, storage)
+    assert storage.search_order_text("пион") == []
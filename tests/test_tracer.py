@@ -0,0 +1,94 @@
+import importlib.util
+import json
+
+import app
+
+
+def rerun_script():
+    """Повторное выполнение app.py, как при перезапуске сценария Streamlit"""
+    spec = importlib.util.spec_from_file_location("app", app.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_tracer_survives_script_reruns():
+    with app.tracer.span("test.before_rerun"):
+        pass
+    module = rerun_script()
+    assert module.tracer is app.tracer
+    assert module.get_tracer() is app.get_tracer()
+    assert "test.before_rerun" in module.tracer.prometheus_text()
+
+
+def test_first_rerun_exports_metrics(tmp_path, monkeypatch):
+    log_path = tmp_path / "trace.jsonl"
+    monkeypatch.setattr(app, 'TRACE_LOG_PATH', str(log_path))
+    tracer = app.Tracer(enabled=True)
+    with tracer.rerun():
+        with tracer.span("test.work"):
+            pass
+    lines = log_path.read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 1
+    snapshot = json.loads(lines[0])
+    assert snapshot['reruns'] == 1
+    assert snapshot['spans']['test.work']['calls'] == 1
+    # Следующая выгрузка - не раньше TRACE_EXPORT_SECONDS
+    with tracer.rerun():
+        pass
+    assert len(log_path.read_text(encoding="utf-8").splitlines()) == 1
+
+
+def test_storage_methods_are_traced_once_per_call():
+    class ProbeStorage(app.OrderStorage):
+        name = "probe"
+
+        def load_orders(self):
+            return self.table.df
+
+    class ChildStorage(ProbeStorage):
+        def search_orders(self, query):
+            return super().search_orders(query)
+
+    # Унаследованный метод оборачивается в подклассе, базовый класс не меняется
+    assert ProbeStorage.search_orders.traced and ProbeStorage.load_orders.traced
+    assert not getattr(app.OrderStorage.search_orders, 'traced', False)
+    assert ChildStorage.load_orders is ProbeStorage.load_orders
+
+    def calls(name):
+        return app.tracer.snapshot()['spans'].get(name, {}).get('calls', 0)
+    before = calls("storage.probe.search_orders")
+    ChildStorage().search_orders("1000")
+    assert calls("storage.probe.search_orders") == before + 1
+
+
+def traced_fragment_script():
+    import streamlit as st
+
+    import app
+
+    @app.traced_fragment("probe")
+    def part():
+        with app.tracer.span("probe.work"):
+            st.session_state.breakdown = [span.name for span in app.tracer.current_rerun()]
+
+    with app.tracer.rerun():
+        part()
+    st.button("Обновить", on_click=lambda: st.rerun("probe"))
+
+
+def test_fragment_rerun_is_measured_as_rerun():
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_function(traced_fragment_script)
+    at.run()
+    assert at.session_state.breakdown == ["rerun", "probe.work"]
+    reruns = app.tracer.snapshot()['reruns']
+
+    at.button[0].click().run()
+
+    assert not at.exception
+    assert at.session_state.breakdown == ["fragment.probe", "probe.work"]
+    snapshot = app.tracer.snapshot()
+    assert snapshot['reruns'] == reruns + 1
+    assert snapshot['spans']['fragment.probe']['calls'] >= 1
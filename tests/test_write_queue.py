@@ -0,0 +1,67 @@
+import app
+from conftest import order_row, sheet_storage
+
+ITEMS = [{'НАИМЕНОВАНИЕ': "Розы", 'КОЛИЧЕСТВО': 3, 'ЦЕНА_ЗА_ЕД': 100.0, 'СУММА': 300.0, 'КОММЕНТАРИЙ_ПОЗИЦИИ': ""}]
+
+
+def queued_storage(tmp_path, count=12):
+    orders_ws, _ = sheet_storage(count)
+    queue = app.SheetWriteQueue(str(tmp_path / "outbox.db"))
+    storage = app.GSheetStorage(orders_ws, write_queue=queue)
+    storage.load_orders()
+    return orders_ws, queue, storage, app.SheetWriteWorker(queue, orders_ws)
+
+
+def sheet_numbers(orders_ws):
+    return [row[1] for row in orders_ws.rows[1:]]
+
+
+def test_flush_after_crash_does_not_duplicate_rows(tmp_path, monkeypatch):
+    orders_ws, queue, storage, worker = queued_storage(tmp_path)
+    data_row = order_row(2000, hours=4)[:len(app.EXPECTED_HEADERS)]
+    storage.append_order(data_row, ITEMS)
+
+    # batchUpdate прошёл, а отметка в очереди - нет: пачка останется в очереди
+    mark_synced = queue.mark_synced
+    monkeypatch.setattr(queue, 'mark_synced', lambda ids: (_ for _ in ()).throw(OSError("disk full")))
+    worker.flush_once()
+    monkeypatch.setattr(queue, 'mark_synced', mark_synced)
+    assert queue.has_queued()
+
+    worker.flush_once()
+
+    assert not queue.has_queued()
+    assert sheet_numbers(orders_ws).count("2000") == 1
+    items_ws = orders_ws.spreadsheet.worksheet(app.WORKSHEET_NAME_ORDER_ITEMS)
+    assert [row[0] for row in items_ws.rows[1:]] == ["2000"]
+
+
+def test_failed_write_stays_visible_after_sync(tmp_path):
+    orders_ws, queue, storage, worker = queued_storage(tmp_path)
+    storage.append_order(order_row(2000, hours=4)[:len(app.EXPECTED_HEADERS)])
+    storage.update_order("1007", order_row(1007, hours=7, comment="позвонить")[:len(app.EXPECTED_HEADERS)])
+
+    def unavailable(body):
+        raise OSError("unavailable")
+    orders_ws.spreadsheet.batch_update = unavailable
+    for _ in range(app.WRITE_QUEUE_MAX_ATTEMPTS):
+        worker.flush_once()
+    assert not queue.has_queued()
+    assert set(queue.status_by_order().values()) == {'failed'}
+
+    # Сверка с листом, где этих записей нет, не убирает их из копии
+    storage.resync()
+    storage.sync.mark_stale()
+    frame = storage.load_orders()
+    numbers = list(frame['НОМЕР_ЗАЯВКИ'].astype(str))
+    assert numbers.count("2000") == 1 and numbers.index("2000") == numbers.index("1004") - 1
+    assert frame.iloc[numbers.index("1007")]['КОММЕНТАРИЙ'] == "позвонить"
+    assert "2000" not in sheet_numbers(orders_ws)
+
+    # После повторной отправки строка в листе одна, и копия совпадает с листом
+    del orders_ws.spreadsheet.batch_update
+    queue.retry_failed()
+    worker.flush_once()
+    storage.sync.mark_stale()
+    assert list(storage.load_orders()['НОМЕР_ЗАЯВКИ'].astype(str)) == sheet_numbers(orders_ws)
+    assert sheet_numbers(orders_ws).count("2000") == 1